@@ -5,42 +5,84 @@ import os
 import base64
 import re
 
-import aiosqlite
 from openai import AsyncOpenAI, RateLimitError
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile, BufferedInputFile, InputMediaPhoto
+from aiogram.exceptions import TelegramAPIError
+
+from log_setup import bind_log_context
+from job_queue import Job, MemoryJobQueue
+from hedging import HedgePolicy, LocalHedgeStats
+from preview import GENERATION_STREAM, PARTIAL_IMAGES, PREVIEW_CAPTION, Preview
+from concurrency import AdaptiveLimiter
+from degradation import DegradationPolicy, tier_params
+from quota import default_limit, release_generation
+from generation import ANOTHER_BUTTON, build_prompt, result_caption
+from name_render import NAME_RENDER, render_name_async
+from storage import make_storage
 
 from config import (
     API_KEYS,
-    DB_PATH,
     OUTPUT_DIR,
     DELAY_BETWEEN_REQUESTS,
+    MAX_CONCURRENT_TASKS,
     logger,
     REF_MALE,
     REF_FEMALE
 )
 
+# после стольких неудачных попыток задача снимается с очереди
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
 class ImageGenerator:
-    def __init__(self, api_keys, bot):
+    def __init__(self, api_keys, bot, queue=None, stream: bool = GENERATION_STREAM, limiter=None, storage=None):
         self.api_keys = api_keys
         self.current_key_index = 0
-        self.queue = asyncio.Queue()
+        # MemoryJobQueue или SQLiteJobQueue (job_queue.py)
+        self.queue = queue or MemoryJobQueue()
         self.lock = asyncio.Lock()
         self.bot = bot
-        logger.debug(f"Initialized lock: {type(self.lock)}")
+        # счётчики пользователей (storage.py); бот передаёт своё хранилище
+        self.storage = storage or make_storage()
+        self._workers: list[asyncio.Task] = []
+        self._in_flight: dict[asyncio.Task, Job] = {}
+        self._stopping = asyncio.Event()
+        self.hedge = HedgePolicy(LocalHedgeStats())
+        # потоковая генерация с превью (preview.py)
+        self.stream = stream
+        # превью по id задачи: повтор после ошибки продолжает то же сообщение, а не шлёт новое
+        self._previews: dict[int, Preview] = {}
+        # сколько запросов к OpenAI идёт одновременно — подстраивается под 429 и задержку
+        self.limiter = limiter or AdaptiveLimiter(MAX_CONCURRENT_TASKS)
+        # при длинной очереди новые задачи идут в более дешёвом качестве (degradation.py)
+        self.degradation = DegradationPolicy()
+        logger.debug("Initialized lock: %s", type(self.lock))
 
     async def get_next_api_key(self) -> str:
         async with self.lock:
             key = self.api_keys[self.current_key_index]
             self.current_key_index = (self.current_key_index + 1) % len(self.api_keys)
-            logger.debug(f"Selected API key: {key[:5]}…")
+            logger.debug("Selected API key: %s…", key[:5])
             return key
 
+    @staticmethod
+    def retry_after(e: RateLimitError) -> float:
+        # заголовки ответа — в e.response (у самого исключения атрибута headers нет)
+        response = getattr(e, 'response', None)
+        if response is not None and response.headers.get('Retry-After'):
+            return float(response.headers['Retry-After'])
+        m = re.search(r"(?:after|in) ([0-9]+(?:\.[0-9]+)?) ?s", str(e))
+        return float(m.group(1)) if m else DELAY_BETWEEN_REQUESTS
+
     async def generate_image(
         self,
         image_path: str,
         profession: str,
         gender: str,
-        user_id: str
+        user_id: str,
+        preview: Preview | None = None,
+        tier: str | None = None,
+        output_path: str | None = None,
+        name: str = "Пользователь"
     ) -> str:
         if not os.path.exists(image_path):
             msg = f"Image not found: {image_path} for user {user_id}"
@@ -49,94 +91,302 @@ class ImageGenerator:
 
         ref_path = REF_MALE if gender == "male" else REF_FEMALE
 
-        prompt = f"Transform this person into a {profession}, {gender} in a realistic style."
-        api_key = await self.get_next_api_key()
-        client = AsyncOpenAI(api_key=api_key)
+        # тот же промпт упаковки с аксессуарами, что и у Celery (generation.py)
+        prompt = build_prompt(profession, name)
+
+        async def request(attempt: int, slot):
+            # у дубля (attempt=1) свой ключ — следующий по кругу; слот limiter-а берёт hedge
+            client = AsyncOpenAI(api_key=await self.get_next_api_key())
+            try:
+                with open(image_path, "rb") as img_file, open(ref_path, "rb") as ref_file:
+                    return await client.images.edit(
+                        model="gpt-image-1",
+                        prompt=prompt,
+                        image=[img_file, ref_file],
+                        n=1,
+                        **tier_params(tier)
+                    )
+            except RateLimitError as e:
+                slot.rate_limited(self.retry_after(e))
+                raise
+            except asyncio.CancelledError:
+                # отменён проигравший дубль — о пропускной способности OpenAI это ничего не говорит
+                slot.abandon()
+                raise
 
         try:
-            with open(image_path, "rb") as img_file, open(ref_path, "rb") as ref_file:
-                response = await client.images.edit(
-                    model="gpt-image-1",
-                    prompt=prompt,
-                    image=[img_file, ref_file],
-                    n=1,
-                    size="1024x1024",
-                    quality="medium"
-                )
-            b64 = response.data[0].b64_json
+            if preview is not None:
+                # без хеджирования: два потока показывали бы пользователю два превью
+                b64 = await self.stream_image(prompt, image_path, ref_path, preview, tier)
+            else:
+                response = await self.hedge.run_async(request, self.limiter.slot)
+                b64 = response.data[0].b64_json
             if not b64:
                 raise RuntimeError("Empty image data from OpenAI")
 
             data = base64.b64decode(b64)
-            filename = f"result_{user_id}_{int(asyncio.get_event_loop().time())}.png"
-            output_path = os.path.join(OUTPUT_DIR, filename)
-            with open(output_path, "wb") as out_file:
+            if NAME_RENDER:
+                # имя на табличку упаковки — своим шрифтом, в пуле процессов (name_render.py)
+                data = await render_name_async(data, name)
+            if output_path is None:
+                filename = f"result_{user_id}_{int(asyncio.get_event_loop().time())}.png"
+                output_path = os.path.join(OUTPUT_DIR, filename)
+            # файл появляется целиком — по нему воркер узнаёт, что генерация уже была
+            with open(f"{output_path}.tmp", "wb") as out_file:
                 out_file.write(data)
+            os.replace(f"{output_path}.tmp", output_path)
 
-            logger.info(f"Image saved: {output_path}")
+            logger.info("Image saved: %s", output_path)
             return output_path
 
         except RateLimitError as e:
-            retry_after = None
-            if hasattr(e, 'headers') and e.headers.get('Retry-After'):
-                retry_after = float(e.headers['Retry-After'])
-            else:
-                m = re.search(r"after ([0-9]+(?:\.[0-9]+)?) seconds", str(e))
-                retry_after = float(m.group(1)) if m else DELAY_BETWEEN_REQUESTS
-            logger.warning(f"Rate limit exceeded, sleeping {retry_after}s for user {user_id}")
-            await asyncio.sleep(retry_after)
-            return await self.generate_image(image_path, profession, gender, user_id)
+            # паузу до Retry-After выдерживает limiter — повтор встанет в очередь за слотом
+            logger.warning("Rate limit exceeded for user %s, retry after %ss", user_id, self.retry_after(e))
+            return await self.generate_image(image_path, profession, gender, user_id, preview, tier, output_path, name)
 
         except Exception as e:
-            logger.error(f"Generation error for user {user_id}: {e}")
+            logger.error("Generation error for user %s: %s", user_id, e)
             raise
 
-    async def worker(self):
-        while True:
-            image_path, profession, gender, user_id = await self.queue.get()
-            try:
-                result_path = await self.generate_image(image_path, profession, gender, user_id)
+    async def show_preview(self, preview: Preview, b64: str) -> None:
+        """Отправляет первый кадр превью, следующими заменяет его — не чаще preview.interval."""
+        photo = BufferedInputFile(base64.b64decode(b64), filename="preview.png")
+        if preview.message_id is None:
+            msg = await self.bot.send_photo(chat_id=preview.chat_id, photo=photo, caption=PREVIEW_CAPTION)
+            preview.message_id = msg.message_id
+        elif not preview.wait_time():
+            await self.bot.edit_message_media(
+                chat_id=preview.chat_id,
+                message_id=preview.message_id,
+                media=InputMediaPhoto(media=photo, caption=PREVIEW_CAPTION),
+            )
+        else:
+            return
+        preview.mark()
 
-                async with aiosqlite.connect(DB_PATH) as db:
-                    cur = await db.execute(
-                        "SELECT photo_count FROM users WHERE user_id = ?",
-                        (int(user_id),)
+    async def stream_image(
+        self,
+        prompt: str,
+        image_path: str,
+        ref_path: str,
+        preview: Preview,
+        tier: str | None = None
+    ) -> str:
+        """images.edit в потоковом режиме: промежуточные кадры уходят в чат, возвращается итоговый b64."""
+        client = AsyncOpenAI(api_key=await self.get_next_api_key())
+        async with self.limiter.slot() as slot:
+            try:
+                with open(image_path, "rb") as img_file, open(ref_path, "rb") as ref_file:
+                    stream = await client.images.edit(
+                        model="gpt-image-1",
+                        prompt=prompt,
+                        image=[img_file, ref_file],
+                        n=1,
+                        **tier_params(tier),
+                        stream=True,
+                        partial_images=PARTIAL_IMAGES
                     )
-                    row = await cur.fetchone()
-                    count = row[0] if row else 0
-
-                if count > 1:
-                    caption = (
-                        "Возвращаемся с результатом. Можете скачать, поделиться\n\n"
-                        "Большое спасибо за участие! Попытки закончились\n"
-                        "Можете нажать help, если в генерации возникла ошибка с написанием"
-                        )
-                else:
-                    caption = "Ваша фигурка готова 🥳 Скорее скачивайте, ставьте на аватарку в Telegram и не меняйте до конца конкурса — 5 июня!\nИ не забудьте поделиться с друзьями, пусть тоже поучаствуют в розыгрыше приза!\nЕсли вдруг что-то не так, нажмите help🥺"
-
-                message = await self.bot.send_photo(
-                        chat_id=user_id,
-                        photo=FSInputFile(result_path),
-                        caption=caption,
-                        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                        InlineKeyboardButton(text="help", callback_data="help"),
-                        InlineKeyboardButton(text="Другую фигурку", callback_data="another")
-                    ]])
+                    async with stream:
+                        async for event in stream:
+                            if event.type == "image_edit.partial_image":
+                                try:
+                                    await self.show_preview(preview, event.b64_json)
+                                except TelegramAPIError as e:
+                                    # превью — не главное, генерацию из-за него не роняем
+                                    logger.warning("Preview failed for user %s: %s", preview.chat_id, e)
+                            elif event.type == "image_edit.completed":
+                                return event.b64_json
+            except RateLimitError as e:
+                slot.rate_limited(self.retry_after(e))
+                raise
+        raise RuntimeError("Image stream ended without image_edit.completed")
+
+    async def start(self, workers: int | None = None) -> None:
+        """
+        Открывает очередь (поднимая задачи, прерванные прошлым перезапуском) и запускает воркеры.
+        По умолчанию воркеров столько, сколько максимально разрешает limiter: реальную
+        параллельность запросов к OpenAI держит он.
+        """
+        await self.queue.open()
+        count = workers or self.limiter.max_limit
+        self._workers += [asyncio.create_task(self.worker()) for _ in range(count)]
+
+    def result_path(self, job: Job) -> str:
+        # результат хранится под id задачи (и именем исходника — id очереди в памяти
+        # после перезапуска начинаются заново): если прошлая попытка упала на доставке,
+        # повтор отправляет готовую картинку, а не генерирует новую
+        stem = os.path.splitext(os.path.basename(job.payload["image_path"]))[0]
+        return os.path.join(OUTPUT_DIR, f"result_{job.id}_{stem}.png")
+
+    async def process(self, job: Job) -> None:
+        """
+        Конвейер одной задачи: генерация (или уже готовый файл) и доставка пользователю.
+        Ошибки — наружу: повторы решает вызывающий (worker или generation.SyncBackend).
+        """
+        image_path, profession, gender, user_id = (
+            job.payload[k] for k in ("image_path", "profession", "gender", "user_id")
+        )
+        tier = job.payload.get("tier")
+        preview = self._previews.setdefault(job.id, Preview(int(user_id))) if self.stream else None
+        result_path = self.result_path(job)
+        if os.path.exists(result_path):
+            logger.info("Result of job %s already generated, delivering it", job.id)
+        else:
+            # имя обычно приходит от бота, из БД — для задач, поставленных без него
+            name = job.payload.get("name")
+            if name is None:
+                user = await self.storage.get_user(int(user_id))
+                name = user["name"] if user else None
+            await self.generate_image(
+                image_path, profession, gender, user_id, preview, tier, result_path, name or "Пользователь"
+            )
+
+        count, limit = job.payload.get("photo_count"), job.payload.get("limit")
+        if count is None or limit is None:
+            user = await self.storage.get_user(int(user_id))
+            count = user["photo_count"] if user else 0
+            # NULL — личного лимита нет, действует общий из settings
+            if user and user["allowed_generations"] is not None:
+                limit = user["allowed_generations"]
+            else:
+                limit = await default_limit(self.storage)
+        # подпись и кнопка «Другую фигурку» — общие с Celery (generation.py)
+        caption, more = result_caption(count, limit)
+        markup = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(**ANOTHER_BUTTON)]]) if more else None
+
+        delivered = False
+        if preview is not None and preview.message_id is not None:
+            # превью уже в чате (и записано в last_photo_id) — заменяем его результатом
+            await asyncio.sleep(preview.wait_time())
+            try:
+                await self.bot.edit_message_media(
+                    chat_id=user_id,
+                    message_id=preview.message_id,
+                    media=InputMediaPhoto(media=FSInputFile(result_path), caption=caption),
+                    reply_markup=markup,
                 )
+                delivered = True
+            except TelegramAPIError as e:
+                logger.warning("Could not replace preview for %s, sending anew: %s", user_id, e)
+        if not delivered:
+            # bot.send_photo проксирован в bot.py и сам записывает last_photo_id
+            await self.bot.send_photo(
+                    chat_id=user_id,
+                    photo=FSInputFile(result_path),
+                    caption=caption,
+                    reply_markup=markup
+            )
+        self._previews.pop(job.id, None)
+        os.remove(result_path)
+        logger.info("Sent image to %s, removed file %s", user_id, result_path)
+
+    async def give_up(self, job: Job) -> None:
+        """Задача окончательно не удалась: попытка возвращается пользователю, следы задачи убираются."""
+        await release_generation(self.storage, job.payload["user_id"])
+        await self.discard(job)
+
+    async def discard(self, job: Job) -> None:
+        """Убирает следы задачи без результата: превью в чате и недоставленный файл."""
+        await self.discard_preview(job)
+        result_path = self.result_path(job)
+        if os.path.exists(result_path):
+            os.remove(result_path)
+
+    async def discard_preview(self, job: Job) -> None:
+        """Задача снята без результата — её превью не должно остаться в чате."""
+        preview = self._previews.pop(job.id, None)
+        if preview is None or preview.message_id is None:
+            return
+        try:
+            await self.bot.delete_message(chat_id=preview.chat_id, message_id=preview.message_id)
+        except TelegramAPIError as e:
+            logger.warning("Could not delete preview for %s: %s", preview.chat_id, e)
 
-                from bot import best_file_id
-                best_file_id[user_id] = message.message_id
+    async def worker(self):
+        me = asyncio.current_task()
+        while not self._stopping.is_set():
+            job = await self.queue.get()
+            if self._stopping.is_set():
+                await self.queue.release(job.id)
+                break
+            self._in_flight[me] = job
+            user_id = job.payload["user_id"]
+            # у каждого воркера свой контекст — user_id и уровень качества задачи попадут во все его записи
+            bind_log_context(user_id=user_id, job_id=job.id, tier=job.payload.get("tier"))
+            try:
+                await self.process(job)
+                await self.queue.ack(job.id)
 
-                os.remove(result_path)
-                logger.info(f"Sent image to {user_id}, removed file {result_path}")
+            except asyncio.CancelledError:
+                # остановка бота посреди генерации — задача вернётся в очередь при следующем запуске
+                raise
 
             except Exception as e:
-                logger.error(f"Worker error: {e}")
+                logger.error("Worker error (attempt %s/%s): %s", job.attempts, JOB_MAX_ATTEMPTS, e)
+                if job.attempts < JOB_MAX_ATTEMPTS and not isinstance(e, FileNotFoundError):
+                    await self.queue.release(job.id, delay=DELAY_BETWEEN_REQUESTS * 2 ** job.attempts)
+                else:
+                    # попытки исчерпаны — задачу снимаем, а генерацию возвращаем пользователю
+                    await self.queue.ack(job.id)
+                    await self.give_up(job)
 
             finally:
-                self.queue.task_done()
-                await asyncio.sleep(DELAY_BETWEEN_REQUESTS)
+                self._in_flight.pop(me, None)
+
+    async def shutdown(self, timeout: float = 30.0) -> None:
+        """
+        Останавливает воркеры: новые задачи не берутся, текущим даётся timeout секунд.
+        Не успевшие задачи возвращаются в очередь и будут выполнены после перезапуска.
+        """
+        self._stopping.set()
+        busy = [t for t in self._workers if t in self._in_flight]
+        idle = [t for t in self._workers if t not in self._in_flight]
+        for task in idle:
+            task.cancel()
+        if busy:
+            done, pending = await asyncio.wait(busy, timeout=timeout)
+            for task in pending:
+                job = self._in_flight.get(task)
+                task.cancel()
+                if job is not None:
+                    await self.queue.release(job.id)
+            if pending:
+                logger.info("Остановка генератора: %s задач возвращено в очередь", len(pending))
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+        await self.queue.close()
+
+    def projected_wait(self) -> float:
+        """Сколько секунд прождёт задача, поставленная сейчас: очередь / параллельность × задержка."""
+        limiter = self.limiter.snapshot()
+        return self.queue.qsize() * (limiter["latency_s"] or 0.0) / max(limiter["limit"], 1)
 
-    async def add_task(self, image_path: str, profession: str, gender: str, user_id: str):
-        await self.queue.put((image_path, profession, gender, user_id))
-        logger.info(f"Task added for user {user_id}: profession={profession}, gender={gender}")
+    async def add_task(
+        self,
+        image_path: str,
+        profession: str,
+        gender: str,
+        user_id: str,
+        name: str | None = None,
+        photo_count: int | None = None,
+        limit: int | None = None
+    ) -> int:
+        """
+        Ставит задачу в очередь; возвращает её место среди задач к генерации (1 — следующая).
+        name/photo_count/limit — профиль, известный боту (None — process() прочитает его из БД).
+        """
+        tier = self.degradation.choose(self.queue.qsize(), self.projected_wait())
+        await self.queue.put({
+            "image_path": image_path,
+            "profession": profession,
+            "gender": gender,
+            "user_id": user_id,
+            "tier": tier.name,
+            "name": name,
+            "photo_count": photo_count,
+            "limit": limit,
+        })
+        position = await self.queue.position(user_id)
+        logger.info("Task added for user %s: profession=%s, gender=%s, tier=%s, position=%s",
+                    user_id, profession, gender, tier.name, position)
+        return position
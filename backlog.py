@@ -0,0 +1,178 @@
+# backlog.py
+
+import asyncio
+import contextvars
+import os
+from collections import OrderedDict
+
+from aiogram import Bot, Dispatcher
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import Update
+
+from config import logger
+
+BACKLOG_BATCH_SIZE = int(os.getenv("BACKLOG_BATCH_SIZE", "100"))
+# сколько ответов на устаревшие нажатия кнопок отправляем одновременно
+BACKLOG_ANSWER_CONCURRENCY = int(os.getenv("BACKLOG_ANSWER_CONCURRENCY", "20"))
+# сколько пользователей из очереди обрабатываем параллельно (все разом упираются в блокировку users.db)
+BACKLOG_FEED_CONCURRENCY = int(os.getenv("BACKLOG_FEED_CONCURRENCY", "10"))
+
+# True, пока хендлер обрабатывает апдейт из накопившейся очереди (process_backlog)
+replaying: contextvars.ContextVar[bool] = contextvars.ContextVar("backlog_replaying", default=False)
+
+
+def _sender_id(update: Update) -> int | None:
+    if update.message and update.message.from_user:
+        return update.message.from_user.id
+    if update.callback_query:
+        return update.callback_query.from_user.id
+    return None
+
+
+def _is_meaningful(update: Update, state: str | None, text_states: set[str], photo_states: set[str]) -> bool:
+    """Имеет ли смысл обрабатывать сообщение пользователя в его текущем состоянии Form."""
+    msg = update.message
+    if msg is None:
+        return False
+    if msg.text and msg.text.startswith("/"):
+        return True
+    if msg.photo:
+        return state in photo_states
+    if msg.text:
+        return state in text_states
+    return False
+
+
+def _pick_latest(
+    user_updates: list[Update], state: str | None, text_states: set[str], photo_states: set[str]
+) -> Update | None:
+    """
+    Последнее действие пользователя, которое стоит выполнить.
+
+    Сообщение или команда важнее кнопки: нажатие из-под старой клавиатуры
+    применилось бы к уже другому состоянию Form. Кнопка берётся, только если
+    после неё пользователь ничего не писал.
+    """
+    latest = next(
+        (u for u in reversed(user_updates) if _is_meaningful(u, state, text_states, photo_states)),
+        None,
+    )
+    if latest is not None:
+        return latest
+    last = user_updates[-1]
+    return last if last.callback_query else None
+
+
+async def _fetch_all(bot: Bot, allowed_updates: list[str], batch_size: int) -> list[Update]:
+    """Выбирает накопившиеся апдейты пачками; последний запрос подтверждает offset."""
+    updates: list[Update] = []
+    offset = None
+    while True:
+        batch = await bot.get_updates(offset=offset, limit=batch_size, timeout=0, allowed_updates=allowed_updates)
+        if not batch:
+            break
+        updates.extend(batch)
+        offset = batch[-1].update_id + 1
+        if len(batch) < batch_size:
+            # подтверждаем выбранное; пришедший за это время апдейт останется для polling
+            await bot.get_updates(offset=offset, limit=1, timeout=0, allowed_updates=allowed_updates)
+            break
+    return updates
+
+
+async def _answer_stale(bot: Bot, callbacks: list) -> None:
+    sem = asyncio.Semaphore(BACKLOG_ANSWER_CONCURRENCY)
+
+    async def answer(call) -> None:
+        async with sem:
+            try:
+                await bot.answer_callback_query(call.id)
+            except TelegramAPIError:
+                # query is too old — Telegram уже сам убрал «часики»
+                pass
+
+    await asyncio.gather(*(answer(c) for c in callbacks))
+
+
+async def drain_backlog(
+    bot: Bot,
+    dp: Dispatcher,
+    keep_users: set[int] = frozenset(),
+    text_states: set[str] = frozenset(),
+    photo_states: set[str] = frozenset(),
+    batch_size: int = BACKLOG_BATCH_SIZE
+) -> list[Update]:
+    """
+    Разбирает очередь апдейтов, накопившуюся за время простоя бота, до начала polling.
+
+    Апдейты группируются по пользователю, и от каждого остаётся только последнее
+    осмысленное действие: команда, текст в состоянии из text_states или фото
+    в состоянии из photo_states, а если сообщений после последнего нажатия кнопки
+    не было — это нажатие. Остальные отбрасываются, а отброшенные
+    нажатия кнопок гасятся одной пачкой answer_callback_query. Апдейты без
+    пользователя (посты в канале и т. п.) и от keep_users (админы) сохраняются все.
+
+    Возвращает апдейты, которые нужно обработать (см. process_backlog); offset
+    к этому моменту уже подтверждён, и polling их повторно не получит.
+    """
+    started = asyncio.get_running_loop().time()
+    updates = await _fetch_all(bot, dp.resolve_used_update_types(), batch_size)
+    if not updates:
+        return []
+
+    kept: list[Update] = []
+    by_user: OrderedDict[int, list[Update]] = OrderedDict()
+    for update in updates:
+        uid = _sender_id(update)
+        if uid is None or uid in keep_users:
+            kept.append(update)
+        else:
+            by_user.setdefault(uid, []).append(update)
+
+    stale_callbacks = []
+    for uid, user_updates in by_user.items():
+        chat_id = next(
+            (u.message.chat.id if u.message else u.callback_query.message.chat.id
+             for u in reversed(user_updates)
+             if u.message or (u.callback_query and u.callback_query.message)),
+            uid,
+        )
+        state = await dp.fsm.get_context(bot=bot, chat_id=chat_id, user_id=uid).get_state()
+        latest = _pick_latest(user_updates, state, text_states, photo_states)
+        if latest is not None:
+            kept.append(latest)
+        stale_callbacks.extend(
+            u.callback_query for u in user_updates if u.callback_query and u is not latest
+        )
+
+    kept.sort(key=lambda u: u.update_id)
+    await _answer_stale(bot, stale_callbacks)
+    logger.info(
+        "Очередь после перезапуска: %s апдейтов от %s пользователей, к обработке %s, "
+        "погашено кнопок %s, за %.1f с",
+        len(updates), len(by_user), len(kept), len(stale_callbacks),
+        asyncio.get_running_loop().time() - started,
+    )
+    return kept
+
+
+async def process_backlog(bot: Bot, dp: Dispatcher, updates: list[Update]) -> None:
+    """
+    Скармливает отобранные апдейты диспетчеру: по порядку для одного пользователя,
+    параллельно (не больше BACKLOG_FEED_CONCURRENCY) для разных.
+    """
+    sem = asyncio.Semaphore(BACKLOG_FEED_CONCURRENCY)
+    groups: OrderedDict[int | None, list[Update]] = OrderedDict()
+    for update in updates:
+        groups.setdefault(_sender_id(update), []).append(update)
+
+    async def feed(group: list[Update]) -> None:
+        replaying.set(True)
+        async with sem:
+            for update in group:
+                try:
+                    await dp.feed_update(bot, update)
+                except Exception as e:
+                    logger.error("Не удалось обработать апдейт %s из очереди: %s", update.update_id, e)
+
+    await asyncio.gather(*(feed(g) for g in groups.values()))
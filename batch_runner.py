@@ -0,0 +1,285 @@
+# batch_runner.py
+
+import asyncio
+import base64
+import io
+import json
+import mimetypes
+import os
+import time
+import uuid
+
+import openai
+import redis
+
+from config import API_KEYS, REDIS_URL, REF_FEMALE, REF_MALE, logger
+from degradation import tier_params
+from generation import build_prompt
+from name_render import NAME_RENDER, render_name_b64
+from tasks import deliver_result_task, save_result, submit_generation
+
+# Отложенная генерация через Batch API: задачи, которым не нужен ответ за минуту, копятся
+# в Redis, уходят в OpenAI одним файлом и возвращаются через обычную доставку
+# (deliver_result_task). Дешевле, и не съедает лимиты запросов интерактивных пользователей.
+GENERATION_BATCH = os.getenv("GENERATION_BATCH", "0") == "1"
+# больше задач в одном файле не кладём: в каждой строке два изображения в base64
+BATCH_MAX_JOBS = int(os.getenv("BATCH_MAX_JOBS", "50"))
+# дольше этого самая старая задача не ждёт, пока наберётся полный файл, с
+BATCH_MAX_WAIT = float(os.getenv("BATCH_MAX_WAIT", "600"))
+# как часто проверяем готовность отправленных пакетов, с
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "60"))
+# модель /v1/responses, которая вызывает инструмент image_generation
+BATCH_MODEL = os.getenv("BATCH_MODEL", "gpt-4.1-mini")
+BATCH_COMPLETION_WINDOW = "24h"
+
+# пакет завершён — дальше его статус не меняется
+_FINAL = {"completed", "failed", "expired", "cancelled"}
+
+
+def is_deferrable(user: dict, default_limit: int, replayed: bool = False) -> bool:
+    """
+    Можно ли отдать генерацию в Batch API: попытка сверх общего лимита (её выдал админ
+    через /generation, в том числе после /help) или фото из очереди, накопившейся,
+    пока бот не работал.
+    """
+    return GENERATION_BATCH and (replayed or user["photo_count"] > default_limit)
+
+
+def _data_url(path: str) -> str:
+    mime = mimetypes.guess_type(path)[0] or "image/jpeg"
+    with open(path, "rb") as f:
+        return f"data:{mime};base64,{base64.b64encode(f.read()).decode()}"
+
+
+def _image_result(body: dict) -> str | None:
+    """b64 картинки из ответа /v1/responses (элемент image_generation_call)."""
+    for item in body.get("output") or []:
+        if item.get("type") == "image_generation_call" and item.get("result"):
+            return item["result"]
+    return None
+
+
+class BatchRunner:
+    """
+    Копит отложенные задачи (список {prefix}:pending), отправляет их пакетами
+    и разбирает готовые пакеты ({prefix}:open: id пакета → задачи и индекс ключа).
+
+    Результаты сохраняются так же, как у generate_image_task, и уходят в deliver_result_task.
+    Строки с ошибкой и задачи из неудавшихся или просроченных пакетов возвращаются
+    в обычную очередь (submit_generation) — пользователь не остаётся без фигурки.
+    tick() вызывается из одного процесса (бот): отправку и разбор никто параллельно не делает.
+    """
+
+    def __init__(self, redis_client, max_jobs: int = BATCH_MAX_JOBS, max_wait: float = BATCH_MAX_WAIT,
+                 model: str = BATCH_MODEL, prefix: str = "batch"):
+        self.r = redis_client
+        self.max_jobs = max_jobs
+        self.max_wait = max_wait
+        self.model = model
+        self.prefix = prefix
+        # ключи OpenAI по кругу: пакет опрашивается тем же ключом, которым создан
+        self._next_key = 0
+
+    def defer(self, image_path: str, profession: str, gender: str, user_id: int,
+              name: str | None = None, tier: str | None = None) -> int:
+        """Откладывает генерацию до следующего пакета; возвращает, сколько задач ждёт отправки."""
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "queued_at": time.time(),
+            "image_path": image_path,
+            "profession": profession,
+            "gender": gender,
+            "user_id": user_id,
+            "name": name,
+            "tier": tier,
+        }
+        pending = self.r.rpush(f"{self.prefix}:pending", json.dumps(job, ensure_ascii=False))
+        logger.info("[%s] Задача %s отложена в Batch API, ждут отправки %s", user_id, job["job_id"], pending)
+        return pending
+
+    def _client(self, key_index: int) -> openai.OpenAI:
+        return openai.OpenAI(api_key=API_KEYS[key_index % len(API_KEYS)])
+
+    def _request(self, job: dict) -> dict:
+        ref_path = REF_MALE if job["gender"] == "male" else REF_FEMALE
+        prompt = build_prompt(job["profession"], job["name"] or "Пользователь")
+        return {
+            "custom_id": job["job_id"],
+            "method": "POST",
+            "url": "/v1/responses",
+            "body": {
+                "model": self.model,
+                "input": [{
+                    "role": "user",
+                    "content": [
+                        {"type": "input_text", "text": prompt},
+                        {"type": "input_image", "image_url": _data_url(job["image_path"])},
+                        {"type": "input_image", "image_url": _data_url(ref_path)},
+                    ],
+                }],
+                "tools": [{"type": "image_generation", **tier_params(job["tier"])}],
+                "tool_choice": {"type": "image_generation"},
+            },
+        }
+
+    def flush(self, force: bool = False) -> str | None:
+        """
+        Отправляет пакет, если набралось max_jobs задач или самая старая ждёт дольше max_wait
+        (force — в любом случае). Возвращает id пакета или None.
+        """
+        key = f"{self.prefix}:pending"
+        head = self.r.lindex(key, 0)
+        if head is None:
+            return None
+        if not force and self.r.llen(key) < self.max_jobs and time.time() - json.loads(head)["queued_at"] < self.max_wait:
+            return None
+
+        # задачи снимаются с pending только вместе с записью пакета в open (ниже):
+        # упади процесс между отправкой и записью — они уйдут повторно, но не пропадут
+        raw = self.r.lrange(key, 0, self.max_jobs - 1)
+        taken = len(raw)
+
+        lines = io.BytesIO()
+        ready = []
+        for item in raw:
+            job = json.loads(item)
+            try:
+                lines.write(json.dumps(self._request(job), ensure_ascii=False).encode() + b"\n")
+                ready.append(job)
+            except OSError as e:
+                # исходник пропал — генерировать не из чего; попытку вернёт on_failure обычной задачи.
+                # С pending снимаем сразу: иначе при неудачной отправке пакета следующий tick()
+                # снова отдал бы задачу в обычную очередь
+                logger.error("[%s] Задача %s не попала в пакет: %s", job["user_id"], job["job_id"], e)
+                self._fallback(job)
+                self.r.lrem(key, 1, item)
+                taken -= 1
+        if not ready:
+            return None
+
+        key_index = self._next_key
+        self._next_key += 1
+        client = self._client(key_index)
+        try:
+            uploaded = client.files.create(file=("generations.jsonl", lines.getvalue()), purpose="batch")
+            batch = client.batches.create(
+                input_file_id=uploaded.id,
+                endpoint="/v1/responses",
+                completion_window=BATCH_COMPLETION_WINDOW,
+            )
+        finally:
+            # при ошибке задачи остались в pending — попробуем на следующем tick()
+            client.close()
+
+        # defer() дописывает только в хвост, а отправляет один tick(): снимаем ровно взятое
+        pipe = self.r.pipeline(transaction=True)
+        pipe.hset(f"{self.prefix}:open", batch.id, json.dumps({
+            "key": key_index,
+            "created": time.time(),
+            "jobs": ready,
+        }, ensure_ascii=False))
+        pipe.ltrim(key, taken, -1)
+        pipe.hincrby(f"{self.prefix}:metrics", "batches", 1)
+        pipe.hincrby(f"{self.prefix}:metrics", "jobs", len(ready))
+        pipe.execute()
+        logger.info("Пакет %s: отправлено %s задач", batch.id, len(ready))
+        return batch.id
+
+    def poll(self) -> int:
+        """Разбирает завершённые пакеты; возвращает, сколько задач из них ушло дальше."""
+        handled = 0
+        for batch_id, raw in self.r.hgetall(f"{self.prefix}:open").items():
+            batch_id = batch_id.decode()
+            try:
+                handled += self._poll_batch(batch_id, json.loads(raw))
+            except Exception as e:
+                # пакет остаётся в open — разберём на следующем tick(); остальные пакеты и flush() не ждут
+                logger.warning("Пакет %s: не удалось получить результаты: %s", batch_id, e)
+        return handled
+
+    def _poll_batch(self, batch_id: str, record: dict) -> int:
+        client = self._client(record["key"])
+        try:
+            batch = client.batches.retrieve(batch_id)
+            if batch.status not in _FINAL:
+                return 0
+            results = {}
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    results.update(self._read_results(client, file_id))
+        finally:
+            client.close()
+        handled = self._fan_out(batch_id, batch.status, record["jobs"], results)
+        self.r.hdel(f"{self.prefix}:open", batch_id)
+        return handled
+
+    @staticmethod
+    def _read_results(client: openai.OpenAI, file_id: str) -> dict[str, str | None]:
+        """custom_id → b64 картинки (None — запрос завершился ошибкой)."""
+        results = {}
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get("response") or {}
+            ok = response.get("status_code") == 200
+            results[item["custom_id"]] = _image_result(response.get("body") or {}) if ok else None
+        return results
+
+    def _fan_out(self, batch_id: str, status: str, jobs: list[dict], results: dict[str, str | None]) -> int:
+        delivered = 0
+        for job in jobs:
+            b64 = results.get(job["job_id"])
+            if not b64:
+                self._fallback(job)
+                continue
+            # под тем же именем, что у generate_image_task, — доставка и её ретраи общие
+            result_path = os.path.join(os.path.dirname(job["image_path"]), f"{job['job_id']}_result.png")
+            try:
+                if NAME_RENDER:
+                    b64 = render_name_b64(b64, job["name"] or "Пользователь")
+                save_result(b64, result_path)
+            except OSError as e:
+                logger.error("[%s] Не удалось сохранить результат пакета: %s", job["user_id"], e)
+                self._fallback(job)
+                continue
+            deliver_result_task.delay(
+                job_id=job["job_id"], result_path=result_path, user_id=job["user_id"], tier=job["tier"]
+            )
+            delivered += 1
+        self.r.hincrby(f"{self.prefix}:metrics", "ok", delivered)
+        logger.info("Пакет %s (%s): %s из %s результатов отправлено пользователям",
+                    batch_id, status, delivered, len(jobs))
+        return len(jobs)
+
+    def _fallback(self, job: dict) -> None:
+        """Задача, которую пакет не выполнил, — в обычную очередь генерации."""
+        self.r.hincrby(f"{self.prefix}:metrics", "fallback", 1)
+        logger.warning("[%s] Задача %s не выполнена пакетом — в обычную очередь", job["user_id"], job["job_id"])
+        submit_generation(
+            job["image_path"], job["profession"], job["gender"], job["user_id"], job["tier"], name=job["name"]
+        )
+
+    def tick(self) -> None:
+        self.poll()
+        self.flush()
+
+    def pending(self) -> int:
+        return self.r.llen(f"{self.prefix}:pending")
+
+    def metrics(self) -> dict:
+        """Счётчики: batches, jobs (отправлено), ok (доставлено), fallback (ушло в обычную очередь)."""
+        return {k.decode(): int(v) for k, v in self.r.hgetall(f"{self.prefix}:metrics").items()}
+
+
+runner = BatchRunner(redis.Redis.from_url(REDIS_URL))
+
+
+async def run_forever(batch_runner: BatchRunner = runner, interval: float = BATCH_POLL_INTERVAL) -> None:
+    """Фоновая задача бота: раз в interval секунд отправляет накопленное и разбирает готовые пакеты."""
+    while True:
+        try:
+            await asyncio.to_thread(batch_runner.tick)
+        except Exception as e:
+            logger.warning("Batch API: %s", e)
+        await asyncio.sleep(interval)
@@ -0,0 +1,111 @@
+import base64
+import random
+
+import pytest
+
+from loadtest.assets import png_bytes
+
+SAMPLE_TEXTS = [
+    "Программист",
+    "  врач-терапевт!!! ",
+    "менеджер по продажам",
+    "водитель такси",
+    "Бухгалтер",
+]
+
+
+# ---------- bot.py: нормализация и поиск профессии ----------
+
+def bench_normalize(benchmark):
+    import bot
+
+    benchmark(lambda: [bot.normalize(t) for t in SAMPLE_TEXTS])
+
+
+def bench_match_profession(benchmark):
+    import bot
+
+    benchmark(lambda: [bot.match_profession(t) for t in SAMPLE_TEXTS])
+
+
+# ---------- каталог профессий ----------
+
+def bench_load_professions(benchmark):
+    import bot
+    from config import ACCESSORIES_FILE
+
+    benchmark.pedantic(bot.load_professions, args=(ACCESSORIES_FILE,), rounds=5, iterations=1)
+
+
+def bench_load_accessories_map(benchmark):
+    import generation
+    from config import ACCESSORIES_FILE
+
+    benchmark.pedantic(generation.load_accessories_map, args=(ACCESSORIES_FILE,), rounds=5, iterations=1)
+
+
+# ---------- generation.py / tasks.py: промпт и сохранение результата ----------
+
+def bench_build_prompt(benchmark):
+    import bot
+    import generation
+
+    rng = random.Random(1)
+    benchmark(lambda: generation.build_prompt(rng.choice(bot.professions), "Анастасия"))
+
+
+@pytest.fixture(scope="module")
+def result_b64() -> str:
+    # несжимаемый PNG 1024×1024 — по объёму как настоящий ответ images.edit
+    return base64.b64encode(png_bytes(1024, noise=True)).decode()
+
+
+def bench_save_result(benchmark, result_b64, tmp_path):
+    import tasks
+
+    path = str(tmp_path / "result.png")
+    benchmark(tasks.save_result, result_b64, path)
+
+
+# ---------- users.db ----------
+
+def bench_get_user(benchmark, bot_db, event_loop_runner):
+    rng = random.Random(2)
+    benchmark(lambda: event_loop_runner(bot_db.get_user(100_000_000 + rng.randrange(1000))))
+
+
+def bench_upsert_user_update(benchmark, bot_db, event_loop_runner):
+    rng = random.Random(3)
+    benchmark(lambda: event_loop_runner(
+        bot_db.upsert_user(100_000_000 + rng.randrange(1000), name="Бенчмарк")
+    ))
+
+
+def bench_upsert_user_insert(benchmark, bot_db, event_loop_runner):
+    ids = iter(range(900_000_000, 999_999_999))
+    benchmark(lambda: event_loop_runner(bot_db.upsert_user(next(ids))))
+
+
+def bench_fetch_user_stats(benchmark, bot_db, event_loop_runner):
+    benchmark.pedantic(lambda: event_loop_runner(bot_db.fetch_user_stats()), rounds=10, iterations=1)
+
+
+def bench_init_db(benchmark, bot_db, event_loop_runner):
+    # повторный старт на уже мигрированной БД: не должен зависеть от числа пользователей
+    benchmark(lambda: event_loop_runner(bot_db.init_db()))
+
+
+def bench_reserve_generation(benchmark, bot_db, event_loop_runner):
+    rng = random.Random(4)
+    benchmark(lambda: event_loop_runner(
+        bot_db.storage.reserve_generation(100_000_000 + rng.randrange(1000), 2)
+    ))
+
+
+def bench_reserve_generation_zero_limit(benchmark, bot_db, event_loop_runner):
+    # общий лимит 0 (/generation all 0): новому пользователю попытка не резервируется
+    ids = iter(range(800_000_000, 899_999_999))
+    uid = next(ids)
+    assert event_loop_runner(bot_db.storage.reserve_generation(uid, 0)) is None
+    assert event_loop_runner(bot_db.storage.get_user(uid)) is None
+    benchmark(lambda: event_loop_runner(bot_db.storage.reserve_generation(next(ids), 0)))
@@ -0,0 +1,91 @@
+"""
+Микробенчмарки горячих путей бота (pytest-benchmark).
+
+Запуск из корня репозитория, в окружении бота (нужен config):
+
+  pip install -r benchmarks/requirements.txt
+  # сохранить эталон на референсной машине
+  pytest benchmarks --benchmark-save=baseline
+  # сравнить с эталоном и упасть, если среднее выросло больше порога
+  pytest benchmarks --benchmark-compare --benchmark-compare-fail=mean:15%
+
+Результаты и эталоны лежат в benchmarks/.results. Размер синтетической
+users.db задаётся BENCH_USERS (по умолчанию 200 000 строк).
+"""
+
+import asyncio
+import os
+import random
+import sqlite3
+
+import pytest
+
+BENCH_USERS = int(os.getenv("BENCH_USERS", "200000"))
+
+
+@pytest.fixture(scope="session", autouse=True)
+def bot_setup():
+    """Бот, хранилище и каталог профессий bot.py создаёт в setup(), как при запуске."""
+    import bot
+
+    bot.setup()
+
+
+@pytest.fixture(scope="session")
+def event_loop_runner():
+    """Один event loop на сессию: в замер не попадает создание цикла."""
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def users_db(tmp_path_factory, event_loop_runner) -> str:
+    """users.db со схемой бота и BENCH_USERS синтетическими пользователями."""
+    import bot
+    from storage import SQLiteStorage
+
+    path = str(tmp_path_factory.mktemp("bench") / "users.db")
+    original = bot.storage
+    bot.storage = SQLiteStorage(path)
+    try:
+        event_loop_runner(bot.init_db())
+    finally:
+        bot.storage = original
+
+    rng = random.Random(42)
+    genders = ["male", "female", ""]
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "INSERT INTO users (user_id, name, profession, gender, photo_count, created_at, updated_at, allowed_generations) "
+        "VALUES (?, ?, ?, ?, ?, datetime('now', ?), datetime('now', ?), 2);",
+        (
+            (
+                100_000_000 + i,
+                f"Имя{i}",
+                rng.choice(bot.professions),
+                rng.choice(genders),
+                rng.randint(0, 2),
+                f"-{rng.randint(0, 30)} days",
+                f"-{rng.randint(0, 30)} days",
+            )
+            for i in range(BENCH_USERS)
+        ),
+    )
+    conn.executemany(
+        "INSERT OR IGNORE INTO subscriptions (user_id) VALUES (?);",
+        ((100_000_000 + i,) for i in range(0, BENCH_USERS, 2)),
+    )
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def bot_db(users_db, monkeypatch):
+    """bot.py, направленный на синтетическую БД."""
+    import bot
+    from storage import SQLiteStorage
+
+    monkeypatch.setattr(bot, "storage", SQLiteStorage(users_db))
+    return bot
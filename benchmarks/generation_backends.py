@@ -0,0 +1,78 @@
+"""
+Одна и та же нагрузка на каждом бэкенде генерации (generation.py) против заглушек loadtest.
+
+  python -m benchmarks.generation_backends --users 40 --rate 2 --latency 5
+  python -m benchmarks.generation_backends --backends inprocess celery --users 200 --rate 0 --rpm-per-key 30
+
+Каждый бэкенд — отдельный прогон python -m loadtest (режимы loadtest generator, celery, sync — см. MODES)
+с одинаковыми пользователями, задержкой OpenAI и числом воркеров; итог — таблица
+пропускной способности и времени до фигурки. sync выполняет задачи по одной —
+его строка показывает цену конвейера без параллельности, на больших --users он долгий.
+Celery берёт брокер из REDIS_URL — направьте его на отдельный Redis.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# бэкенд generation.py → режим loadtest
+MODES = {"inprocess": "generator", "celery": "celery", "sync": "sync"}
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(prog="python -m benchmarks.generation_backends", description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--backends", nargs="+", choices=list(MODES), default=list(MODES))
+    p.add_argument("--users", type=int, default=40)
+    p.add_argument("--rate", type=float, default=2.0)
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--latency", type=float, default=5.0)
+    p.add_argument("--rpm-per-key", type=int, default=0)
+    return p.parse_args(argv)
+
+
+def run_backend(name: str, args: argparse.Namespace) -> dict:
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as tmp:
+        report = tmp.name
+    cmd = [
+        sys.executable, "-m", "loadtest",
+        "--mode", MODES[name],
+        "--users", str(args.users),
+        "--rate", str(args.rate),
+        "--workers", str(args.workers),
+        "--latency", str(args.latency),
+        "--rpm-per-key", str(args.rpm_per_key),
+        "--json", report,
+    ]
+    try:
+        subprocess.run(cmd, cwd=ROOT, check=True)
+        with open(report, encoding="utf-8") as f:
+            return json.load(f)
+    finally:
+        os.remove(report)
+
+
+def row(name: str, summary: dict) -> str:
+    ttf = summary["time_to_figure_s"]
+    return (
+        f"{name:<10} {summary['delivered']:>4}/{summary['users']:<4} {summary['figures_per_min']:>9.1f} фиг/мин  "
+        f"p50 {ttf['p50'] or 0:>7.1f} с  p95 {ttf['p95'] or 0:>7.1f} с  ошибок {summary['error_rate']:.1%}"
+    )
+
+
+def main() -> None:
+    args = parse_args()
+    results = {name: run_backend(name, args) for name in args.backends}
+    print(f"{args.users} пользователей, {args.rate}/с, {args.workers} воркеров, задержка OpenAI {args.latency} с")
+    for name, summary in results.items():
+        print(row(name, summary))
+
+
+if __name__ == "__main__":
+    main()
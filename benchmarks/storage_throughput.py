@@ -0,0 +1,157 @@
+"""
+Пропускная способность хранилища (storage.py) под одновременной нагрузкой бота и воркеров.
+
+  python -m benchmarks.storage_throughput --backend sqlite
+  python -m benchmarks.storage_throughput --backend postgres --dsn postgresql://bot@localhost:5432/bot_bench
+
+Бот — один процесс с --bot-tasks корутинами: ответы анкеты (upsert_user),
+резервирование генерации, чтение профиля. Воркеры — --workers процессов
+(как prefork у Celery), каждый через BlockingStorage читает профиль и пишет
+last_photo_id, иногда возвращает попытку. Таблицы назначения очищаются —
+не направляйте на боевую БД.
+"""
+
+import argparse
+import asyncio
+import multiprocessing as mp
+import os
+import random
+import tempfile
+import time
+
+from storage import PostgresStorage, SQLiteStorage
+
+USERS = 10_000
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(prog="python -m benchmarks.storage_throughput", description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--backend", choices=["sqlite", "postgres"], default="sqlite")
+    p.add_argument("--dsn", default="postgresql://bot@localhost:5432/bot_bench")
+    p.add_argument("--sqlite", default=os.path.join(tempfile.gettempdir(), "storage_bench.db"))
+    p.add_argument("--bot-tasks", type=int, default=50)
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--duration", type=float, default=10.0)
+    return p.parse_args(argv)
+
+
+def make(args: argparse.Namespace):
+    if args.backend == "postgres":
+        return PostgresStorage(args.dsn)
+    return SQLiteStorage(args.sqlite)
+
+
+async def prepare(args: argparse.Namespace) -> None:
+    if args.backend == "sqlite" and os.path.exists(args.sqlite):
+        os.remove(args.sqlite)
+    store = make(args)
+    await store.open()
+    await store.migrate()
+    if args.backend == "postgres":
+        async with store.pool.acquire() as conn:
+            await conn.execute("TRUNCATE users, subscriptions, admins, settings")
+    # лимит не мешает: каждое резервирование — запись
+    await store.set_setting("default_allowed_generations", str(10 ** 9))
+    for uid in range(USERS):
+        await store.upsert_user(uid)
+    await store.close()
+
+
+def _percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(p / 100 * len(ordered)), len(ordered) - 1)] if ordered else 0.0
+
+
+class Tally:
+    def __init__(self):
+        self.ops = 0
+        self.errors = 0
+        self.latencies: list[float] = []
+
+    def timed(self, started: float) -> None:
+        self.ops += 1
+        self.latencies.append(time.perf_counter() - started)
+
+
+async def bot_load(args: argparse.Namespace) -> Tally:
+    store = make(args)
+    await store.open()
+    tally = Tally()
+    deadline = time.monotonic() + args.duration
+
+    async def user_flow(seed: int):
+        rng = random.Random(seed)
+        while time.monotonic() < deadline:
+            uid = rng.randrange(USERS)
+            started = time.perf_counter()
+            try:
+                step = rng.random()
+                if step < 0.4:
+                    await store.upsert_user(uid, name=f"Имя{uid}")
+                elif step < 0.7:
+                    await store.reserve_generation(uid, 10 ** 9)
+                else:
+                    await store.get_user(uid)
+                tally.timed(started)
+            except Exception:
+                tally.errors += 1
+
+    await asyncio.gather(*(user_flow(i) for i in range(args.bot_tasks)))
+    await store.close()
+    return tally
+
+
+def worker_load(args: argparse.Namespace, seed: int, out: mp.Queue) -> None:
+    from storage import BlockingStorage
+
+    store = BlockingStorage(lambda: make(args))
+    rng = random.Random(seed)
+    tally = Tally()
+    deadline = time.monotonic() + args.duration
+    while time.monotonic() < deadline:
+        uid = rng.randrange(USERS)
+        started = time.perf_counter()
+        try:
+            store.get_user(uid)
+            store.set_last_photo_ids({uid: rng.randrange(10 ** 6)})
+            if rng.random() < 0.05:
+                store.release_generation(uid)
+            tally.timed(started)
+        except Exception:
+            tally.errors += 1
+    out.put((tally.ops, tally.errors, tally.latencies))
+
+
+def report(name: str, tally: Tally, duration: float) -> str:
+    return (
+        f"{name:<8} {tally.ops / duration:>9.0f} оп/с  ошибок {tally.errors:>5}  "
+        f"p50 {_percentile(tally.latencies, 50) * 1000:>7.1f} мс  p99 {_percentile(tally.latencies, 99) * 1000:>7.1f} мс"
+    )
+
+
+def main() -> None:
+    args = parse_args()
+    asyncio.run(prepare(args))
+
+    out: mp.Queue = mp.Queue()
+    workers = [mp.Process(target=worker_load, args=(args, 1000 + i, out)) for i in range(args.workers)]
+    for w in workers:
+        w.start()
+    bot = asyncio.run(bot_load(args))
+    worker = Tally()
+    for _ in workers:
+        ops, errors, latencies = out.get()
+        worker.ops += ops
+        worker.errors += errors
+        worker.latencies += latencies
+    for w in workers:
+        w.join()
+
+    print(f"{args.backend}: {args.bot_tasks} корутин бота, {args.workers} процессов-воркеров, {args.duration:.0f} с")
+    print(report("бот", bot, args.duration))
+    print(report("воркеры", worker, args.duration))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,15 @@
+import os
 import re
 import random
 import asyncio
 from pathlib import Path
 import tempfile
 from difflib import SequenceMatcher
-from tasks import generate_image_task
+from tasks import hedge_metrics, tier_metrics
 from config import ACCESSORIES_FILE, STOP_NAME_WORDS
 
 import pandas as pd
-import aiosqlite
+import redis.asyncio as aioredis
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command, CommandStart
 from aiogram.filters.state import StateFilter
@@ -18,35 +19,98 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFil
 from aiogram.enums.chat_action import ChatAction
 from aiogram.utils.chat_action import ChatActionSender
 from aiogram.exceptions import TelegramNetworkError
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from config import (
     API_TOKEN, BASE_DIR, WAIT_VIDEO_PATH, SUB_CHANNEL_USERNAME,
-    ADMIN_CHANNEL_USERNAME, ADMIN_IDS, DB_PATH, API_KEYS, MAX_CONCURRENT_TASKS, logger
+    ADMIN_CHANNEL_USERNAME, ADMIN_IDS, DB_PATH, API_KEYS, REDIS_URL, logger
 )
 from api import ImageGenerator
-from typing import Set, Tuple
+from job_queue import MemoryJobQueue, SQLiteJobQueue
+from quota import default_limit, release_generation, reserve_generation, set_default_limit
+from storage import EXPORT_FIELDS, PostgresStorage, SQLiteStorage, make_storage
+from result_index import LastResultIndex
+from profile_writer import ProfileWriter
+from log_setup import setup_logging, log_context
+from backlog import drain_backlog, process_backlog, replaying
+import batch_runner
+import photo_quality
+import name_render
 from celery_app import celery_app
-import sqlite3
-
-processed_media_groups: Set[Tuple[int, str]] = set()
+from telegram_client import AsyncTelegramLimiter, RateLimitMiddleware
+from generation import GENERATION_BACKEND, GenerationBackend, GenerationRequest, make_backend
 
 # --------------------
 # Инициализация бота
 # --------------------
-bot = Bot(token=API_TOKEN)
+# TELEGRAM_API_URL — адрес альтернативного Bot API (локальный сервер, заглушка для нагрузочных тестов)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+# Общий с Celery-воркерами каталог для исходных фото
+SHARED_TMP_DIR = os.getenv("SHARED_TMP_DIR", "/shared_tmp")
+
 dp = Dispatcher()
+# очередь задач генерации: sqlite переживает перезапуск, memory — для отладки
+GENERATOR_QUEUE = os.getenv("GENERATOR_QUEUE", "sqlite")
+
+# Бот, хранилище, генератор и каталог профессий создаёт setup() при запуске, а не импорт модуля:
+# пулы процессов (process_pool.py) стартуют через spawn и заново импортируют bot.py в каждом
+# дочернем процессе — там не нужны ни соединения, ни фоновые задачи
+bot: Bot
+tg_redis: aioredis.Redis
+storage: SQLiteStorage | PostgresStorage
+last_results: LastResultIndex
+profiles: ProfileWriter
+generator: ImageGenerator
+generation: GenerationBackend
+
+
+def setup() -> None:
+    global bot, tg_redis, storage, last_results, profiles, generator, generation, professions, _orig_send_photo
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+    bot = Bot(token=API_TOKEN, session=session)
+    # Все исходящие сообщения (хендлеры, видео-заглушка, ImageGenerator) — под общим
+    # с Celery-воркерами лимитом Bot API в Redis; 429 повторяются после retry_after
+    tg_redis = aioredis.Redis.from_url(REDIS_URL)
+    bot.session.middleware(RateLimitMiddleware(AsyncTelegramLimiter(tg_redis)))
+
+    # users, подписки, админы и настройки: SQLite или PostgreSQL (STORAGE_BACKEND, storage.py)
+    storage = make_storage()
+
+    # Последний результат каждого пользователя: LRU в памяти + пакетная запись в users.last_photo_id
+    last_results = LastResultIndex(storage)
+
+    # Проксируем только send_photo, чтобы сохранять последнее фото
+    _orig_send_photo = bot.send_photo
+    bot.send_photo = _send_photo_recorder  # type: ignore
+
+    # Анкета во время Form — в данных FSM; в users она попадает пачками (воронка /stats)
+    # и вместе с резервированием попытки в process_photo
+    profiles = ProfileWriter(storage)
+
+    # Инициализация генератора изображений
+    generator = ImageGenerator(
+        API_KEYS, bot,
+        queue=SQLiteJobQueue(DB_PATH) if GENERATOR_QUEUE == "sqlite" else MemoryJobQueue(),
+        storage=storage,
+    )
+    # где исполняются генерации (generation.py): воркеры запускает только выбранный бэкенд —
+    # при celery ImageGenerator не держит простаивающих воркеров
+    generation = make_backend(GENERATION_BACKEND, generator)
+    if batch_runner.GENERATION_BATCH and generation.name != "celery":
+        # результаты пакетов доставляет deliver_result_task, а запасной путь — справедливая очередь Celery
+        raise ValueError(f"GENERATION_BATCH=1 работает только с GENERATION_BACKEND=celery, а не {generation.name}")
+
+    professions = load_professions(ACCESSORIES_FILE)
 
-best_file_id: dict[int, int] = {}
 
-# Проксируем только send_photo, чтобы сохранять последнее фото
-_orig_send_photo = bot.send_photo
 async def _send_photo_recorder(chat_id: int, *args, **kwargs):
     msg = await _orig_send_photo(chat_id=chat_id, *args, **kwargs)
-    best_file_id[chat_id] = msg.message_id
+    last_results.record(chat_id, msg.message_id)
     return msg
-bot.send_photo = _send_photo_recorder  # type: ignore
 
-# Инициализация генератора изображений
-generator = ImageGenerator(API_KEYS, bot)
+
+# фоновый опрос Batch API; запускается в on_startup
+batch_loop: asyncio.Task | None = None
 
 # --------------------
 # Состояния
@@ -72,112 +136,54 @@ disable_web_page_preview=True
 # Загрузка профессий
 # --------------------
 
-df = pd.read_excel(ACCESSORIES_FILE)
-df.columns = df.columns.str.strip()                         # убираем лишние пробелы в названиях столбцов
-df["ПРОФЕССИЯ"] = df["ПРОФЕССИЯ"] \
-    .astype(str) \
-    .str.replace("/", ",", regex=False)                     # приводим слэши к запятым
-df = df.assign(
-    ПРОФЕССИЯ=df["ПРОФЕССИЯ"].str.split(",")               # разбиваем по запятой
-).explode("ПРОФЕССИЯ")                                      # «взрываем» строки
-df["ПРОФЕССИЯ"] = df["ПРОФЕССИЯ"].str.strip()               # обрезаем пробелы по краям
-
-raw_professions = df["ПРОФЕССИЯ"].dropna().astype(str).tolist()
-professions = [ normalize(p) for p in raw_professions ]
+def load_professions(path: str) -> list[str]:
+    df = pd.read_excel(path)
+    df.columns = df.columns.str.strip()                         # убираем лишние пробелы в названиях столбцов
+    df["ПРОФЕССИЯ"] = df["ПРОФЕССИЯ"] \
+        .astype(str) \
+        .str.replace("/", ",", regex=False)                     # приводим слэши к запятым
+    df = df.assign(
+        ПРОФЕССИЯ=df["ПРОФЕССИЯ"].str.split(",")               # разбиваем по запятой
+    ).explode("ПРОФЕССИЯ")                                      # «взрываем» строки
+    df["ПРОФЕССИЯ"] = df["ПРОФЕССИЯ"].str.strip()               # обрезаем пробелы по краям
+
+    raw_professions = df["ПРОФЕССИЯ"].dropna().astype(str).tolist()
+    return [ normalize(p) for p in raw_professions ]
+
+# каталог профессий; загружает setup()
+professions: list[str] = []
+
+def match_profession(text: str) -> tuple[str | None, float]:
+    """Ближайшая профессия из каталога и степень похожести (0..1)."""
+    text, best, score = normalize(text), None, 0.0
+    for p in professions:
+        s = SequenceMatcher(None, text, p).ratio()
+        if s > score:
+            best, score = p, s
+    return best, score
 
 # --------------------
 # База данных
 # --------------------
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        # 1) админы
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS admins (
-                user_id INTEGER PRIMARY KEY
-            );
-        """)
-        for aid in ADMIN_IDS:
-            await db.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?);", (aid,))
-
-        # 2) пользователи
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id             INTEGER PRIMARY KEY,
-                name                TEXT,
-                profession          TEXT,
-                gender              TEXT,
-                photo_count         INTEGER DEFAULT 0
-            );
-        """)
-
-        # 3) подписи подписок
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                user_id       INTEGER PRIMARY KEY,
-                subscribed_at TEXT    DEFAULT (datetime('now'))
-            );
-        """)
-
-        # 4) Миграция: добавляем недостающие колонки
-        cursor = await db.execute("PRAGMA table_info(users);")
-        cols = [row[1] for row in await cursor.fetchall()]
-
-        if "created_at" not in cols:
-            await db.execute(
-                "ALTER TABLE users ADD COLUMN created_at TEXT DEFAULT (datetime('now'));"
-            )
-        if "updated_at" not in cols:
-            await db.execute(
-                "ALTER TABLE users ADD COLUMN updated_at TEXT DEFAULT (datetime('now'));"
-            )
-        if "allowed_generations" not in cols:
-            await db.execute(
-                "ALTER TABLE users ADD COLUMN allowed_generations INTEGER DEFAULT 2;"
-            )
-
-        # 5) Инициализируем старые записи, у которых NULL
-        await db.execute(
-            "UPDATE users SET created_at = datetime('now') WHERE created_at IS NULL;"
-        )
-        await db.execute(
-            "UPDATE users SET updated_at = datetime('now') WHERE updated_at IS NULL;"
-        )
-        await db.execute(
-            "UPDATE users SET allowed_generations = 2 WHERE allowed_generations IS NULL;"
-        )
-
-        await db.commit()
+    await storage.open()
+    await storage.migrate()
+    # список админов берётся из конфига — его правят без миграций
+    await storage.add_admins(ADMIN_IDS)
     # лог
     logger.info("DB initialized and migrated")
 
 
 async def is_admin(user_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT 1 FROM admins WHERE user_id = ?", (user_id,))
-        return await cur.fetchone() is not None
+    return await storage.is_admin(user_id)
 
 # ————————————— get_user —————————————
 async def get_user(uid: int) -> dict | None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT user_id, name, profession, gender, photo_count,
-                   created_at, updated_at, allowed_generations
-              FROM users
-             WHERE user_id = ?;
-        """, (uid,))
-        row = await cur.fetchone()
-        if not row:
-            return None
-        return {
-            "user_id": row[0],
-            "name": row[1],
-            "profession": row[2],
-            "gender": row[3],
-            "photo_count": row[4],
-            "created_at": row[5],
-            "updated_at": row[6],
-            "allowed_generations": row[7]
-        }
+    """Профиль; allowed_generations — действующий лимит (личный или общий)."""
+    user = await storage.get_user(uid)
+    if user is not None and user["allowed_generations"] is None:
+        user["allowed_generations"] = await default_limit(storage)
+    return user
 
 async def upsert_user(
     uid: int,
@@ -191,65 +197,15 @@ async def upsert_user(
 ):
     """
     - При name/profession/gender/inc_photo обновляем updated_at.
-    - При set_allowed меняем allowed_generations на конкретное значение.
-    - При dec_allowed -- уменьшаем allowed_generations на 1.
+    - При set_allowed задаём личный лимит allowed_generations.
+    - При dec_allowed -- уменьшаем действующий лимит на 1 (становится личным).
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT 1 FROM users WHERE user_id = ?;", (uid,))
-        exists = await cur.fetchone() is not None
-
-        if not exists:
-            # вставка новой строки
-            await db.execute("""
-                INSERT INTO users (
-                    user_id, name, profession, gender, photo_count,
-                    created_at, updated_at, allowed_generations
-                ) VALUES (
-                    ?, ?, ?, ?, ?,
-                    datetime('now'), datetime('now'), ?
-                );
-            """, (
-                uid,
-                name or "",
-                profession or "",
-                gender or "",
-                1 if inc_photo else 0,
-                set_allowed if set_allowed is not None else 2
-            ))
-        else:
-            # обновляем поля, если переданы
-            if name is not None:
-                await db.execute(
-                    "UPDATE users SET name = ?, updated_at = datetime('now') WHERE user_id = ?;",
-                    (name, uid)
-                )
-            if profession is not None:
-                await db.execute(
-                    "UPDATE users SET profession = ?, updated_at = datetime('now') WHERE user_id = ?;",
-                    (profession, uid)
-                )
-            if gender is not None:
-                await db.execute(
-                    "UPDATE users SET gender = ?, updated_at = datetime('now') WHERE user_id = ?;",
-                    (gender, uid)
-                )
-            if inc_photo:
-                await db.execute(
-                    "UPDATE users SET photo_count = photo_count + 1, updated_at = datetime('now') WHERE user_id = ?;",
-                    (uid,)
-                )
-            if set_allowed is not None:
-                await db.execute(
-                    "UPDATE users SET allowed_generations = ?, updated_at = datetime('now') WHERE user_id = ?;",
-                    (set_allowed, uid)
-                )
-            if dec_allowed:
-                await db.execute(
-                    "UPDATE users SET allowed_generations = allowed_generations - 1, updated_at = datetime('now') WHERE user_id = ?;",
-                    (uid,)
-                )
-
-        await db.commit()
+    await storage.upsert_user(
+        uid, name=name, profession=profession, gender=gender, inc_photo=inc_photo,
+        set_allowed=set_allowed, dec_allowed=dec_allowed,
+        default_limit=await default_limit(storage) if dec_allowed else None,
+    )
+
 # --------------------
 # Клавиатуры
 # --------------------
@@ -276,22 +232,59 @@ def result_keyboard() -> InlineKeyboardMarkup:
         InlineKeyboardButton(text="Другую фигурку", callback_data="another")
     ]])
 
+# --------------------
+# Контекст логов: user_id во всех записях, сделанных при обработке апдейта
+# --------------------
+@dp.update.outer_middleware()
+async def log_context_middleware(handler, event, data):
+    user = data.get("event_from_user")
+    with log_context(user_id=user.id if user else None):
+        return await handler(event, data)
+
 # --------------------
 # Хэндлеры
 # --------------------
 @dp.startup()
 async def on_startup():
-    global ADMIN_CHAT_ID
+    global ADMIN_CHAT_ID, batch_loop
     await init_db()
     chat = await bot.get_chat(ADMIN_CHANNEL_USERNAME)
     ADMIN_CHAT_ID = chat.id
-    for _ in range(MAX_CONCURRENT_TASKS):
-        asyncio.create_task(generator.worker())
-    logger.info("Бот запущен, воркеры генератора изображений активированы")
+    await generation.start()
+    last_results.start()
+    profiles.start()
+    # апдейты, накопившиеся за время простоя: от каждого пользователя только последнее действие
+    backlog = await drain_backlog(
+        bot, dp,
+        keep_users=set(ADMIN_IDS),
+        text_states={Form.ask_name.state, Form.ask_profession.state},
+        photo_states={Form.ask_photo.state},
+    )
+    if backlog:
+        # до начала polling: иначе живой апдейт пользователя обгонит его апдейт из очереди
+        await process_backlog(bot, dp, backlog)
+    if batch_runner.GENERATION_BATCH:
+        # отложенные генерации — пакетами через Batch API (batch_runner.py)
+        batch_loop = asyncio.create_task(batch_runner.run_forever())
+    logger.info("Бот запущен, генерации исполняет бэкенд %s", generation.name)
+
+@dp.shutdown()
+async def on_shutdown():
+    if batch_loop is not None:
+        batch_loop.cancel()
+    # незавершённые генерации возвращаются в очередь и продолжатся после перезапуска
+    await generation.shutdown()
+    photo_quality.shutdown()
+    name_render.shutdown()
+    # дописываем в БД накопленные last_photo_id и ответы анкеты
+    await last_results.close()
+    await profiles.close()
+    await storage.close()
+    await tg_redis.aclose()
 
 @dp.message(CommandStart())
 async def cmd_start(msg: types.Message, state: FSMContext):
-    logger.info(f"Пользователь {msg.from_user.id} нажал /start — проверяем подписку")
+    logger.info("Пользователь %s нажал /start — проверяем подписку", msg.from_user.id)
     try:
         member = await bot.get_chat_member(SUB_CHANNEL_USERNAME, msg.from_user.id)
         if member.status in ("creator", "administrator", "member"):
@@ -309,7 +302,7 @@ async def cmd_start(msg: types.Message, state: FSMContext):
         )
         await state.set_state(Form.check_sub)
     except Exception as e:
-        logger.error(f"Не удалось проверить подписку для {msg.from_user.id}: {e}")
+        logger.error("Не удалось проверить подписку для %s: %s", msg.from_user.id, e)
         # на всякий случай тоже предлагаем подписаться
         await msg.answer(
             "Что-то пошло не так при проверке подписки, попробуйте ещё раз или подпишитесь вручную:",
@@ -317,7 +310,7 @@ async def cmd_start(msg: types.Message, state: FSMContext):
         )
         await state.set_state(Form.check_sub)
 
-    await upsert_user(msg.from_user.id)
+    profiles.record(msg.from_user.id)
 
 @dp.callback_query(StateFilter(Form.check_sub), F.data == "check_sub")
 async def on_check_sub(call: types.CallbackQuery, state: FSMContext):
@@ -329,12 +322,7 @@ async def on_check_sub(call: types.CallbackQuery, state: FSMContext):
 
     if is_sub:
         # 1) Записываем в subscriptions (если ещё не записано)
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "INSERT OR IGNORE INTO subscriptions (user_id) VALUES (?);",
-                (call.from_user.id,)
-            )
-            await db.commit()
+        await storage.add_subscription(call.from_user.id)
 
         # 2) Переходим дальше по сценарию
         await call.message.edit_text(
@@ -362,49 +350,49 @@ async def process_name(msg: types.Message, state: FSMContext):
         return
 
     # 3) Иначе сохраняем и переходим к следующему шагу
-    await upsert_user(msg.from_user.id, name=name)
+    await state.update_data(name=name)
+    profiles.record(msg.from_user.id, name=name)
     await msg.answer(
         "Кем вы работаете? Напишите свою профессию, а мы поищем её в списке 🎯"
     )
     await state.set_state(Form.ask_profession)
-    logger.info(f"Пользователь {msg.from_user.id} ввел имя: {name}")
+    logger.info("Пользователь %s ввел имя: %s", msg.from_user.id, name)
 
 @dp.message(StateFilter(Form.ask_profession))
 async def process_profession(msg: types.Message, state: FSMContext):
-    text, best, score = normalize(msg.text), None, 0.0
-    for p in professions:
-        s = SequenceMatcher(None, text, p).ratio()
-        if s > score:
-            best, score = p, s
+    best, score = match_profession(msg.text)
     if score >= 0.75:
-        await upsert_user(msg.from_user.id, profession=best)
+        await state.update_data(profession=best)
+        profiles.record(msg.from_user.id, profession=best)
         await msg.answer(
             "Выберите, для кого создаем результат", reply_markup=gender_keyboard()
         )
         await state.set_state(Form.choose_gender)
-        logger.info(f"Пользователь {msg.from_user.id} выбрал профессию: {best}")
+        logger.info("Пользователь %s выбрал профессию: %s", msg.from_user.id, best)
     else:
         await msg.answer(
             "Хм, такой профессии у нас нет 🧐 Попробуйте проверить написание или выберите случайный вариант из списка.",
             reply_markup=retry_prof_keyboard()
         )
-        logger.warning(f"Пользователь {msg.from_user.id} ввел неверную профессию: {msg.text}")
+        logger.warning("Пользователь %s ввел неверную профессию: %s", msg.from_user.id, msg.text)
 
 @dp.callback_query(F.data == "random_profession")
 async def random_prof(call: types.CallbackQuery, state: FSMContext):
     prof = random.choice(professions)
-    await upsert_user(call.from_user.id, profession=prof)
+    await state.update_data(profession=prof)
+    profiles.record(call.from_user.id, profession=prof)
     await call.message.edit_text(f"Ваша профессия — {prof}")
     await call.message.answer(
         "Выберите, для кого создаем результат", reply_markup=gender_keyboard()
     )
     await state.set_state(Form.choose_gender)
-    logger.info(f"Пользователь {call.from_user.id} получил случайную профессию: {prof}")
+    logger.info("Пользователь %s получил случайную профессию: %s", call.from_user.id, prof)
 
 @dp.callback_query(F.data.in_(["gender_male", "gender_female"]))
 async def choose_gender(call: types.CallbackQuery, state: FSMContext):
     gender = "male" if call.data == "gender_male" else "female"
-    await upsert_user(call.from_user.id, gender=gender)
+    await state.update_data(gender=gender)
+    profiles.record(call.from_user.id, gender=gender)
     await call.message.delete()
     await call.message.answer(
         "Пора загрузить ваше фото! 📸 Чтобы фигурка получилась максимально похожей, выбирайте чёткое селфи без посторонних предметов на фоне.\n\n"
@@ -414,26 +402,30 @@ async def choose_gender(call: types.CallbackQuery, state: FSMContext):
     disable_web_page_preview=True
     )
     await state.set_state(Form.ask_photo)
-    logger.info(f"Пользователь {call.from_user.id} выбрал пол: {gender}")
+    logger.info("Пользователь %s выбрал пол: %s", call.from_user.id, gender)
 
 @dp.message(StateFilter(Form.ask_photo), ~F.photo)
 async def not_photo(msg: types.Message):
     await msg.answer("Фото нужно загрузить как картинку, а не файл. Попробуйте ещё раз?")
-    logger.warning(f"Пользователь {msg.from_user.id} отправил не фото")
+    logger.warning("Пользователь %s отправил не фото", msg.from_user.id)
 
 @dp.message(StateFilter(Form.ask_photo), F.photo)
 async def process_photo(msg: types.Message, state: FSMContext):
-    # Проверяем текущее состояние пользователя
-    user = await get_user(msg.from_user.id)
-    if not user:
-        # на всякий случай — новый пользователь
-        await upsert_user(msg.from_user.id)
-        user = await get_user(msg.from_user.id)
-
-    photo_count = user["photo_count"]
-    limit       = user["allowed_generations"]
+    photo = msg.photo[-1]
+    # размер Telegram сообщает сам — слишком маленькое фото отклоняем, не скачивая и не тратя попытку
+    if photo_quality.PHOTO_QUALITY and min(photo.width, photo.height) < photo_quality.PHOTO_MIN_SIDE:
+        await msg.answer(photo_quality.PhotoQuality("small").message())
+        logger.info("Пользователь %s прислал слишком маленькое фото: %sx%s", msg.from_user.id, photo.width, photo.height)
+        return
 
-    if photo_count >= limit:
+    # Проверка лимита, +1 к счётчику и анкета из FSM — одним запросом (quota.py);
+    # чего нет в FSM (анкета заполнена до перезапуска), берётся из БД
+    data = await state.get_data()
+    user = await reserve_generation(
+        storage, msg.from_user.id,
+        **{k: data.get(k) for k in ("name", "profession", "gender")},
+    )
+    if user is None:
         # лимит исчерпан — финальное сообщение
         await msg.answer(
             "Большое спасибо, что поучаствовали!❤️\n\n"
@@ -444,25 +436,70 @@ async def process_photo(msg: types.Message, state: FSMContext):
         )
         return
 
-    # Увеличиваем счётчик и сохраняем
-    await upsert_user(msg.from_user.id, inc_photo=True)
-    await msg.answer("Успех! Мы уже создаём вашу уникальную фигурку 😎 Это займёт некоторое время, мы оповестим вас о готовности!")
-    logger.info(f"Пользователь {msg.from_user.id} отправил фото, попытка {photo_count+1}/{limit}")
+    profiles.saved(msg.from_user.id)
 
-    # Скачиваем фото в файл
-    photo = msg.photo[-1]
-    file = await bot.get_file(photo.file_id)
-    with tempfile.NamedTemporaryFile(dir="/shared_tmp", delete=False, suffix=".jpg") as tmp:
-        await bot.download_file(file.file_path, tmp.name)
-        image_path = tmp.name
+    # Скачиваем фото в файл; не скачалось — попытку не засчитываем
+    try:
+        file = await bot.get_file(photo.file_id)
+        with tempfile.NamedTemporaryFile(dir=SHARED_TMP_DIR, delete=False, suffix=".jpg") as tmp:
+            await bot.download_file(file.file_path, tmp.name)
+            image_path = tmp.name
+    except Exception:
+        await release_generation(storage, msg.from_user.id)
+        raise
+
+    # Размытое, тёмное или нечитаемое фото — не тратим на него images.edit (photo_quality.py):
+    # попытку возвращаем, остаёмся в ask_photo и ждём другое
+    try:
+        quality = await photo_quality.check_photo(image_path)
+    except BaseException:
+        # пул упал или бот останавливается — попытку не засчитываем, файл не бросаем
+        await release_generation(storage, msg.from_user.id)
+        os.remove(image_path)
+        raise
+    if not quality.ok:
+        await release_generation(storage, msg.from_user.id)
+        os.remove(image_path)
+        await msg.answer(quality.message())
+        logger.info("Пользователь %s прислал негодное фото: %s", msg.from_user.id, quality.reason)
+        return
+
+    # Повторная попытка, выданная админом, или фото из очереди простоя — не срочно:
+    # отдаём в Batch API, не занимая лимиты OpenAI интерактивных пользователей.
+    # Иначе ставим задачу в очередь выбранного бэкенда (generation.py);
+    # очереди справедливые: задачи одного пользователя не обгоняют чужие,
+    # имя и счётчики — из резервирования: воркерам не нужно перечитывать профиль
+    try:
+        deferred = batch_runner.is_deferrable(user, await default_limit(storage), replaying.get())
+        if deferred:
+            await asyncio.to_thread(
+                batch_runner.runner.defer, image_path, user["profession"], user["gender"], msg.from_user.id, user["name"]
+            )
+            position = 0
+        else:
+            position = await generation.submit(GenerationRequest(
+                image_path, user["profession"], user["gender"], msg.from_user.id,
+                name=user["name"], photo_count=user["photo_count"], limit=user["allowed_generations"],
+            ))
+    except Exception:
+        # задача не поставлена — попытку не засчитываем, файл не бросаем; остаёмся в ask_photo
+        logger.exception("Не удалось поставить генерацию пользователя %s в очередь", msg.from_user.id)
+        await release_generation(storage, msg.from_user.id)
+        os.remove(image_path)
+        await msg.answer("Не получилось принять фото — попробуйте отправить его ещё раз чуть позже 🙏")
+        return
+
+    await state.clear()
+    await msg.answer("Успех! Мы уже создаём вашу уникальную фигурку 😎 Это займёт некоторое время, мы оповестим вас о готовности!")
+    logger.info("Пользователь %s отправил фото, попытка %s/%s", msg.from_user.id, user["photo_count"], user["allowed_generations"])
 
     # Placeholder-видео (не важно, сколько генераций)
     asyncio.create_task(send_placeholder_video(msg.chat.id))
 
-    # Ставим задачу в очередь
-    data = await get_user(msg.from_user.id)
-    generate_image_task.delay(image_path, data["profession"], data["gender"], msg.from_user.id)
-    await state.clear()
+    if deferred:
+        await msg.answer("Эту фигурку мы соберём в спокойном режиме — пришлём, как только она будет готова 🕐")
+    elif position > 1:
+        await msg.answer(f"Вы в очереди: перед вашей фигуркой ещё {position - 1} 🕐")
 
 async def send_placeholder_video(chat_id: int):
     try:
@@ -471,9 +508,9 @@ async def send_placeholder_video(chat_id: int):
             bot.send_video(chat_id=chat_id, video=FSInputFile(WAIT_VIDEO_PATH), supports_streaming=True),
             timeout=120.0
         )
-        logger.info(f"Video placeholder sent to {chat_id}")
+        logger.info("Video placeholder sent to %s", chat_id)
     except Exception as e:
-        logger.warning(f"Не удалось отправить видео-заглушку: {e}")
+        logger.warning("Не удалось отправить видео-заглушку: %s", e)
 
 
 #@dp.callback_query(F.data == "help")
@@ -491,21 +528,13 @@ async def send_placeholder_video(chat_id: int):
     #await call.answer(
     #    "Мы уже проверяем вашу фигурку и скоро исправим ошибку! Спасибо за терпение 🤝", show_alert=True
     #)
-    #logger.info(f"Пользователь {uid} запросил помощь")
+    #logger.info("Пользователь %s запросил помощь", uid)
 
 @dp.message(Command("help"))
 async def cmd_help(msg: types.Message):
     uid = msg.from_user.id
-    # 1) достаём из БД или словаря последний message_id для фото
-    photo_id = None
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT last_photo_id FROM users WHERE user_id = ?;",
-            (uid,)
-        )
-        row = await cur.fetchone()
-        if row:
-            photo_id = row[0]
+    # 1) достаём из индекса (память, затем БД) последний message_id для фото
+    photo_id = await last_results.get(uid)
 
     if photo_id:
         # 2) сначала пересылаем само фото
@@ -532,7 +561,7 @@ async def cmd_help(msg: types.Message):
     await msg.answer(
         "Мы получили ваш запрос и уже проверяем вашу фигурку! Спасибо за терпение 🤝"
     )
-    logger.info(f"/help от {uid}: переслано фото {photo_id} и ID пользователя")
+    logger.info("/help от %s: переслано фото %s и ID пользователя", uid, photo_id)
 
 
 @dp.callback_query(F.data == "another")
@@ -554,7 +583,7 @@ async def another_fun(call: types.CallbackQuery, state: FSMContext):
     # 4) Переводим FSM в состояние ask_name
     await state.set_state(Form.ask_name)
 
-    logger.info(f"Пользователь {uid} запросил другую фигурку — начинаем заново")
+    logger.info("Пользователь %s запросил другую фигурку — начинаем заново", uid)
 
 # --------------------
 # Админские команды (из чата)
@@ -569,24 +598,22 @@ async def admin_broadcast(msg: types.Message):
         await msg.reply("❌ Укажите текст: /broadcast <текст>")
         return
     text = parts[1]
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT user_id FROM users")
-        ids = [r[0] for r in await cur.fetchall()]
+    ids = await storage.user_ids()
     success = 0
     for uid in ids:
         try:
             await bot.send_message(chat_id=uid, text=text)
             success += 1
         except Exception as e:
-            logger.warning(f"Не удалось отправить сообщение пользователю {uid}: {e}")
+            logger.warning("Не удалось отправить сообщение пользователю %s: %s", uid, e)
     await msg.reply(f"✅ Рассылка выполнена: {success} пользователей.")
-    logger.info(f"Рассылка выполнена: {success} пользователей.")
+    logger.info("Рассылка выполнена: %s пользователей.", success)
 
 @dp.message(Command("send"))
 async def admin_send(msg: types.Message):
     if msg.from_user.id not in ADMIN_IDS:
         await msg.reply("❌ У вас нет прав для этой команды.")
-        logger.warning(f"Пользователь {msg.from_user.id} попытался выполнить /send без прав.")
+        logger.warning("Пользователь %s попытался выполнить /send без прав.", msg.from_user.id)
         return
     parts = msg.text.split(' ', 2)
     if len(parts) < 3:
@@ -601,16 +628,16 @@ async def admin_send(msg: types.Message):
     try:
         await bot.send_message(chat_id=uid, text=text)
         await msg.reply(f"✅ Сообщение отправлено пользователю {uid}.")
-        logger.info(f"Сообщение отправлено пользователю {uid}.")
+        logger.info("Сообщение отправлено пользователю %s.", uid)
     except Exception as e:
         await msg.reply(f"❌ Не удалось отправить: {e}")
-        logger.error(f"Не удалось отправить сообщение пользователю {uid}: {e}")
+        logger.error("Не удалось отправить сообщение пользователю %s: %s", uid, e)
 
 @dp.message(Command("reset"))
 async def admin_reset(msg: types.Message):
     if msg.from_user.id not in ADMIN_IDS:
         await msg.reply("❌ У вас нет прав для этой команды.")
-        logger.warning(f"Пользователь {msg.from_user.id} попытался выполнить /reset без прав.")
+        logger.warning("Пользователь %s попытался выполнить /reset без прав.", msg.from_user.id)
         return
     parts = msg.text.split(' ', 1)
     if len(parts) < 2:
@@ -621,11 +648,9 @@ async def admin_reset(msg: types.Message):
     except ValueError:
         await msg.reply("❌ User ID должен быть числом.")
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET photo_count = 0 WHERE user_id = ?", (uid,))
-        await db.commit()
+    await storage.reset_photo_count(uid)
     await msg.reply(f"✅ Счетчик фото для пользователя {uid} сброшен.")
-    logger.info(f"Счетчик фото сброшен для пользователя {uid}.")
+    logger.info("Счетчик фото сброшен для пользователя %s.", uid)
 
 # --------------------
 # Админские команды (из канала)
@@ -633,29 +658,27 @@ async def admin_reset(msg: types.Message):
 @dp.channel_post(Command("broadcast"))
 async def channel_broadcast(post: types.Message):
     if post.chat.id != ADMIN_CHAT_ID:
-        logger.warning(f"Попытка выполнить /broadcast из неверного канала: {post.chat.id}")
+        logger.warning("Попытка выполнить /broadcast из неверного канала: %s", post.chat.id)
         return
     parts = post.text.split(' ', 1)
     if len(parts) < 2:
         logger.warning("Команда /broadcast в канале без текста.")
         return
     text = parts[1]
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT user_id FROM users")
-        ids = [r[0] for r in await cur.fetchall()]
+    ids = await storage.user_ids()
     success = 0
     for uid in ids:
         try:
             await bot.send_message(chat_id=uid, text=text)
             success += 1
         except Exception as e:
-            logger.warning(f"Не удалось отправить сообщение пользователю {uid}: {e}")
-    logger.info(f"Рассылка из канала выполнена: {success} пользователей.")
+            logger.warning("Не удалось отправить сообщение пользователю %s: %s", uid, e)
+    logger.info("Рассылка из канала выполнена: %s пользователей.", success)
 
 @dp.channel_post(Command("send"))
 async def channel_send(post: types.Message):
     if post.chat.id != ADMIN_CHAT_ID:
-        logger.warning(f"Попытка выполнить /send из неверного канала: {post.chat.id}")
+        logger.warning("Попытка выполнить /send из неверного канала: %s", post.chat.id)
         return
     parts = post.text.split(' ', 2)
     if len(parts) < 3:
@@ -669,14 +692,14 @@ async def channel_send(post: types.Message):
     text = parts[2]
     try:
         await bot.send_message(chat_id=uid, text=text)
-        logger.info(f"Сообщение отправлено пользователю {uid} из канала.")
+        logger.info("Сообщение отправлено пользователю %s из канала.", uid)
     except Exception as e:
-        logger.error(f"Не удалось отправить сообщение пользователю {uid} из канала: {e}")
+        logger.error("Не удалось отправить сообщение пользователю %s из канала: %s", uid, e)
 
 @dp.channel_post(Command("reset"))
 async def channel_reset(post: types.Message):
     if post.chat.id != ADMIN_CHAT_ID:
-        logger.warning(f"Попытка выполнить /reset из неверного канала: {post.chat.id}")
+        logger.warning("Попытка выполнить /reset из неверного канала: %s", post.chat.id)
         return
     parts = post.text.split(' ', 1)
     if len(parts) < 2:
@@ -687,10 +710,8 @@ async def channel_reset(post: types.Message):
     except ValueError:
         logger.warning("Команда /reset в канале с некорректным user_id.")
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET photo_count = 0 WHERE user_id = ?", (uid,))
-        await db.commit()
-    logger.info(f"Счетчик фото сброшен для пользователя {uid} из канала.")
+    await storage.reset_photo_count(uid)
+    logger.info("Счетчик фото сброшен для пользователя %s из канала.", uid)
 
 @dp.message(Command("addadmin"))
 async def cmd_addadmin(msg: types.Message):
@@ -708,12 +729,7 @@ async def cmd_addadmin(msg: types.Message):
     new_id = int(parts[1])
 
     # 3) добавляем в таблицу
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT OR IGNORE INTO admins (user_id) VALUES (?)",
-            (new_id,)
-        )
-        await db.commit()
+    await storage.add_admins([new_id])
 
     # 4) подтверждаем в чате
     await msg.reply(f"✅ Пользователь {new_id} теперь администратор.")
@@ -735,6 +751,8 @@ async def cmd_analytics(msg: types.Message):
 
     # Локальная очередь
     local_q = generator.queue.qsize()
+    # место последней задачи пользователя в очереди бэкенда генерации
+    position = await generation.position(uid)
 
     # Очередь в celery
     insp = celery_app.control.inspect()
@@ -748,7 +766,8 @@ async def cmd_analytics(msg: types.Message):
         f"— Имя: {user['name']}\n"
         f"— Профессия: {user['profession']}\n"
         f"— Пол: {user['gender']}\n"
-        f"— Фото отправлено: {user['photo_count']} раз(а)\n\n"
+        f"— Фото отправлено: {user['photo_count']} раз(а)\n"
+        f"— Место в очереди ({generation.name}): {position or '—'}\n\n"
         f"🕐 AsyncIO очередь: {local_q}\n"
         f"🕐 Celery reserved: {reserved_count}\n"
         f"🕐 Celery scheduled: {scheduled_count}\n"
@@ -763,12 +782,7 @@ async def cmd_export(msg: types.Message):
         return await msg.reply("❌ У вас нет прав для этой команды.")
 
     # 1) Считываем всю таблицу users в DataFrame
-    conn = sqlite3.connect(DB_PATH)
-    df = pd.read_sql_query(
-        "SELECT user_id, name, profession, gender, photo_count, last_photo_id FROM users",
-        conn
-    )
-    conn.close()
+    df = pd.DataFrame(await storage.export_users(), columns=EXPORT_FIELDS)
 
     # 2) Сохраняем её в Excel
     file_path = "/tmp/users_report.xlsx"
@@ -778,16 +792,13 @@ async def cmd_export(msg: types.Message):
     await msg.reply_document(
         FSInputFile(file_path, filename="users_report.xlsx")
     )
-    logger.info(f"Экспорт пользователей выполнен админом {msg.from_user.id}")
-
-from config import DEFAULT_ALLOWED_GENERATIONS
-import aiosqlite
+    logger.info("Экспорт пользователей выполнен админом %s", msg.from_user.id)
 
 @dp.message(Command("generation"))
 async def cmd_generation(msg: types.Message):
     """
-    /generation all 1   — установить allowed_generations=1 всем
-    /generation 12345 2 — установить allowed_generations=2 пользователю 12345
+    /generation all 1   — общий лимит 1 (у кого нет личного)
+    /generation 12345 2 — личный лимит 2 пользователю 12345
     """
     parts = msg.text.split()
     if len(parts) != 3 or not parts[2].isdigit():
@@ -796,10 +807,9 @@ async def cmd_generation(msg: types.Message):
     target, cnt = parts[1], int(parts[2])
 
     if target.lower() == "all":
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("UPDATE users SET allowed_generations = ?, updated_at = datetime('now');", (cnt,))
-            await db.commit()
-        return await msg.reply(f"✅ Установлено {cnt} генераций для всех пользователей.")
+        # одна строка settings вместо перезаписи всей таблицы users
+        await set_default_limit(storage, cnt)
+        return await msg.reply(f"✅ Установлено {cnt} генераций для всех пользователей (кроме тех, кому лимит задан лично).")
     elif target.isdigit():
         uid = int(target)
         await upsert_user(uid, set_allowed=cnt)
@@ -807,57 +817,37 @@ async def cmd_generation(msg: types.Message):
     else:
         return await msg.reply("❌ Неверный первый аргумент, используйте all или user_id.")
 
+async def fetch_user_stats() -> dict:
+    """Воронка и активность пользователей для /stats."""
+    return await storage.user_stats()
+
+def format_tiers(counts: dict) -> str:
+    return ", ".join(f"{name} – {n}" for name, n in counts.items()) or "нет данных"
+
+def format_hedge(m: dict) -> str:
+    requests_total = int(m.get("requests", 0))
+    if not requests_total:
+        return "нет данных"
+    hedged = int(m.get("hedged", 0))
+    return (
+        f"{hedged} из {requests_total} ({hedged / requests_total:.1%}), "
+        f"дубль первым {int(m.get('hedge_wins', 0))}, сэкономлено ≈{m.get('latency_saved_s', 0):.0f} с"
+    )
+
 @dp.message(Command("stats"))
 async def cmd_stats(msg: types.Message):
-    # 1) Собираем метрики из БД в отдельном соединении — чтобы не блокировать глобальные апдейты
-    async with aiosqlite.connect(DB_PATH, timeout=20.0) as db:
-        # (опционально) возвращать строки как dict
-        db.row_factory = aiosqlite.Row
-
-        # сколько пользователей вообще открыли бота
-        cur = await db.execute("SELECT COUNT(*) AS cnt FROM users;")
-        total_users = (await cur.fetchone())["cnt"]
-
-        # написали имя
-        cur = await db.execute(
-            "SELECT COUNT(*) AS cnt FROM users WHERE name IS NOT NULL AND name <> '';"
-        )
-        wrote_name = (await cur.fetchone())["cnt"]
-
-        # написали профессию
-        cur = await db.execute(
-            "SELECT COUNT(*) AS cnt FROM users WHERE profession IS NOT NULL AND profession <> '';"
-        )
-        wrote_prof = (await cur.fetchone())["cnt"]
-
-        # выбрали пол: всего, М, Ж
-        cur = await db.execute("SELECT COUNT(*) AS cnt FROM users WHERE gender IN ('male','female');")
-        total_gender = (await cur.fetchone())["cnt"]
-        cur = await db.execute("SELECT COUNT(*) AS cnt FROM users WHERE gender = 'male';")
-        male_count = (await cur.fetchone())["cnt"]
-        cur = await db.execute("SELECT COUNT(*) AS cnt FROM users WHERE gender = 'female';")
-        female_count = (await cur.fetchone())["cnt"]
-
-        # отправили хотя бы 1 фото
-        cur = await db.execute("SELECT COUNT(*) AS cnt FROM users WHERE photo_count >= 1;")
-        at_least_one = (await cur.fetchone())["cnt"]
-
-        # отправили 2 и более фото
-        cur = await db.execute("SELECT COUNT(*) AS cnt FROM users WHERE photo_count >= 2;")
-        at_least_two = (await cur.fetchone())["cnt"]
-
-        # активных за неделю (updated_at за последние 7 дней)
-        cur = await db.execute(
-            "SELECT COUNT(*) AS cnt "
-            "FROM users "
-            "WHERE updated_at >= datetime('now', '-7 days');"
-        )
-        active_week = (await cur.fetchone())["cnt"]
-
-        # подписались всего (с учётом ручного оффсета)
-        cur = await db.execute("SELECT COUNT(*) AS cnt FROM subscriptions;")
-        real_subs = (await cur.fetchone())["cnt"]
-        subs = real_subs + 13087  # ваш оффсет
+    # 1) Собираем метрики из БД
+    stats = await fetch_user_stats()
+    total_users = stats["total_users"]
+    wrote_name = stats["wrote_name"]
+    wrote_prof = stats["wrote_prof"]
+    total_gender = stats["total_gender"]
+    male_count = stats["male_count"]
+    female_count = stats["female_count"]
+    at_least_one = stats["at_least_one"]
+    at_least_two = stats["at_least_two"]
+    active_week = stats["active_week"]
+    subs = stats["real_subs"] + 13087  # ваш оффсет
 
     # 2) Метрики очередей
     local_q = generator.queue.qsize()
@@ -866,6 +856,13 @@ async def cmd_stats(msg: types.Message):
     scheduled = insp.scheduled() or {}
     reserved_count = sum(len(v) for v in reserved.values())
     scheduled_count = sum(len(v) for v in scheduled.values())
+    hedge_local = generator.hedge.stats.snapshot()
+    limiter = generator.limiter.snapshot()
+    tiers_local = dict(generator.degradation.counts)
+    tiers_celery = await asyncio.to_thread(tier_metrics)
+    hedge_celery = await asyncio.to_thread(hedge_metrics)
+    batch_pending = await asyncio.to_thread(batch_runner.runner.pending)
+    batch_stats = await asyncio.to_thread(batch_runner.runner.metrics)
 
     # 3) Формируем и отправляем отчёт
     text = (
@@ -878,7 +875,15 @@ async def cmd_stats(msg: types.Message):
         f"— Отправили ≥2 фото: {at_least_two}\n\n"
         f"— AsyncIO-очередь: {local_q}\n"
         f"— Celery reserved: {reserved_count}\n"
-        f"— Celery scheduled: {scheduled_count}\n\n"
+        f"— Celery scheduled: {scheduled_count}\n"
+        f"— Параллельность AsyncIO: {limiter['limit']} (в работе {limiter['inflight']}, 429: {limiter['rate_limited']})\n"
+        f"— Дубли запросов (AsyncIO): {format_hedge(hedge_local)}\n"
+        f"— Дубли запросов (Celery): {format_hedge(hedge_celery)}\n"
+        f"— Уровни качества AsyncIO: {format_tiers(tiers_local)}\n"
+        f"— Уровни качества Celery: {format_tiers(tiers_celery)}\n"
+        f"— Batch API: ждут отправки {batch_pending}, пакетов {batch_stats.get('batches', 0)}, "
+        f"задач {batch_stats.get('jobs', 0)}, доставлено {batch_stats.get('ok', 0)}, "
+        f"в обычную очередь {batch_stats.get('fallback', 0)}\n\n"
         f"— Активных за неделю: {active_week}\n"
         f"— Подписались: {subs}"
     )
@@ -890,12 +895,11 @@ async def cmd_stats(msg: types.Message):
     )
 
 
-@dp.startup()
-async def on_startup():
-    await init_db()
-    for _ in range(MAX_CONCURRENT_TASKS):
-        asyncio.create_task(generator.worker())
-    logger.info("Бот запущен")
+def main() -> None:
+    setup_logging("bot", logger)
+    setup()
+    dp.run_polling(bot, skip_updates=True)
+
 
 if __name__ == "__main__":
-    dp.run_polling(bot, skip_updates=True)
\ No newline at end of file
+    main()
\ No newline at end of file
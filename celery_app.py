@@ -1,5 +1,9 @@
-from celery import Celery
+import os
+
+from celery import Celery, signals
+from kombu import Queue
 from config import REDIS_URL
+from log_setup import setup_logging, bind_log_context, clear_log_context
 
 celery_app = Celery(
     'image_tasks',
@@ -8,8 +12,81 @@ celery_app = Celery(
     include=['tasks']       # <--- добавляем ваш модуль с тасками
 )
 
+# генерации — в своей очереди: по её длине tasks.choose_tier судит о нагрузке,
+# и доставки (deliver_result_task) её не раздувают. Воркер без -Q слушает обе
+GENERATION_QUEUE = "generation"
+
 celery_app.conf.update(
+    task_queues=(Queue("celery"), Queue(GENERATION_QUEUE)),
+    task_routes={"tasks.generate_image_task": {"queue": GENERATION_QUEUE}},
     task_serializer='json',
     result_serializer='json',
     accept_content=['json'],
+    # generate_image_task — fire-and-forget: результат (None) никто не читает,
+    # а бэкенд держал бы по ключу celery-task-meta-* на задачу сутки
+    task_ignore_result=True,
+    result_expires=3600,
 )
+
+# Профили воркера: согласованные наборы настроек под нагрузку, выбираются CELERY_PROFILE.
+# Сжатие задаётся на стороне отправителя, поэтому у бота и воркеров профиль один.
+# Замеры на заглушках: python -m loadtest --mode celery --celery-profile <имя>
+WORKER_PROFILES = {
+    # как было: prefork, concurrency из командной строки, ack до выполнения
+    "default": {},
+    # задача почти всё время ждёт OpenAI и Telegram: много потоков, по одной задаче на поток,
+    # ack после выполнения — задачи упавшего воркера вернутся в очередь.
+    # Лимиты времени пул threads не соблюдает — держат таймауты HTTP-клиентов
+    "io-heavy": {
+        "worker_pool": "threads",
+        "worker_concurrency": 32,
+        "worker_prefetch_multiplier": 1,
+        "task_acks_late": True,
+        "task_reject_on_worker_lost": True,
+    },
+    # маленькая машина: два процесса, перезапуск после 20 задач или 300 МБ,
+    # сообщения в Redis сжаты
+    "low-memory": {
+        "worker_pool": "prefork",
+        "worker_concurrency": 2,
+        "worker_prefetch_multiplier": 1,
+        "worker_max_tasks_per_child": 20,
+        "worker_max_memory_per_child": 300_000,  # КиБ
+        "task_compression": "gzip",
+        "task_acks_late": True,
+        "task_reject_on_worker_lost": True,
+        "task_soft_time_limit": 300,
+        "task_time_limit": 360,
+    },
+    # быстро разобрать всплеск: максимум потоков и предвыборка пачками;
+    # ack сразу — задачи, взятые упавшим воркером, теряются вместе с попыткой пользователя
+    "burst": {
+        "worker_pool": "threads",
+        "worker_concurrency": 64,
+        "worker_prefetch_multiplier": 4,
+        "task_acks_late": False,
+    },
+}
+CELERY_PROFILE = os.getenv("CELERY_PROFILE", "default")
+if CELERY_PROFILE not in WORKER_PROFILES:
+    raise ValueError(f"Неизвестный CELERY_PROFILE: {CELERY_PROFILE}")
+celery_app.conf.update(WORKER_PROFILES[CELERY_PROFILE])
+# с acks_late сообщение вернётся в очередь, если не подтверждено за visibility_timeout —
+# он должен быть больше жёсткого лимита задачи
+celery_app.conf.broker_transport_options = {"visibility_timeout": 3600}
+
+
+# Логи воркера — JSON-строки через очередь (см. log_setup); Celery свои обработчики не ставит
+@signals.setup_logging.connect
+def _setup_worker_logging(**kwargs):
+    setup_logging("worker")
+
+
+@signals.task_prerun.connect
+def _bind_task_context(task_id=None, **kwargs):
+    bind_log_context(job_id=task_id)
+
+
+@signals.task_postrun.connect
+def _clear_task_context(**kwargs):
+    clear_log_context()
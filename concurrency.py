@@ -0,0 +1,140 @@
+# concurrency.py
+
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+
+from config import logger
+
+GENERATOR_MIN_CONCURRENCY = int(os.getenv("GENERATOR_MIN_CONCURRENCY", "1"))
+GENERATOR_MAX_CONCURRENCY = int(os.getenv("GENERATOR_MAX_CONCURRENCY", "32"))
+# во сколько раз режем параллельность при 429 или росте задержки
+CONCURRENCY_BACKOFF = float(os.getenv("CONCURRENCY_BACKOFF", "0.7"))
+# задержка считается выросшей, если быстрая средняя больше медленной во столько раз
+CONCURRENCY_LATENCY_TOLERANCE = float(os.getenv("CONCURRENCY_LATENCY_TOLERANCE", "1.5"))
+
+
+class Slot:
+    """
+    Один запрос под лимитом; вызывающий отмечает 429 через rate_limited(),
+    а запрос, брошенный не из-за OpenAI (проигравший дубль хеджа), — через abandon().
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.retry_after: float | None = None
+        self.abandoned = False
+
+    def rate_limited(self, retry_after: float) -> None:
+        self.retry_after = retry_after
+
+    def abandon(self) -> None:
+        self.abandoned = True
+
+
+class AdaptiveLimiter:
+    """
+    AIMD-ограничитель одновременных запросов к OpenAI.
+
+    Каждый успешный запрос с нормальной задержкой прибавляет 1/limit к лимиту
+    (то есть +1 за «раунд» из limit запросов). 429 и рост задержки
+    (быстрая EWMA больше медленной в latency_tolerance раз) умножают лимит на backoff,
+    не чаще раза за время одного запроса. На 429 все новые запросы вдобавок ждут
+    Retry-After — вместо фиксированной паузы после каждой задачи.
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        min_limit: int = GENERATOR_MIN_CONCURRENCY,
+        max_limit: int = GENERATOR_MAX_CONCURRENCY,
+        backoff: float = CONCURRENCY_BACKOFF,
+        latency_tolerance: float = CONCURRENCY_LATENCY_TOLERANCE
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = float(min(max(initial, min_limit), self.max_limit))
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.inflight = 0
+        self.rate_limited = 0
+        self._cond = asyncio.Condition()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._fast: float | None = None
+        self._slow: float | None = None
+
+    @asynccontextmanager
+    async def slot(self):
+        await self._acquire()
+        slot = Slot()
+        try:
+            yield slot
+        except BaseException:
+            if slot.retry_after is not None and not slot.abandoned:
+                self._on_rate_limit(slot.retry_after)
+            raise
+        else:
+            # брошенный запрос не успех: ни рост лимита, ни задержка в EWMA
+            if not slot.abandoned:
+                self._on_success(time.monotonic() - slot.started)
+        finally:
+            async with self._cond:
+                self.inflight -= 1
+                self._cond.notify_all()
+
+    async def _acquire(self) -> None:
+        async with self._cond:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), pause)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.inflight < int(self.limit):
+                    break
+                await self._cond.wait()
+            self.inflight += 1
+
+    def _set_limit(self, value: float, reason: str) -> None:
+        old = int(self.limit)
+        self.limit = min(max(value, self.min_limit), self.max_limit)
+        if int(self.limit) != old:
+            logger.info("Параллельность генератора: %s → %s (%s)", old, int(self.limit), reason)
+
+    def _decrease(self, reason: str) -> None:
+        now = time.monotonic()
+        # одно снижение на «раунд»: запросы, начатые до снижения, не режут лимит повторно
+        if now - self._last_decrease < (self._fast or 0.0):
+            return
+        self._last_decrease = now
+        self._set_limit(self.limit * self.backoff, reason)
+
+    def _on_success(self, latency: float) -> None:
+        if self._fast is None:
+            self._fast = self._slow = latency
+        else:
+            self._fast += 0.3 * (latency - self._fast)
+            self._slow += 0.05 * (latency - self._slow)
+        if self._fast > self._slow * self.latency_tolerance:
+            self._decrease(f"задержка {self._fast:.1f} с против обычной {self._slow:.1f} с")
+        elif self.inflight >= int(self.limit):
+            # растём, только если лимит действительно выбран
+            self._set_limit(self.limit + 1 / self.limit, "запросы проходят")
+
+    def _on_rate_limit(self, retry_after: float) -> None:
+        self.rate_limited += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        self._decrease(f"429, пауза {retry_after:.1f} с")
+
+    def snapshot(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "inflight": self.inflight,
+            "rate_limited": self.rate_limited,
+            "paused_s": round(max(self._paused_until - time.monotonic(), 0.0), 1),
+            "latency_s": round(self._fast, 1) if self._fast is not None else None,
+        }
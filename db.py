@@ -1,74 +1,82 @@
 import aiosqlite
 import logging
 
+from migrations import column_names, migrate, sql
+from setting_cache import fresh, remember
+
 import os
 DB_PATH = os.getenv("USERS_DB", "data/users.db")
 
+async def _schema_v1(db: aiosqlite.Connection):
+    """Исходная схема; в БД, созданных до миграций, добавляем недостающие колонки."""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tg_id INTEGER UNIQUE,
+            is_subscribed BOOLEAN DEFAULT 0,
+            category TEXT,
+            detail TEXT,
+            name TEXT,
+            city TEXT,
+            address TEXT,
+            review TEXT,
+            genre TEXT,
+            gen_limit INTEGER DEFAULT 1,
+            current_gen_count INTEGER DEFAULT 0,
+            generator TEXT DEFAULT 'suno',
+            is_finished INTEGER DEFAULT 0
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS song_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tg_id INTEGER,
+            category TEXT,
+            detail TEXT,
+            name TEXT,
+            city TEXT,
+            address TEXT,
+            review TEXT,
+            genre TEXT,
+            prompt TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+    cols = await column_names(db, "users")
+    if "generator" not in cols:
+        await db.execute("ALTER TABLE users ADD COLUMN generator TEXT DEFAULT 'suno'")
+        logging.info("Столбец generator добавлен в users")
+    if "is_finished" not in cols:
+        await db.execute('ALTER TABLE users ADD COLUMN is_finished INTEGER DEFAULT 0')
+        logging.info("Столбец is_finished добавлен в users")
+
+    # Устанавливаем начальное значение глобального лимита (например, 1)
+    await db.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('default_gen_limit', '1'))
+
+
+# Шаги миграций (migrations.py): только дописываем в конец
+MIGRATIONS = [
+    _schema_v1,
+    # история пользователя: WHERE tg_id=? ORDER BY created_at без сортировки всей таблицы
+    sql("CREATE INDEX IF NOT EXISTS idx_song_history_user ON song_history(tg_id, created_at)"),
+    # gen_limit — личный лимит: совпадающий с общим сбрасываем в NULL, чтобы он следовал за settings
+    sql(
+        "UPDATE users SET gen_limit = NULL WHERE gen_limit = "
+        "(SELECT CAST(value AS INTEGER) FROM settings WHERE key = 'default_gen_limit')"
+    ),
+]
+
+
 async def init_db():
     async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                tg_id INTEGER UNIQUE,
-                is_subscribed BOOLEAN DEFAULT 0,
-                category TEXT,
-                detail TEXT,
-                name TEXT,
-                city TEXT,
-                address TEXT,
-                review TEXT,
-                genre TEXT,
-                gen_limit INTEGER DEFAULT 1,
-                current_gen_count INTEGER DEFAULT 0,
-                generator TEXT DEFAULT 'suno'
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS song_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                tg_id INTEGER,
-                category TEXT,
-                detail TEXT,
-                name TEXT,
-                city TEXT,
-                address TEXT,
-                review TEXT,
-                genre TEXT,
-                prompt TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Новая таблица settings
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        ''')
-        try:
-            await db.execute("ALTER TABLE users ADD COLUMN generator TEXT DEFAULT 'suno'")
-            await db.commit()
-            logging.info("Столбец generator добавлен в users")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" in str(e):
-                logging.info("Столбец generator уже существует")
-            else:
-                logging.error(f"Ошибка при добавлении колонки generator: {e}")
-
-        try:
-            await db.execute('ALTER TABLE users ADD COLUMN is_finished INTEGER DEFAULT 0')
-            await db.commit()
-            logging.info("Столбец is_finished добавлен в users")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" in str(e):
-                logging.info("Столбец is_finished уже существует")
-            else:
-                logging.error(f"Ошибка при добавлении колонки is_finished: {e}")
-
-        # Устанавливаем начальное значение глобального лимита (например, 1)
-        await db.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', ('default_gen_limit', '1'))
-        await db.commit()
+        await migrate(db, MIGRATIONS, name="songs")
         logging.info("[DB] База данных инициализирована.")
 
 
@@ -99,36 +107,60 @@ async def get_global_generator() -> str:
         row = await cur.fetchone()
     return row[0] if row else "suno"
 
-async def add_user(tg_id: int):
+# общий лимит — строка settings, users.gen_limit — личный лимит (NULL — общий).
+# Кэш — общий с ботом (setting_cache.py, LIMIT_CACHE_TTL), ключ кэша — путь к этой БД
+DEFAULT_LIMIT_KEY = "default_gen_limit"
+
+
+async def get_setting(key: str) -> str | None:
     async with aiosqlite.connect(DB_PATH) as db:
-        # Получаем глобальный лимит из settings
-        async with db.execute("SELECT value FROM settings WHERE key = 'default_gen_limit'") as cursor:
+        async with db.execute("SELECT value FROM settings WHERE key = ?", (key,)) as cursor:
             row = await cursor.fetchone()
-            default_limit = int(row[0]) if row else 1  # Если нет значения, используем 1
-        # Добавляем пользователя с глобальным лимитом
+    return row[0] if row else None
+
+
+async def set_setting(key: str, value: str) -> None:
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+        await db.commit()
+
+
+async def get_default_gen_limit() -> int:
+    """Общий лимит генераций; из settings не чаще раза в LIMIT_CACHE_TTL секунд."""
+    limit = fresh(DB_PATH, DEFAULT_LIMIT_KEY)
+    if limit is None:
+        value = await get_setting(DEFAULT_LIMIT_KEY)
+        limit = remember(DB_PATH, DEFAULT_LIMIT_KEY, int(value) if value is not None else 1)  # Если нет значения, используем 1
+    return limit
+
+async def add_user(tg_id: int):
+    async with aiosqlite.connect(DB_PATH) as db:
+        # gen_limit NULL — действует общий лимит из settings
         await db.execute(
-            'INSERT OR IGNORE INTO users (tg_id, gen_limit, current_gen_count) VALUES (?, ?, 0)',
-            (tg_id, default_limit)
+            'INSERT OR IGNORE INTO users (tg_id, gen_limit, current_gen_count) VALUES (?, NULL, 0)',
+            (tg_id,)
         )
         await db.commit()
-        logging.info(f"[DB] Добавлен пользователь {tg_id} с gen_limit={default_limit}")
+        logging.info(f"[DB] Добавлен пользователь {tg_id}")
 
 async def set_gen_limit(limit: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Обновляем глобальный лимит в settings
-        await db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('default_gen_limit', ?)", (str(limit),))
-        # Применяем новый лимит ко всем пользователям
-        await db.execute("UPDATE users SET gen_limit = ?", (limit,))
-        await db.commit()
-        logging.info(f"[DB] Установлен глобальный лимит генераций: {limit}")
+    # Одна строка settings: у кого нет личного лимита, получат новый при следующем чтении
+    await set_setting(DEFAULT_LIMIT_KEY, str(limit))
+    remember(DB_PATH, DEFAULT_LIMIT_KEY, limit)
+    logging.info(f"[DB] Установлен глобальный лимит генераций: {limit}")
 
 async def get_user(tg_id: int):
+    """Анкета пользователя; gen_limit — действующий лимит (личный или общий)."""
+    default_limit = await get_default_gen_limit()
     async with aiosqlite.connect(DB_PATH) as db:
         async with db.execute('SELECT * FROM users WHERE tg_id=?', (tg_id,)) as cursor:
             row = await cursor.fetchone()
             if row:
                 columns = [col[0] for col in cursor.description]
-                return dict(zip(columns, row))
+                user = dict(zip(columns, row))
+                if user["gen_limit"] is None:
+                    user["gen_limit"] = default_limit
+                return user
             return None
 
 async def update_user_fields(tg_id: int, **fields):
@@ -180,14 +212,51 @@ async def add_song_history(tg_id: int, data: dict, prompt: str):
         ))
         await db.commit()
 
-async def get_user_history(tg_id: int):
+# сколько записей истории читаем за один запрос
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+
+_HISTORY_COLUMNS = "id, category, detail, name, city, address, review, genre, prompt, created_at"
+
+
+async def get_user_history_page(tg_id: int, after: tuple | None = None, limit: int = HISTORY_PAGE_SIZE):
+    """
+    Страница истории по возрастанию (created_at, id) и курсор следующей страницы
+    (None — дальше записей нет). after — курсор предыдущей страницы.
+
+    Keyset-пагинация по индексу idx_song_history_user (tg_id, created_at; id — rowid,
+    он и так замыкает ключ индекса): читается только сама страница, без OFFSET.
+    """
+    if after is None:
+        query = f"""SELECT {_HISTORY_COLUMNS} FROM song_history
+                    WHERE tg_id=?
+                    ORDER BY created_at, id LIMIT ?"""
+        params = (tg_id, limit)
+    else:
+        query = f"""SELECT {_HISTORY_COLUMNS} FROM song_history
+                    WHERE tg_id=? AND (created_at, id) > (?, ?)
+                    ORDER BY created_at, id LIMIT ?"""
+        params = (tg_id, *after, limit)
     async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            '''SELECT id, category, detail, name, city, address, review, genre, prompt, created_at
-               FROM song_history WHERE tg_id=?
-               ORDER BY created_at ASC''', (tg_id,)
-        ) as cursor:
-            return await cursor.fetchall()
+        async with db.execute(query, params) as cursor:
+            rows = await cursor.fetchall()
+    cursor_next = (rows[-1][-1], rows[-1][0]) if len(rows) == limit else None
+    return rows, cursor_next
+
+
+async def iter_user_history(tg_id: int, page_size: int = HISTORY_PAGE_SIZE):
+    """Вся история пользователя постранично: в памяти не больше одной страницы."""
+    after = None
+    while True:
+        rows, after = await get_user_history_page(tg_id, after, page_size)
+        for row in rows:
+            yield row
+        if after is None:
+            return
+
+
+async def get_user_history(tg_id: int):
+    """Вся история списком; для больших историй — iter_user_history."""
+    return [row async for row in iter_user_history(tg_id)]
 
 async def delete_user_history(tg_id: int):
     async with aiosqlite.connect(DB_PATH) as db:
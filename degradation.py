@@ -0,0 +1,79 @@
+# degradation.py
+
+import os
+import threading
+from collections import Counter
+from dataclasses import dataclass
+
+from config import logger
+
+
+@dataclass(frozen=True)
+class Tier:
+    name: str
+    quality: str
+    size: str
+    # порог входа: глубина очереди или прогноз ожидания, с (0 — без порога)
+    queue_depth: int = 0
+    wait_s: float = 0.0
+
+
+# от лучшего к самому дешёвому; у gpt-image-1 нет размеров меньше 1024, поэтому экономим на quality
+TIERS = [
+    Tier("standard", quality="medium", size="1024x1024"),
+    Tier(
+        "fast", quality="low", size="1024x1024",
+        queue_depth=int(os.getenv("DEGRADE_QUEUE_DEPTH", "200")),
+        wait_s=float(os.getenv("DEGRADE_WAIT_S", "300")),
+    ),
+]
+TIERS_BY_NAME = {t.name: t for t in TIERS}
+# обратно на уровень выше — только когда нагрузка упала ниже порога × ratio
+DEGRADE_RECOVER_RATIO = float(os.getenv("DEGRADE_RECOVER_RATIO", "0.6"))
+
+
+def tier_params(name: str | None) -> dict:
+    """quality/size для images.edit; неизвестный или пустой уровень — standard."""
+    tier = TIERS_BY_NAME.get(name or "", TIERS[0])
+    return {"quality": tier.quality, "size": tier.size}
+
+
+class DegradationPolicy:
+    """
+    Выбирает уровень качества для новых задач по глубине очереди и прогнозу ожидания.
+
+    Уровень повышается (дешевле), как только нагрузка достигла его порога, и
+    возвращается обратно, только когда она опустилась ниже порога × recover_ratio, —
+    чтобы на границе уровни не переключались на каждой задаче.
+    """
+
+    def __init__(self, tiers: list[Tier] = TIERS, recover_ratio: float = DEGRADE_RECOVER_RATIO):
+        self.tiers = tiers
+        self.recover_ratio = recover_ratio
+        self.level = 0
+        self.counts: Counter = Counter()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _reached(tier: Tier, depth: int, wait_s: float, scale: float = 1.0) -> bool:
+        return (
+            (tier.queue_depth and depth >= tier.queue_depth * scale)
+            or (tier.wait_s and wait_s >= tier.wait_s * scale)
+        )
+
+    def choose(self, queue_depth: int, projected_wait_s: float) -> Tier:
+        with self._lock:
+            level = self.level
+            while level + 1 < len(self.tiers) and self._reached(self.tiers[level + 1], queue_depth, projected_wait_s):
+                level += 1
+            while level > 0 and not self._reached(self.tiers[level], queue_depth, projected_wait_s, self.recover_ratio):
+                level -= 1
+            if level != self.level:
+                logger.warning(
+                    "Качество генерации: %s → %s (очередь %s, ожидание ≈%.0f с)",
+                    self.tiers[self.level].name, self.tiers[level].name, queue_depth, projected_wait_s,
+                )
+                self.level = level
+            tier = self.tiers[level]
+            self.counts[tier.name] += 1
+            return tier
@@ -0,0 +1,171 @@
+# fair_queue.py
+
+import asyncio
+import json
+import os
+import uuid
+
+from config import logger
+from job_queue import MAX_INFLIGHT_PER_USER
+
+# сколько задач генерации одновременно выдано Celery (в брокере, у воркеров, на доставке);
+# остальные ждут в справедливой очереди. 0 — вдвое больше concurrency воркеров (tasks.py)
+FAIR_DISPATCH_DEPTH = int(os.getenv("FAIR_DISPATCH_DEPTH", "0"))
+# через сколько секунд выданная задача, о завершении которой никто не сообщил, перестаёт занимать место
+FAIR_INFLIGHT_TTL = int(os.getenv("FAIR_INFLIGHT_TTL", "1800"))
+# как часто диспетчер проверяет, не освободилось ли место
+FAIR_POLL_INTERVAL = float(os.getenv("FAIR_POLL_INTERVAL", "0.5"))
+# сколько первых задач очереди просматривает одна выдача в поисках пользователя без лимита
+FAIR_SCAN = 200
+
+# Ставит задачу с меткой max(vtime, последняя метка пользователя) + 1 (job_queue.FairClock).
+# KEYS: очередь (ZSET метка → "user:job"), payload задач, последние метки пользователей, vtime.
+# ARGV: user_id, job_id, payload. Возвращает место задачи в очереди.
+_SUBMIT_LUA = """
+local vtime = tonumber(redis.call('GET', KEYS[4]) or '0')
+local last = tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or '0')
+local tag = math.max(vtime, last) + 1
+redis.call('HSET', KEYS[3], ARGV[1], tag)
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+redis.call('ZADD', KEYS[1], tag, ARGV[1] .. ':' .. ARGV[2])
+return redis.call('ZCOUNT', KEYS[1], '-inf', tag)
+"""
+
+# Забирает первую по метке задачу пользователя, у которого в работе меньше лимита.
+# KEYS: очередь, payload задач, последние метки, vtime, выданные задачи (ZSET job → срок).
+# ARGV: лимит на пользователя, общий лимит выданных, срок жизни выданной задачи (с),
+# сколько задач просмотреть, префикс ключей «в работе у пользователя».
+# Возвращает {job_id, payload} или false.
+_POP_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1])
+local ttl = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[5], '-inf', now)
+if redis.call('ZCARD', KEYS[5]) >= tonumber(ARGV[2]) then
+  return false
+end
+local items = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[4]) - 1, 'WITHSCORES')
+local full = {}
+for i = 1, #items, 2 do
+  local user, job = string.match(items[i], '^(.*):([^:]*)$')
+  local busy = ARGV[5] .. user
+  if full[user] == nil then
+    redis.call('ZREMRANGEBYSCORE', busy, '-inf', now)
+    full[user] = redis.call('ZCARD', busy) >= tonumber(ARGV[1])
+  end
+  if not full[user] then
+    local tag = tonumber(items[i + 1])
+    redis.call('ZREM', KEYS[1], items[i])
+    redis.call('ZADD', busy, now + ttl, job)
+    redis.call('EXPIRE', busy, ttl)
+    redis.call('ZADD', KEYS[5], now + ttl, job)
+    if tonumber(redis.call('GET', KEYS[4]) or '0') < tag then
+      redis.call('SET', KEYS[4], tag)
+    end
+    if tonumber(redis.call('HGET', KEYS[3], user) or '-1') == tag then
+      redis.call('HDEL', KEYS[3], user)
+    end
+    local payload = redis.call('HGET', KEYS[2], job)
+    redis.call('HDEL', KEYS[2], job)
+    return {job, payload}
+  end
+end
+return false
+"""
+
+
+class FairQueue:
+    """
+    Справедливая очередь перед Celery: задачи генерации ждут в Redis в том же порядке,
+    что и в job_queue (FairClock), и выдаются в брокер, только пока выданных меньше depth,
+    а у пользователя в работе меньше max_inflight. Очередь Celery остаётся короткой —
+    альбом одного пользователя не занимает её голову.
+
+    Выданная задача занимает место до done() (его вызывают таски по завершении
+    или окончательной ошибке), но не дольше inflight_ttl — потерянная задача не держит
+    пользователя вечно. Счётчики «в работе» — ключи {prefix}:busy:{user_id}: рассчитано
+    на один Redis, не на кластер.
+    """
+
+    def __init__(self, redis_client, depth: int, prefix: str = "fair",
+                 max_inflight: int = MAX_INFLIGHT_PER_USER, inflight_ttl: int = FAIR_INFLIGHT_TTL):
+        self.r = redis_client
+        self.depth = depth
+        self.prefix = prefix
+        self.max_inflight = max_inflight
+        self.inflight_ttl = inflight_ttl
+        self._submit = redis_client.register_script(_SUBMIT_LUA)
+        self._pop = redis_client.register_script(_POP_LUA)
+
+    def _keys(self) -> list[str]:
+        return [f"{self.prefix}:queue", f"{self.prefix}:jobs", f"{self.prefix}:last", f"{self.prefix}:vtime"]
+
+    def submit(self, user_id, payload: dict) -> tuple[str, int]:
+        """Ставит задачу в очередь; возвращает её id (он же id задачи Celery) и место в очереди."""
+        job_id = uuid.uuid4().hex
+        position = self._submit(keys=self._keys(), args=[user_id, job_id, json.dumps(payload, ensure_ascii=False)])
+        return job_id, int(position)
+
+    def pop(self) -> tuple[str, dict] | None:
+        """Следующая задача, которую можно выдать, или None."""
+        found = self._pop(
+            keys=[*self._keys(), f"{self.prefix}:running"],
+            args=[self.max_inflight, self.depth, self.inflight_ttl, FAIR_SCAN, f"{self.prefix}:busy:"],
+        )
+        if not found:
+            return None
+        return found[0].decode(), json.loads(found[1])
+
+    def done(self, user_id, job_id: str) -> None:
+        """Задача завершена (доставлена или окончательно упала) — место свободно."""
+        pipe = self.r.pipeline()
+        pipe.zrem(f"{self.prefix}:busy:{user_id}", job_id)
+        pipe.zrem(f"{self.prefix}:running", job_id)
+        pipe.execute()
+
+    def dispatch(self, send) -> int:
+        """Выдаёт send(job_id, payload) задачи, пока есть место; возвращает, сколько выдано."""
+        sent = 0
+        while (found := self.pop()) is not None:
+            job_id, payload = found
+            try:
+                send(job_id, payload)
+            except Exception:
+                # задача уже снята с очереди — вернём её в начало, чтобы не потерять
+                self.requeue(payload["user_id"], job_id, payload)
+                raise
+            sent += 1
+        return sent
+
+    def requeue(self, user_id, job_id: str, payload: dict) -> None:
+        vtime = int(self.r.get(f"{self.prefix}:vtime") or 0)
+        pipe = self.r.pipeline()
+        pipe.hset(f"{self.prefix}:jobs", job_id, json.dumps(payload, ensure_ascii=False))
+        pipe.zadd(f"{self.prefix}:queue", {f"{user_id}:{job_id}": vtime})
+        pipe.execute()
+        self.done(user_id, job_id)
+
+    def size(self) -> int:
+        return self.r.zcard(f"{self.prefix}:queue")
+
+    def position(self, user_id) -> int:
+        """Место последней задачи пользователя в очереди (1 — следующая), 0 — в очереди её нет."""
+        last = self.r.hget(f"{self.prefix}:last", user_id)
+        if last is None:
+            return 0
+        return self.r.zcount(f"{self.prefix}:queue", "-inf", int(last))
+
+
+async def dispatch_forever(dispatch, interval: float = FAIR_POLL_INTERVAL) -> None:
+    """
+    Фоновая задача бота: dispatch() (например, tasks.dispatch_generations) переносит задачи
+    из справедливой очереди в Celery; когда выдавать нечего — ждём interval.
+    """
+    while True:
+        try:
+            sent = await asyncio.to_thread(dispatch)
+        except Exception as e:
+            logger.warning("Не удалось выдать задачи из справедливой очереди: %s", e)
+            sent = 0
+        if not sent:
+            await asyncio.sleep(interval)
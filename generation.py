@@ -0,0 +1,236 @@
+# generation.py
+
+import asyncio
+import os
+import random
+import re
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass
+
+import pandas as pd
+
+from config import ACCESSORIES_FILE, PACKAGING_PROMPT_TEMPLATE, logger
+from job_queue import Job
+from name_render import NAME_PLATE_PROMPT, NAME_RENDER
+
+# Одна генерация — один конвейер: промпт упаковки с аксессуарами профессии, images.edit,
+# сохранение, доставка с подписью по оставшимся попыткам. Где он исполняется, решает бэкенд:
+#   inprocess — воркеры api.ImageGenerator в процессе бота (очередь job_queue);
+#   celery    — generate_image_task / deliver_result_task (tasks.py) через справедливую очередь;
+#   sync      — прямо в вызове submit(), для тестов и отладки.
+GENERATION_BACKEND = os.getenv("GENERATION_BACKEND", "celery")
+
+
+@dataclass
+class GenerationRequest:
+    image_path: str
+    profession: str
+    gender: str
+    user_id: int
+    # профиль на момент резервирования попытки; None — исполнитель прочитает его из БД
+    name: str | None = None
+    photo_count: int | None = None
+    limit: int | None = None
+
+    def payload(self) -> dict:
+        return asdict(self)
+
+
+def _norm(s: str) -> str:
+    t = s.lower()
+    t = re.sub(r"[^\w\s]", "", t)
+    return re.sub(r"\s+", " ", t).strip()
+
+def load_accessories_map(path: str) -> dict[str, list[str]]:
+    """Маппинг нормализованная профессия → список аксессуаров из каталога."""
+    acc_df = pd.read_excel(path)
+    acc_df.columns = acc_df.columns.str.strip()
+    acc_df["ПРОФЕССИЯ"] = acc_df["ПРОФЕССИЯ"] \
+        .astype(str) \
+        .str.replace("/", ",", regex=False)
+    acc_df = acc_df.assign(
+        ПРОФЕССИЯ=acc_df["ПРОФЕССИЯ"].str.split(",")
+    ).explode("ПРОФЕССИЯ")
+    acc_df["ПРОФЕССИЯ"] = acc_df["ПРОФЕССИЯ"].str.strip()
+
+    # строим mapping, дублируя аксессуары
+    accessories_map: dict[str, list[str]] = {}
+    for _, row in acc_df.iterrows():
+        prof = _norm(row["ПРОФЕССИЯ"])
+        items: list[str] = []
+        for col in acc_df.columns:
+            if col.startswith("Аксессуар_") and isinstance(row[col], str) and row[col].strip():
+                items.append(row[col].strip())
+        # если одна и та же профессия встречалась несколько раз, последний overwrite дублирует список
+        accessories_map[prof] = items
+    return accessories_map
+
+# загружаем маппинг профессия → список аксессуаров
+_accessories_map = load_accessories_map(ACCESSORIES_FILE)
+
+def build_prompt(profession: str, user_name: str) -> str:
+    """
+    Промпт упаковки: 6 случайных аксессуаров профессии + имя пользователя.
+    При NAME_RENDER имя модели не передаётся — она оставляет пустую табличку (name_render.py).
+    """
+    acc_list = _accessories_map.get(_norm(profession), [])
+
+    # выбираем ровно 6 штук (с повторениями, если мало)
+    if len(acc_list) >= 6:
+        selected = random.sample(acc_list, 6)
+    else:
+        selected = random.choices(acc_list, k=6)
+
+    # Подставляем все переменные в шаблон
+    prompt = PACKAGING_PROMPT_TEMPLATE.format(
+        profession=profession,
+        accessories=", ".join(selected),
+        name="" if NAME_RENDER else user_name
+    )
+    return f"{prompt}\n{NAME_PLATE_PROMPT}" if NAME_RENDER else prompt
+
+
+# кнопка под результатом, пока у пользователя остались попытки
+ANOTHER_BUTTON = {"text": "Другую фигурку", "callback_data": "another"}
+
+
+def result_caption(photo_count: int, limit: int) -> tuple[str, bool]:
+    """Подпись к результату и нужна ли кнопка «Другую фигурку» (остались попытки)."""
+    if photo_count >= limit:
+        # финальное сообщение — без клавиатуры
+        return (
+            "Большое спасибо, что поучаствовали!❤️\n\n"
+            "Вы использовали все доступные попытки.\n\n"
+            "Обязательно ставьте фигурку на аватарку и не меняйте её до окончания акции и объявления победителей — 5 июня! 🤞\n\n"
+            "А если вам понравился результат, поделитесь им и ссылкой на бота с близкими — вдруг они тоже коллекционируют классный мерч.\n\n"
+            "Если что-то пошло не так, жмите /help 🥺"
+        ), False
+    return (
+        "Ваша фигурка готова 🥳 Скорее скачивайте, ставьте на аватарку в Telegram и не меняйте до конца конкурса — 5 июня!\n\n"
+        "И не забудьте поделиться с друзьями, пусть тоже поучаствуют в розыгрыше приза!\n\n"
+        "Если вдруг что-то не так, пишите /help 🥺"
+    ), True
+
+
+class GenerationBackend(ABC):
+    """Где исполняется конвейер генерации; бот работает только с этим интерфейсом."""
+
+    name = ""
+
+    async def start(self) -> None:
+        """Запускает воркеры бэкенда (у остальных бэкендов их нет — и простаивающих дублей тоже)."""
+
+    @abstractmethod
+    async def submit(self, request: GenerationRequest) -> int:
+        """
+        Ставит генерацию; возвращает место в очереди (1 — следующая, 0 — уже выполнена).
+        Если submit бросил исключение, попытка и файл фото остаются за вызывающим.
+        """
+
+    async def position(self, user_id: int) -> int:
+        """Место последней задачи пользователя в очереди, 0 — в очереди её нет."""
+        return 0
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class InProcessBackend(GenerationBackend):
+    """Воркеры api.ImageGenerator в этом процессе; очередь — generator.queue."""
+
+    name = "inprocess"
+
+    def __init__(self, generator):
+        self.generator = generator
+
+    async def start(self) -> None:
+        await self.generator.start()
+
+    async def submit(self, request: GenerationRequest) -> int:
+        return await self.generator.add_task(
+            request.image_path, request.profession, request.gender, request.user_id,
+            name=request.name, photo_count=request.photo_count, limit=request.limit,
+        )
+
+    async def position(self, user_id: int) -> int:
+        return await self.generator.queue.position(user_id)
+
+    async def shutdown(self) -> None:
+        await self.generator.shutdown()
+
+
+class CeleryBackend(GenerationBackend):
+    """
+    Celery-воркеры: задачи ждут в справедливой очереди (fair_queue.py), фоновая задача
+    этого процесса выдаёт их в брокер. Уровень качества выбирается по очереди Celery.
+    """
+
+    name = "celery"
+
+    def __init__(self):
+        # tasks импортирует этот модуль (build_prompt) — импортируем его здесь, а не наверху
+        import tasks
+
+        self.tasks = tasks
+        self._dispatcher: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        from fair_queue import dispatch_forever
+
+        self._dispatcher = asyncio.create_task(dispatch_forever(self.tasks.dispatch_generations))
+
+    async def submit(self, request: GenerationRequest) -> int:
+        # при длинной очереди — более дешёвое качество (degradation.py)
+        tier = await asyncio.to_thread(self.tasks.choose_tier)
+        return await asyncio.to_thread(
+            self.tasks.submit_generation, request.image_path, request.profession, request.gender, request.user_id, tier,
+            name=request.name, photo_count=request.photo_count, limit=request.limit,
+        )
+
+    async def position(self, user_id: int) -> int:
+        return await asyncio.to_thread(self.tasks.generation_position, user_id)
+
+    async def shutdown(self) -> None:
+        # очередь в Redis — невыданные задачи дождутся следующего запуска
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+
+
+class SyncBackend(GenerationBackend):
+    """
+    Весь конвейер ImageGenerator внутри submit(): генерация и доставка закончены к возврату,
+    без очереди и повторов. Ошибка — наружу: превью и файл результата убираются здесь,
+    попытку и фото, как при любом сбое submit, возвращает бот. Для тестов и отладки.
+    """
+
+    name = "sync"
+
+    def __init__(self, generator):
+        self.generator = generator
+        self._next_id = 0
+
+    async def submit(self, request: GenerationRequest) -> int:
+        self._next_id += 1
+        job = Job(self._next_id, request.payload(), 1, str(request.user_id))
+        logger.info("Синхронная генерация для %s", request.user_id)
+        try:
+            await self.generator.process(job)
+        except Exception:
+            # попытку вернёт вызывающий (bot.process_photo), здесь — только следы задачи
+            await self.generator.discard(job)
+            raise
+        return 0
+
+
+BACKENDS = ("inprocess", "celery", "sync")
+
+
+def make_backend(name: str = GENERATION_BACKEND, generator=None) -> GenerationBackend:
+    """Бэкенд по имени; inprocess и sync исполняют задачи через generator (api.ImageGenerator)."""
+    if name == "celery":
+        return CeleryBackend()
+    if name not in BACKENDS:
+        raise ValueError(f"Неизвестный GENERATION_BACKEND {name!r}, есть: {', '.join(BACKENDS)}")
+    if generator is None:
+        raise ValueError(f"Бэкенду {name} нужен ImageGenerator")
+    return InProcessBackend(generator) if name == "inprocess" else SyncBackend(generator)
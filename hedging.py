@@ -0,0 +1,234 @@
+# hedging.py
+
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, AsyncContextManager, Awaitable, Callable, TypeVar
+
+from config import logger
+
+T = TypeVar("T")
+
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "0") == "1"
+# дублируем запрос, если он дольше этого перцентиля недавних задержек
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "90"))
+# максимальная доля дублей среди последних HEDGE_WINDOW запросов
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.1"))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))
+# пока замеров меньше, перцентиль ненадёжен и дублей нет
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+
+
+def _percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def _expected_remaining(latencies: list[float], elapsed: float) -> float:
+    """Сколько в среднем ещё шёл бы запрос, уже длящийся elapsed секунд (по недавним замерам)."""
+    longer = [x for x in latencies if x > elapsed]
+    return sum(longer) / len(longer) - elapsed if longer else 0.0
+
+
+class LocalHedgeStats:
+    """Окно замеров и счётчики в памяти процесса — для ImageGenerator."""
+
+    def __init__(self, window: int = HEDGE_WINDOW):
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._hedged: deque[bool] = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.metrics = {"requests": 0, "hedged": 0, "hedge_wins": 0, "latency_saved_s": 0.0}
+
+    def latencies(self) -> list[float]:
+        with self._lock:
+            return list(self._latencies)
+
+    def hedge_share(self) -> float:
+        with self._lock:
+            return sum(self._hedged) / len(self._hedged) if self._hedged else 0.0
+
+    def record(self, latency: float, hedged: bool, won: bool, saved: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+            self._hedged.append(hedged)
+            self.metrics["requests"] += 1
+            self.metrics["hedged"] += hedged
+            self.metrics["hedge_wins"] += won
+            self.metrics["latency_saved_s"] += saved
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.metrics)
+
+
+class RedisHedgeStats:
+    """
+    То же окно в Redis: у Celery-воркеров (prefork) общие перцентиль,
+    бюджет и метрики. Метрики — в хэше {prefix}:metrics.
+    """
+
+    def __init__(self, redis_client, prefix: str = "hedge", window: int = HEDGE_WINDOW):
+        self.r = redis_client
+        self.prefix = prefix
+        self.window = window
+
+    def latencies(self) -> list[float]:
+        return [float(x) for x in self.r.lrange(f"{self.prefix}:latency", 0, -1)]
+
+    def hedge_share(self) -> float:
+        flags = self.r.lrange(f"{self.prefix}:hedged", 0, -1)
+        return sum(int(x) for x in flags) / len(flags) if flags else 0.0
+
+    def record(self, latency: float, hedged: bool, won: bool, saved: float) -> None:
+        pipe = self.r.pipeline()
+        pipe.lpush(f"{self.prefix}:latency", latency)
+        pipe.ltrim(f"{self.prefix}:latency", 0, self.window - 1)
+        pipe.lpush(f"{self.prefix}:hedged", int(hedged))
+        pipe.ltrim(f"{self.prefix}:hedged", 0, self.window - 1)
+        pipe.hincrby(f"{self.prefix}:metrics", "requests", 1)
+        pipe.hincrby(f"{self.prefix}:metrics", "hedged", int(hedged))
+        pipe.hincrby(f"{self.prefix}:metrics", "hedge_wins", int(won))
+        pipe.hincrbyfloat(f"{self.prefix}:metrics", "latency_saved_s", saved)
+        pipe.execute()
+
+    def snapshot(self) -> dict:
+        raw = self.r.hgetall(f"{self.prefix}:metrics")
+        return {k.decode(): float(v) for k, v in raw.items()}
+
+
+class HedgePolicy:
+    """
+    Хеджирование запросов к OpenAI.
+
+    Если запрос не вернулся за percentile-й перцентиль недавних задержек, запускается
+    дубль (вызывающий сам берёт для него другой API-ключ), побеждает первый успешный
+    ответ, второй отменяется. Дублей не больше budget от последних запросов окна.
+
+    В окно замеров идёт длительность основного запроса. Если первым успел дубль,
+    основной отменён и его полная длительность неизвестна — записывается, сколько он
+    успел проработать: это нижняя граница, а не время победителя, которое занижало бы
+    перцентиль. latency_saved_s в метриках — оценка: сколько в среднем ещё шёл бы
+    основной запрос, судя по недавним запросам дольше уже прошедшего времени.
+    """
+
+    def __init__(self, stats, enabled: bool = HEDGE_ENABLED, percentile: float = HEDGE_PERCENTILE,
+                 budget: float = HEDGE_BUDGET, min_samples: int = HEDGE_MIN_SAMPLES):
+        self.stats = stats
+        self.enabled = enabled
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+
+    def hedge_delay(self) -> float | None:
+        """Через сколько секунд дублировать запрос; None — не дублировать."""
+        if not self.enabled:
+            return None
+        latencies = self.stats.latencies()
+        if len(latencies) < self.min_samples or self.stats.hedge_share() >= self.budget:
+            return None
+        return _percentile(latencies, self.percentile)
+
+    def _finish(self, latency: float, hedged: bool, won: bool) -> None:
+        """latency — сколько шёл основной запрос; если победил дубль, — до его ответа (нижняя граница)."""
+        saved = _expected_remaining(self.stats.latencies(), latency) if won else 0.0
+        self.stats.record(latency, hedged, won, saved)
+        if hedged:
+            logger.info(
+                "Хедж-запрос: %s, основной шёл %.1f с", "дубль успел первым" if won else "основной успел первым", latency
+            )
+
+    async def run_async(self, call: Callable[[int, Any], Awaitable[T]],
+                        slot: Callable[[], AsyncContextManager] | None = None) -> T:
+        """
+        call(attempt, slot) — корутина запроса; attempt 0 — основной, 1 — дубль.
+        slot() — контекст, в котором выполняется каждая попытка (слот limiter-а); его
+        значение передаётся в call. Ожидание в очереди за слотом не входит ни в задержку
+        перед дублем, ни в замеры.
+        """
+        slot = slot or nullcontext
+        delay = self.hedge_delay()
+        started: dict[int, float] = {}
+        running = asyncio.Event()
+
+        async def attempt(n: int) -> T:
+            async with slot() as s:
+                started[n] = time.monotonic()
+                if n == 0:
+                    running.set()
+                return await call(n, s)
+
+        primary = asyncio.create_task(attempt(0))
+        if delay is None:
+            result = await primary
+            self._finish(time.monotonic() - started[0], False, False)
+            return result
+
+        # отсчёт до дубля — с начала самого запроса
+        waiter = asyncio.create_task(running.wait())
+        await asyncio.wait({primary, waiter}, return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            result = primary.result()
+            self._finish(time.monotonic() - started[0], False, False)
+            return result
+
+        hedge = asyncio.create_task(attempt(1))
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # основной успел вместе с дублем — победа его
+                for task in sorted(done, key=lambda t: t is hedge):
+                    if task.exception() is not None:
+                        continue
+                    self._finish(time.monotonic() - started[0], True, task is hedge)
+                    return task.result()
+            # оба запроса упали — отдаём ошибку основного
+            raise primary.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def run_sync(self, call: Callable[[int], T], cancel: Callable[[int], None] | None = None) -> T:
+        """
+        Синхронный вариант для Celery: попытки в потоках. Поток нельзя прервать,
+        поэтому проигравшую попытку останавливает cancel(attempt) — например,
+        закрывает её HTTP-клиент.
+        """
+        started = time.monotonic()
+        delay = self.hedge_delay()
+        if delay is None:
+            result = call(0)
+            self._finish(time.monotonic() - started, False, False)
+            return result
+
+        pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="hedge")
+        try:
+            futures = {pool.submit(call, 0): 0}
+            done, _ = wait(futures, timeout=delay)
+            if not done:
+                futures[pool.submit(call, 1)] = 1
+            pending = set(futures)
+            errors: dict[int, BaseException] = {}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                # основной успел вместе с дублем — победа его
+                for future in sorted(done, key=lambda f: futures[f]):
+                    attempt = futures[future]
+                    if future.exception() is not None:
+                        errors[attempt] = future.exception()
+                        continue
+                    for other in pending:
+                        if cancel is not None:
+                            cancel(futures[other])
+                    self._finish(time.monotonic() - started, len(futures) > 1, attempt == 1)
+                    return future.result()
+            raise errors.get(0) or errors[1]
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
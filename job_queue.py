@@ -0,0 +1,374 @@
+# job_queue.py
+
+import asyncio
+import heapq
+import json
+import os
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+import aiosqlite
+
+from config import logger
+from migrations import column_names
+
+# сколько секунд взятая задача невидима для других воркеров; потом считается брошенной
+JOB_VISIBILITY_TIMEOUT = float(os.getenv("JOB_VISIBILITY_TIMEOUT", "600"))
+# как часто ждущий воркер перепроверяет таблицу (задачи с истёкшей невидимостью)
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+# сколько задач одного пользователя генерируется одновременно; остальные ждут, пока не освободится место
+MAX_INFLIGHT_PER_USER = int(os.getenv("MAX_INFLIGHT_PER_USER", "2"))
+
+
+@dataclass
+class Job:
+    id: int
+    payload: dict
+    attempts: int
+    user_id: str = ""
+    # виртуальная метка справедливой очереди (FairClock)
+    tag: int = 0
+
+
+def job_owner(payload: dict) -> str:
+    """Чей это запрос: ключ справедливой очереди — user_id из payload."""
+    return str(payload.get("user_id", ""))
+
+
+class FairClock:
+    """
+    Справедливый порядок задач между пользователями (start-time fair queuing).
+
+    Каждая задача получает метку max(vtime, последняя метка пользователя) + 1,
+    очередь отдаёт задачи по возрастанию метки, vtime — метка последней взятой.
+    Для задач одинаковой стоимости это круговой обход (DRR с квантом в одну задачу):
+    пользователь с альбомом из десяти фото получает один слот из каждого «круга»,
+    а новичок встаёт в ближайший круг, а не в хвост чужих задач.
+    """
+
+    def __init__(self, vtime: int = 0):
+        self.vtime = vtime
+        self._last: dict[str, int] = {}
+
+    def stamp(self, user_id: str) -> int:
+        tag = max(self.vtime, self._last.get(user_id, 0)) + 1
+        self._last[user_id] = tag
+        return tag
+
+    def served(self, user_id: str, tag: int) -> None:
+        self.vtime = max(self.vtime, tag)
+        # взята последняя задача пользователя — помнить его больше незачем
+        if self._last.get(user_id) == tag:
+            del self._last[user_id]
+
+    def last(self, user_id: str) -> int | None:
+        """Метка последней ещё не взятой задачи пользователя."""
+        return self._last.get(user_id)
+
+    def restore(self, user_id: str, tag: int) -> None:
+        self._last[user_id] = max(self._last.get(user_id, 0), tag)
+
+
+class MemoryJobQueue:
+    """
+    Очередь в памяти с тем же интерфейсом, что и SQLiteJobQueue.
+    Ничего не переживает перезапуск — для локальной отладки и нагрузочных тестов.
+    """
+
+    def __init__(self, max_inflight: int = MAX_INFLIGHT_PER_USER):
+        self.max_inflight = max_inflight
+        # (метка, id, задача) — куча в справедливом порядке (FairClock)
+        self._heap: list[tuple[int, int, Job]] = []
+        self._clock = FairClock()
+        self._taken: dict[int, Job] = {}
+        self._inflight: Counter[str] = Counter()
+        self._wakeup = asyncio.Event()
+        self._next_id = 0
+
+    async def open(self) -> None:
+        pass
+
+    async def put(self, payload: dict) -> int:
+        self._next_id += 1
+        user_id = job_owner(payload)
+        self._push(Job(self._next_id, payload, 0, user_id, self._clock.stamp(user_id)))
+        return self._next_id
+
+    def _push(self, job: Job) -> None:
+        heapq.heappush(self._heap, (job.tag, job.id, job))
+        self._wakeup.set()
+
+    def _pop(self) -> Job | None:
+        """Первая по метке задача пользователя, у которого меньше max_inflight задач в работе."""
+        skipped = []
+        job = None
+        while self._heap:
+            item = heapq.heappop(self._heap)
+            if self._inflight[item[2].user_id] < self.max_inflight:
+                job = item[2]
+                break
+            skipped.append(item)
+        for item in skipped:
+            heapq.heappush(self._heap, item)
+        return job
+
+    async def get(self) -> Job:
+        while (job := self._pop()) is None:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        job.attempts += 1
+        self._clock.served(job.user_id, job.tag)
+        self._inflight[job.user_id] += 1
+        self._taken[job.id] = job
+        return job
+
+    def _untake(self, job_id: int) -> Job | None:
+        job = self._taken.pop(job_id, None)
+        if job is not None:
+            self._inflight[job.user_id] -= 1
+            if self._inflight[job.user_id] <= 0:
+                del self._inflight[job.user_id]
+            # у пользователя освободилось место — его задачи снова можно брать
+            self._wakeup.set()
+        return job
+
+    async def ack(self, job_id: int) -> None:
+        self._untake(job_id)
+
+    async def release(self, job_id: int, delay: float = 0) -> None:
+        job = self._untake(job_id)
+        if job is None:
+            return
+        # метка сохраняется: повтор встаёт на своё прежнее место, а не в хвост
+        if delay:
+            asyncio.get_running_loop().call_later(delay, self._push, job)
+        else:
+            self._push(job)
+
+    def qsize(self) -> int:
+        return len(self._heap)
+
+    async def position(self, user_id) -> int:
+        """Место последней задачи пользователя в очереди (1 — следующая), 0 — в очереди её нет."""
+        last = self._clock.last(str(user_id))
+        if last is None:
+            return 0
+        return sum(1 for tag, _, _ in self._heap if tag <= last)
+
+    async def close(self) -> None:
+        pass
+
+
+class SQLiteJobQueue:
+    """
+    Очередь задач генерации в таблице generation_jobs.
+
+    get() атомарно берёт задачу и делает её невидимой на visibility_timeout;
+    ack() удаляет задачу после доставки, release() возвращает её в очередь
+    (повтор после ошибки или остановка бота). При open() задачи, взятые прошлым
+    процессом и не подтверждённые, сразу возвращаются в очередь — бот один,
+    значит, их никто не обрабатывает. Доставка «хотя бы один раз»: если процесс
+    упал между отправкой фото и ack, фото придёт повторно.
+
+    Взятая задача может долго ждать слот limiter-а, поэтому, пока процесс её держит,
+    невидимость продлевается (_heartbeat), а сам процесс свои задачи повторно не берёт.
+
+    Задачи отдаются в справедливом порядке по пользователям (FairClock, метка в колонке tag),
+    у одного пользователя в работе не больше max_inflight задач.
+    """
+
+    def __init__(self, db_path: str, visibility_timeout: float = JOB_VISIBILITY_TIMEOUT,
+                 poll_interval: float = JOB_POLL_INTERVAL, max_inflight: int = MAX_INFLIGHT_PER_USER):
+        self.db_path = db_path
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+        self.max_inflight = max_inflight
+        self._db: aiosqlite.Connection | None = None
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        # число видимых задач; ведём сами, чтобы qsize() не ходил в БД
+        self._size = 0
+        self._clock = FairClock()
+        # взятые этим процессом задачи → пользователь; после перезапуска все задачи снова видимы
+        self._taken: dict[int, str] = {}
+        self._inflight: Counter[str] = Counter()
+        self._heartbeat_task: asyncio.Task | None = None
+
+    async def open(self) -> None:
+        if self._db is not None:
+            return
+        self._db = await aiosqlite.connect(self.db_path)
+        await self._db.execute("PRAGMA busy_timeout = 5000;")
+        await self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS generation_jobs (
+                id         INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload    TEXT NOT NULL,
+                attempts   INTEGER NOT NULL DEFAULT 0,
+                visible_at REAL NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                user_id    TEXT NOT NULL DEFAULT '',
+                tag        INTEGER NOT NULL DEFAULT 0
+            );
+            """
+        )
+        if "tag" not in await column_names(self._db, "generation_jobs"):
+            # очередь старого формата: владелец — из payload, метка — номер задачи у пользователя,
+            # т. е. оставшиеся задачи сразу раскладываются по кругам
+            await self._db.execute("ALTER TABLE generation_jobs ADD COLUMN user_id TEXT NOT NULL DEFAULT '';")
+            await self._db.execute("ALTER TABLE generation_jobs ADD COLUMN tag INTEGER NOT NULL DEFAULT 0;")
+            await self._db.execute(
+                "UPDATE generation_jobs SET user_id = CAST(json_extract(payload, '$.user_id') AS TEXT);"
+            )
+            await self._db.execute(
+                """
+                UPDATE generation_jobs SET tag = t.turn
+                  FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY id) AS turn
+                          FROM generation_jobs) AS t
+                 WHERE t.id = generation_jobs.id;
+                """
+            )
+        await self._db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_generation_jobs_visible ON generation_jobs(visible_at, id);"
+        )
+        await self._db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_generation_jobs_fair ON generation_jobs(tag, id);"
+        )
+        now = time.time()
+        cur = await self._db.execute(
+            "UPDATE generation_jobs SET visible_at = ? WHERE visible_at > ?;", (now, now)
+        )
+        recovered = cur.rowcount
+        await self._db.commit()
+        cur = await self._db.execute("SELECT COUNT(*), MIN(tag) FROM generation_jobs;")
+        self._size, first_tag = await cur.fetchone()
+        # отсчёт продолжается с самой ранней задачи; новые встанут в её круг
+        self._clock = FairClock(vtime=(first_tag or 1) - 1)
+        async with self._db.execute("SELECT user_id, MAX(tag) FROM generation_jobs GROUP BY user_id;") as cur:
+            async for user_id, tag in cur:
+                self._clock.restore(user_id, tag)
+        if self._size:
+            logger.info("Очередь генерации: %s задач после перезапуска, из них прерванных %s", self._size, recovered)
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def _heartbeat(self) -> None:
+        """Продлевает невидимость задач, взятых этим процессом, пока они в работе."""
+        while True:
+            await asyncio.sleep(self.visibility_timeout / 3)
+            if not self._taken:
+                continue
+            taken = list(self._taken)
+            try:
+                async with self._lock:
+                    await self._db.execute(
+                        f"UPDATE generation_jobs SET visible_at = ? WHERE id IN ({', '.join('?' * len(taken))});",
+                        (time.time() + self.visibility_timeout, *taken),
+                    )
+                    await self._db.commit()
+            except Exception as e:
+                logger.error("Очередь генерации: не удалось продлить невидимость задач: %s", e)
+
+    async def put(self, payload: dict) -> int:
+        user_id = job_owner(payload)
+        async with self._lock:
+            cur = await self._db.execute(
+                "INSERT INTO generation_jobs (payload, visible_at, user_id, tag) VALUES (?, ?, ?, ?);",
+                (json.dumps(payload, ensure_ascii=False), time.time(), user_id, self._clock.stamp(user_id)),
+            )
+            await self._db.commit()
+        self._size += 1
+        self._wakeup.set()
+        return cur.lastrowid
+
+    async def _claim(self) -> Job | None:
+        now = time.time()
+        # пользователи, у которых уже max_inflight задач в работе, пропускаются;
+        # свои задачи в работе — тоже, даже если их невидимость истекла
+        busy = [user_id for user_id, n in self._inflight.items() if n >= self.max_inflight]
+        taken = list(self._taken)
+        skip = f"AND user_id NOT IN ({', '.join('?' * len(busy))})" if busy else ""
+        if taken:
+            skip += f" AND id NOT IN ({', '.join('?' * len(taken))})"
+        async with self._lock:
+            cur = await self._db.execute(
+                f"""
+                UPDATE generation_jobs
+                   SET visible_at = ?, attempts = attempts + 1
+                 WHERE id = (SELECT id FROM generation_jobs
+                              WHERE visible_at <= ? {skip}
+                              ORDER BY tag, id LIMIT 1)
+             RETURNING id, payload, attempts, user_id, tag;
+                """,
+                (now + self.visibility_timeout, now, *busy, *taken),
+            )
+            row = await cur.fetchone()
+            await self._db.commit()
+        if row is None:
+            return None
+        job = Job(row[0], json.loads(row[1]), row[2], row[3], row[4])
+        self._clock.served(job.user_id, job.tag)
+        self._taken[job.id] = job.user_id
+        self._inflight[job.user_id] += 1
+        return job
+
+    async def get(self) -> Job:
+        while True:
+            self._wakeup.clear()
+            job = await self._claim()
+            if job is not None:
+                self._size = max(self._size - 1, 0)
+                return job
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _untake(self, job_id: int) -> None:
+        user_id = self._taken.pop(job_id, None)
+        if user_id is None:
+            return
+        self._inflight[user_id] -= 1
+        if self._inflight[user_id] <= 0:
+            del self._inflight[user_id]
+        # у пользователя освободилось место — его задачи снова можно брать
+        self._wakeup.set()
+
+    async def ack(self, job_id: int) -> None:
+        async with self._lock:
+            await self._db.execute("DELETE FROM generation_jobs WHERE id = ?;", (job_id,))
+            await self._db.commit()
+        self._untake(job_id)
+
+    async def release(self, job_id: int, delay: float = 0) -> None:
+        # метка не меняется: повтор встаёт на своё прежнее место, а не в хвост
+        async with self._lock:
+            await self._db.execute(
+                "UPDATE generation_jobs SET visible_at = ? WHERE id = ?;", (time.time() + delay, job_id)
+            )
+            await self._db.commit()
+        self._size += 1
+        self._untake(job_id)
+
+    def qsize(self) -> int:
+        return self._size
+
+    async def position(self, user_id) -> int:
+        """Место последней задачи пользователя в очереди (1 — следующая), 0 — в очереди её нет."""
+        last = self._clock.last(str(user_id))
+        if last is None:
+            return 0
+        async with self._lock:
+            cur = await self._db.execute(
+                "SELECT COUNT(*) FROM generation_jobs WHERE visible_at <= ? AND tag <= ?;", (time.time(), last)
+            )
+            return (await cur.fetchone())[0]
+
+    async def close(self) -> None:
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+            self._heartbeat_task = None
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
@@ -0,0 +1,5 @@
+"""
+Нагрузочный стенд: локальные заглушки Bot API и OpenAI, симуляция пользователей и отчёт.
+
+Запуск: python -m loadtest --help
+"""
@@ -0,0 +1,227 @@
+"""
+Нагрузочный прогон против локальных заглушек Telegram и OpenAI.
+
+Режимы:
+  bot        — bot.py + Celery-воркер, пользователи проходят весь Form;
+  celery     — только Celery-воркер, задачи ставит generation.CeleryBackend (справедливая очередь)
+               или напрямую generate_image_task.delay (--no-fair);
+  generator  — generation.InProcessBackend: api.ImageGenerator в этом же процессе;
+  sync       — generation.SyncBackend: задачи выполняются по одной прямо при постановке.
+
+Режимы celery, generator и sync — одна нагрузка на разных бэкендах generation.py;
+сравнить их разом: python -m benchmarks.generation_backends.
+
+Примеры:
+  python -m loadtest --mode bot --users 200 --rate 5 --latency 20
+  python -m loadtest --mode generator --users 500 --rate 0 --rate-limit 0.1 --retry-after 3 --json report.json
+  python -m loadtest --mode generator --users 500 --rate 0 --rpm-per-key 30 --workers 4 --max-workers 32
+  python -m loadtest --mode celery --users 500 --rate 0 --latency 5 --celery-profile io-heavy
+  TG_GLOBAL_RATE=5 python -m loadtest --mode celery --users 200 --rate 0 --latency 0.5 --tg-global-rate 5 --tg-chat-rate 1
+  python -m loadtest --mode celery --users 100 --rate 2 --latency 5 --heavy-users 2 --heavy-jobs 50
+  python -m loadtest --mode celery --users 100 --rate 1 --rpm-per-key 20 --batch-share 0.5 --batch-latency 60
+  python -m loadtest --mode sync --users 5 --rate 0 --latency 1
+
+Celery-режимы берут брокер из REDIS_URL конфига — направьте его на отдельный Redis,
+чтобы не смешивать прогон с боевой очередью.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+
+from loadtest.report import Collector, format_summary
+from loadtest.stand import Stand, add_stand_in_args, stand_in_stats, stand_ins_from_args
+from loadtest.users import FIRST_USER_ID, arrivals, wait_figure, walk_form
+
+logger = logging.getLogger("loadtest")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(prog="python -m loadtest", description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--mode", choices=["bot", "celery", "generator", "sync"], default="bot")
+    p.add_argument("--users", type=int, default=50, help="сколько пользователей симулировать")
+    p.add_argument("--rate", type=float, default=2.0, help="приход пользователей в секунду (0 — все сразу)")
+    p.add_argument("--step-timeout", type=float, default=30.0)
+    p.add_argument("--max-workers", type=int, default=0,
+                   help="generator: верхняя граница адаптивной параллельности (0 — фиксированно --workers)")
+    p.add_argument("--celery-profile", help="celery/bot: профиль воркера из celery_app.WORKER_PROFILES "
+                                            "(concurrency профиля важнее --workers)")
+    p.add_argument("--heavy-users", type=int, default=0,
+                   help="celery/generator: столько пользователей в начале прогона ставят по --heavy-jobs задач")
+    p.add_argument("--heavy-jobs", type=int, default=20)
+    p.add_argument("--no-fair", action="store_true",
+                   help="celery: ставить задачи прямо в Celery, минуя справедливую очередь")
+    p.add_argument("--batch-share", type=float, default=0.0,
+                   help="celery: доля пользователей, чья генерация отложена в Batch API (batch_runner.py)")
+    p.add_argument("--batch-max-wait", type=float, default=10.0,
+                   help="сколько секунд задача ждёт, пока наберётся пакет")
+    add_stand_in_args(p)
+    return p.parse_args(argv)
+
+
+def load_professions() -> list[str]:
+    import pandas as pd
+    from config import ACCESSORIES_FILE
+
+    df = pd.read_excel(ACCESSORIES_FILE)
+    df.columns = df.columns.str.strip()
+    names = df["ПРОФЕССИЯ"].dropna().astype(str).str.replace("/", ",", regex=False).str.split(",").str[0]
+    return [n.strip() for n in names if n.strip()]
+
+
+async def run(args: argparse.Namespace) -> dict:
+    tg, oa = stand_ins_from_args(args)
+    professions = load_professions()
+    generator = None
+    backend = None
+    tg_redis = None
+    batches = None
+    heavy = None
+    deferred = None
+    sessions = []
+    flows: list[asyncio.Task] = []
+
+    async with Stand(
+        tg, oa,
+        bot=args.mode == "bot",
+        celery_workers=args.workers if args.mode in ("bot", "celery") else 0,
+        tg_port=args.tg_port,
+        openai_port=args.openai_port,
+        celery_profile=args.celery_profile,
+    ) as stand:
+        redis_before = stand.redis_memory()
+        try:
+            submit = None
+            if args.mode == "celery" and args.no_fair:
+                from tasks import generate_image_task
+
+                def submit(path, prof, gender, uid):
+                    generate_image_task.delay(path, prof, gender, uid)
+
+            elif args.mode == "celery":
+                from generation import CeleryBackend
+
+                # как в bot.py: задачи ждут в справедливой очереди, диспетчер бэкенда выдаёт их в Celery
+                backend = CeleryBackend()
+
+                if args.batch_share:
+                    import redis
+                    from batch_runner import BatchRunner, run_forever
+                    from config import REDIS_URL
+
+                    runner = BatchRunner(redis.Redis.from_url(REDIS_URL), max_wait=args.batch_max_wait)
+                    batches = asyncio.create_task(run_forever(runner, interval=1.0))
+                    deferred = Collector()
+
+            elif args.mode in ("generator", "sync"):
+                from aiogram import Bot
+                from aiogram.client.session.aiohttp import AiohttpSession
+                from aiogram.client.telegram import TelegramAPIServer
+                from api import ImageGenerator
+                from concurrency import AdaptiveLimiter
+                from config import API_KEYS, API_TOKEN, REDIS_URL
+                from generation import make_backend
+                from redis.asyncio import Redis
+                from telegram_client import AsyncTelegramLimiter, RateLimitMiddleware
+
+                bot = Bot(token=API_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(tg.base_url)))
+                sessions.append(bot.session)
+                # как в bot.py: сообщения под общим лимитом Bot API (без Redis — без лимита)
+                tg_redis = Redis.from_url(REDIS_URL)
+                bot.session.middleware(RateLimitMiddleware(AsyncTelegramLimiter(tg_redis)))
+                limiter = AdaptiveLimiter(
+                    args.workers,
+                    min_limit=1 if args.max_workers else args.workers,
+                    max_limit=args.max_workers or args.workers,
+                )
+                generator = ImageGenerator(API_KEYS, bot, stream=args.stream, limiter=limiter)
+                backend = make_backend("inprocess" if args.mode == "generator" else "sync", generator)
+
+            if backend is not None:
+                from generation import GenerationRequest
+
+                await backend.start()
+
+                async def submit(path, prof, gender, uid):
+                    await backend.submit(GenerationRequest(path, prof, gender, uid))
+
+            async def enqueue(uid: int, name: str, collector: Collector, defer: bool = False) -> None:
+                path = os.path.join(stand.tmp_dir, f"{name}.jpg")
+                with open(path, "wb") as f:
+                    f.write(tg.photo_bytes)
+                submitted = time.monotonic()
+                job = (path, random.choice(professions), random.choice(["male", "female"]), uid)
+                result = runner.defer(*job) if defer else submit(*job)
+                if asyncio.iscoroutine(result):
+                    await result
+                flows.append(asyncio.create_task(wait_figure(tg, uid, collector, submitted, args.figure_timeout)))
+
+            stats = Collector()
+            if submit is not None and args.heavy_users:
+                # «альбомы»: несколько пользователей разом забивают очередь своими задачами
+                heavy = Collector()
+                for h in range(args.heavy_users):
+                    uid = FIRST_USER_ID + args.users + h
+                    for j in range(args.heavy_jobs):
+                        await enqueue(uid, f"{uid}_{j}", heavy)
+
+            async for i in arrivals(args.users, args.rate):
+                uid = FIRST_USER_ID + i
+                if args.mode == "bot":
+                    flows.append(asyncio.create_task(
+                        walk_form(tg, uid, random.choice(professions), stats, args.step_timeout, args.figure_timeout)
+                    ))
+                    continue
+                if deferred is not None and random.random() < args.batch_share:
+                    await enqueue(uid, str(uid), deferred, defer=True)
+                    continue
+                await enqueue(uid, str(uid), stats)
+
+            await asyncio.gather(*flows)
+            stats.finish()
+            redis_after = stand.redis_memory()
+        finally:
+            if batches is not None:
+                batches.cancel()
+            if backend is not None:
+                await backend.shutdown()
+            for session in sessions:
+                await session.close()
+            if tg_redis is not None:
+                await tg_redis.aclose()
+
+    extra = {"limiter": generator.limiter.snapshot()} if generator is not None else {}
+    if heavy is not None:
+        # основная статистика — по обычным пользователям, здесь — задачи «альбомов»
+        heavy_summary = heavy.summary()
+        extra["heavy"] = {k: heavy_summary[k] for k in ("users", "delivered", "time_to_figure_s")}
+    if deferred is not None:
+        # основная статистика — по интерактивным пользователям, здесь — отложенные в Batch API
+        deferred_summary = deferred.summary()
+        extra["deferred"] = {k: deferred_summary[k] for k in ("users", "delivered", "time_to_figure_s")}
+    if args.mode in ("bot", "celery") and redis_before and redis_after:
+        extra["redis"] = {
+            "profile": args.celery_profile or "default",
+            "used_memory_delta": redis_after["used_memory"] - redis_before["used_memory"],
+            "result_keys": redis_after["result_keys"] - redis_before["result_keys"],
+        }
+    return stats.summary(mode=args.mode, **extra, **stand_in_stats(tg, oa))
+
+
+def main(argv=None) -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    args = parse_args(argv)
+    summary = asyncio.run(run(args))
+    print(format_summary(summary))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+# loadtest/assets.py
+
+import os
+import struct
+import zlib
+
+
+def _chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+
+def png_bytes(size: int = 64, noise: bool = False) -> bytes:
+    """
+    RGB-картинка size×size в формате PNG без сторонних библиотек.
+    noise=True даёт несжимаемый шум — по объёму он близок к настоящему результату генерации.
+    """
+    if noise:
+        rows = b"".join(b"\x00" + os.urandom(size * 3) for _ in range(size))
+    else:
+        # простой градиент: красный по x, зелёный по y
+        rows = b"".join(
+            b"\x00" + b"".join(bytes((x * 255 // size, y * 255 // size, 128)) for x in range(size))
+            for y in range(size)
+        )
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _chunk(b"IHDR", header)
+        + _chunk(b"IDAT", zlib.compress(rows, 1))
+        + _chunk(b"IEND", b"")
+    )
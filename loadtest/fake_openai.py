@@ -0,0 +1,246 @@
+# loadtest/fake_openai.py
+
+import asyncio
+import base64
+import json
+import logging
+import math
+import random
+import time
+from collections import Counter, deque
+
+from aiohttp import web
+
+from loadtest.assets import png_bytes
+
+logger = logging.getLogger("loadtest")
+
+
+class FakeOpenAI:
+    """
+    Заглушка images.edit (POST /v1/images/edits).
+
+    - latency / latency_sigma: медиана и разброс логнормальной задержки ответа, сек;
+    - rate_limit_ratio: доля запросов, на которые сразу отвечаем 429;
+    - rpm_per_key: лимит запросов в минуту на ключ (0 — без лимита), сверх него тоже 429;
+    - retry_after: значение заголовка Retry-After в ответах 429;
+    - low_quality_factor: во сколько раз быстрее отвечаем на quality=low.
+
+    Запрос с stream=true получает SSE: partial_images промежуточных кадров
+    (PNG 256×256), равномерно распределённых по задержке, и итоговый кадр.
+
+    Batch API (POST /v1/files, POST /v1/batches, GET /v1/batches/{id},
+    GET /v1/files/{id}/content): пакет завершается через batch_latency секунд,
+    доля строк batch_error_rate — с ошибкой 500 в файле ошибок. Лимиты 429 на пакеты
+    не действуют: у Batch API своя квота.
+    """
+
+    def __init__(
+        self,
+        latency: float = 20.0,
+        latency_sigma: float = 0.4,
+        rate_limit_ratio: float = 0.0,
+        rpm_per_key: int = 0,
+        retry_after: float = 2.0,
+        image_bytes: bytes | None = None,
+        low_quality_factor: float = 0.4,
+        batch_latency: float = 30.0,
+        batch_error_rate: float = 0.0
+    ):
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.rate_limit_ratio = rate_limit_ratio
+        self.rpm_per_key = rpm_per_key
+        self.retry_after = retry_after
+        self.low_quality_factor = low_quality_factor
+        self.batch_latency = batch_latency
+        self.batch_error_rate = batch_error_rate
+        self._files: dict[str, bytes] = {}
+        self._batches: dict[str, dict] = {}
+        self.image_b64 = base64.b64encode(image_bytes or png_bytes(1024, noise=True)).decode()
+        self.partial_b64 = base64.b64encode(png_bytes(256)).decode()
+        self.stats: Counter = Counter()
+        self.per_key: Counter = Counter()
+        self.inflight = 0
+        self.max_inflight = 0
+        self._windows: dict[str, deque] = {}
+        self._runner: web.AppRunner | None = None
+        self.base_url = ""
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8082) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/images/edits", self._images_edit)
+        app.router.add_post("/v1/files", self._upload_file)
+        app.router.add_get("/v1/files/{file_id}/content", self._file_content)
+        app.router.add_post("/v1/batches", self._create_batch)
+        app.router.add_get("/v1/batches/{batch_id}", self._get_batch)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self.base_url = f"http://{host}:{port}/v1"
+        logger.info(f"Fake OpenAI слушает {self.base_url}")
+        return self.base_url
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    def _limited(self, key: str) -> bool:
+        if random.random() < self.rate_limit_ratio:
+            return True
+        if not self.rpm_per_key:
+            return False
+        now = time.monotonic()
+        window = self._windows.setdefault(key, deque())
+        while window and now - window[0] > 60:
+            window.popleft()
+        if len(window) >= self.rpm_per_key:
+            return True
+        window.append(now)
+        return False
+
+    def _rate_limited(self) -> web.Response:
+        self.stats["rate_limited"] += 1
+        return web.json_response(
+            {"error": {
+                "message": f"Rate limit reached. Please try again in {self.retry_after}s.",
+                "type": "requests",
+                "code": "rate_limit_exceeded",
+            }},
+            status=429,
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+    def _delay(self, quality: str = "medium") -> float:
+        if self.latency <= 0:
+            return 0.0
+        delay = random.lognormvariate(math.log(self.latency), self.latency_sigma)
+        return delay * self.low_quality_factor if quality == "low" else delay
+
+    async def _images_edit(self, request: web.Request) -> web.StreamResponse:
+        form = await request.post()
+        key = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        self.stats["requests"] += 1
+        self.per_key[key] += 1
+
+        if self._limited(key):
+            return self._rate_limited()
+
+        quality = form.get("quality") or "auto"
+        self.stats[f"quality_{quality}"] += 1
+        if form.get("stream") == "true":
+            return await self._stream(request, int(form.get("partial_images") or 0), quality)
+
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            await asyncio.sleep(self._delay(quality))
+        finally:
+            self.inflight -= 1
+
+        self.stats["ok"] += 1
+        return web.json_response({
+            "created": int(time.time()),
+            "data": [{"b64_json": self.image_b64}],
+        })
+
+    async def _stream(self, request: web.Request, partial_images: int, quality: str) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        delay = self._delay(quality)
+        common = {"created_at": int(time.time()), "size": "1024x1024", "quality": quality,
+                  "background": "opaque", "output_format": "png"}
+
+        async def send(event: dict) -> None:
+            await response.write(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode())
+
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            for i in range(partial_images):
+                await asyncio.sleep(delay / (partial_images + 1))
+                self.stats["partial_images"] += 1
+                await send({"type": "image_edit.partial_image", "partial_image_index": i,
+                            "b64_json": self.partial_b64, **common})
+            await asyncio.sleep(delay / (partial_images + 1))
+        finally:
+            self.inflight -= 1
+
+        self.stats["ok"] += 1
+        await send({"type": "image_edit.completed", "b64_json": self.image_b64, **common,
+                    "usage": {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0,
+                              "input_tokens_details": {"image_tokens": 0, "text_tokens": 0}}})
+        await response.write_eof()
+        return response
+
+    # ---------- Batch API ----------
+
+    def _store_file(self, content: bytes, filename: str, purpose: str) -> dict:
+        file_id = f"file-{len(self._files) + 1}"
+        self._files[file_id] = content
+        return {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed"}
+
+    async def _upload_file(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        upload = form["file"]
+        return web.json_response(self._store_file(upload.file.read(), upload.filename, form.get("purpose", "batch")))
+
+    async def _file_content(self, request: web.Request) -> web.Response:
+        content = self._files.get(request.match_info["file_id"])
+        if content is None:
+            return web.json_response({"error": {"message": "No such file"}}, status=404)
+        return web.Response(body=content, content_type="application/jsonl")
+
+    async def _create_batch(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        if body["input_file_id"] not in self._files:
+            return web.json_response({"error": {"message": "No such file"}}, status=400)
+        batch_id = f"batch_{len(self._batches) + 1}"
+        self._batches[batch_id] = batch = {
+            "id": batch_id, "object": "batch", "endpoint": body["endpoint"], "status": "in_progress",
+            "input_file_id": body["input_file_id"], "completion_window": body["completion_window"],
+            "created_at": int(time.time()), "output_file_id": None, "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        self.stats["batches"] += 1
+        asyncio.create_task(self._run_batch(batch))
+        return web.json_response(batch)
+
+    async def _get_batch(self, request: web.Request) -> web.Response:
+        batch = self._batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return web.json_response({"error": {"message": "No such batch"}}, status=404)
+        return web.json_response(batch)
+
+    async def _run_batch(self, batch: dict) -> None:
+        await asyncio.sleep(self.batch_latency)
+        output, errors = [], []
+        for line in self._files[batch["input_file_id"]].decode().splitlines():
+            if not line.strip():
+                continue
+            req = json.loads(line)
+            self.stats["batch_requests"] += 1
+            if random.random() < self.batch_error_rate:
+                self.stats["batch_failed"] += 1
+                errors.append({"id": f"req_{req['custom_id']}", "custom_id": req["custom_id"], "error": None,
+                               "response": {"status_code": 500, "body": {"error": {"message": "Internal error"}}}})
+                continue
+            output.append({"id": f"req_{req['custom_id']}", "custom_id": req["custom_id"], "error": None,
+                           "response": {"status_code": 200, "body": {
+                               "object": "response", "status": "completed", "model": req["body"]["model"],
+                               "output": [{"type": "image_generation_call", "id": f"ig_{req['custom_id']}",
+                                           "status": "completed", "result": self.image_b64}],
+                           }}})
+
+        def dump(rows: list[dict]) -> str | None:
+            if not rows:
+                return None
+            content = "".join(json.dumps(row) + "\n" for row in rows).encode()
+            return self._store_file(content, "batch_output.jsonl", "batch_output")["id"]
+
+        batch.update(
+            status="completed", completed_at=int(time.time()),
+            output_file_id=dump(output), error_file_id=dump(errors),
+            request_counts={"total": len(output) + len(errors), "completed": len(output), "failed": len(errors)},
+        )
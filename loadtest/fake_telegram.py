@@ -0,0 +1,329 @@
+# loadtest/fake_telegram.py
+
+import asyncio
+import itertools
+import json
+import logging
+import math
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+
+from aiohttp import web
+
+from loadtest.assets import png_bytes
+
+logger = logging.getLogger("loadtest")
+
+BOT_ID = 7000000001
+ADMIN_CHAT_ID = -1001000000001
+
+# методы, на которые действуют лимиты флуда (как у настоящего Bot API — сообщения в чаты)
+FLOOD_PREFIXES = ("send", "edit", "forward", "copy")
+
+
+class _Bucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = time.monotonic()
+
+    def take(self) -> float:
+        """0 — токен списан, иначе через сколько секунд появится следующий."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+@dataclass
+class Outgoing:
+    method: str
+    chat_id: int
+    message_id: int | None
+    params: dict
+    ts: float = field(default_factory=time.monotonic)
+
+
+class FakeTelegram:
+    """
+    Локальная заглушка Bot API.
+
+    Бот забирает апдейты через getUpdates, а всё, что он шлёт в чаты
+    (sendMessage, sendPhoto, sendVideo, edit*…), складывается в очередь
+    соответствующего чата — оттуда её читают симулированные пользователи.
+    Токен не проверяется: бот, Celery-воркер и генератор могут использовать любой.
+
+    global_rate / chat_rate > 0 включают лимиты флуда: сообщения сверх них получают
+    429 с retry_after (счётчик — calls["429"]). error_rate — доля сообщений,
+    на которые заглушка отвечает 502 (calls["502"]).
+    """
+
+    def __init__(self, photo_bytes: bytes | None = None, global_rate: float = 0.0,
+                 chat_rate: float = 0.0, chat_burst: float = 3.0, error_rate: float = 0.0):
+        self.photo_bytes = photo_bytes or png_bytes(512)
+        self.error_rate = error_rate
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global_bucket = _Bucket(global_rate, global_rate) if global_rate else None
+        self._chat_buckets: dict[str, _Bucket] = {}
+        self.calls: Counter = Counter()
+        self.files: dict[str, bytes] = {}
+        self._updates: list[dict] = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._has_updates = asyncio.Event()
+        self._inbox: dict[int, asyncio.Queue] = {}
+        self._last_markup: dict[int, dict] = {}
+        self._runner: web.AppRunner | None = None
+        self.base_url = ""
+
+    # ---------- сервер ----------
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        app.router.add_get("/file/bot{token}/{path:.+}", self._handle_file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self.base_url = f"http://{host}:{port}"
+        logger.info(f"Fake Bot API слушает {self.base_url}")
+        return self.base_url
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _params(self, request: web.Request) -> dict:
+        params: dict = dict(request.query)
+        if request.method != "POST":
+            return params
+        if request.content_type == "application/json":
+            params.update(await request.json())
+            return params
+        form = await request.post()
+        for key, value in form.items():
+            if isinstance(value, web.FileField):
+                params[key] = value.file.read()
+            else:
+                params[key] = value
+        return params
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._params(request)
+        if method.startswith(FLOOD_PREFIXES) and (retry_after := self._flood_wait(params)):
+            self.calls["429"] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {retry_after}",
+                "parameters": {"retry_after": retry_after},
+            }, status=429)
+        if method.startswith(FLOOD_PREFIXES) and random.random() < self.error_rate:
+            self.calls["502"] += 1
+            return web.json_response({"ok": False, "error_code": 502, "description": "Bad Gateway"}, status=502)
+        self.calls[method] += 1
+
+        handler = getattr(self, f"_m_{method}", None)
+        result = await handler(params) if handler else True
+        if isinstance(result, web.Response):
+            return result
+        return web.json_response({"ok": True, "result": result})
+
+    def _flood_wait(self, params: dict) -> int:
+        """retry_after в целых секундах, если сообщение превышает лимит, иначе 0."""
+        wait = 0.0
+        if self.chat_rate and "chat_id" in params:
+            bucket = self._chat_buckets.setdefault(str(params["chat_id"]), _Bucket(self.chat_rate, self.chat_burst))
+            wait = bucket.take()
+        if not wait and self._global_bucket is not None:
+            wait = self._global_bucket.take()
+        return math.ceil(wait)
+
+    async def _handle_file(self, request: web.Request) -> web.Response:
+        file_id = request.match_info["path"].rsplit("/", 1)[-1].split(".")[0]
+        data = self.files.get(file_id)
+        if data is None:
+            return web.Response(status=404)
+        return web.Response(body=data, content_type="application/octet-stream")
+
+    # ---------- объекты Bot API ----------
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    @staticmethod
+    def _chat(chat_id: int) -> dict:
+        if chat_id == ADMIN_CHAT_ID:
+            return {"id": chat_id, "type": "channel", "title": "admins"}
+        return {"id": chat_id, "type": "private", "first_name": f"user{chat_id}"}
+
+    def _message(self, chat_id: int, message_id: int, from_bot: bool = True, **content) -> dict:
+        sender = {"id": BOT_ID, "is_bot": True, "first_name": "loadtest"} if from_bot else self._user(chat_id)
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": self._chat(chat_id),
+            "from": sender,
+            **content,
+        }
+
+    def _new_file(self, data: bytes) -> dict:
+        file_id = f"f{next(self._file_ids)}"
+        self.files[file_id] = data
+        return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(data)}
+
+    # ---------- апдейты от пользователей ----------
+
+    def _push(self, payload: dict) -> None:
+        payload["update_id"] = next(self._update_ids)
+        self._updates.append(payload)
+        self._has_updates.set()
+
+    def push_text(self, user_id: int, text: str) -> None:
+        content = {"text": text}
+        if text.startswith("/"):
+            command = text.split()[0]
+            content["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        self._push({"message": self._message(user_id, next(self._message_ids), from_bot=False, **content)})
+
+    def push_photo(self, user_id: int, data: bytes | None = None) -> None:
+        file = self._new_file(data or self.photo_bytes)
+        photo = [{**file, "width": 1024, "height": 1024}]
+        self._push({"message": self._message(user_id, next(self._message_ids), from_bot=False, photo=photo)})
+
+    def push_callback(self, user_id: int, data: str) -> None:
+        message = self._last_markup.get(user_id) or self._message(user_id, next(self._message_ids))
+        self._push({"callback_query": {
+            "id": str(next(self._update_ids)),
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "message": message,
+            "data": data,
+        }})
+
+    def pending_updates(self) -> int:
+        return len(self._updates)
+
+    # ---------- сообщения от бота ----------
+
+    def inbox(self, chat_id: int) -> asyncio.Queue:
+        return self._inbox.setdefault(chat_id, asyncio.Queue())
+
+    async def expect(self, chat_id: int, methods: set[str], timeout: float) -> Outgoing:
+        """Ждёт ближайшее сообщение в чат с одним из методов methods; остальные пропускает."""
+        inbox = self.inbox(chat_id)
+        deadline = time.monotonic() + timeout
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise asyncio.TimeoutError
+            event = await asyncio.wait_for(inbox.get(), left)
+            if event.method in methods:
+                return event
+
+    def _outgoing(self, method: str, params: dict, **content) -> dict | bool:
+        raw_chat = str(params["chat_id"])
+        # каналы бот адресует по @username — все они считаются админским чатом
+        chat_id = int(raw_chat) if raw_chat.lstrip("-").isdigit() else ADMIN_CHAT_ID
+        message_id = int(params.get("message_id") or 0) or next(self._message_ids)
+        message = self._message(chat_id, message_id, **content)
+
+        markup = params.get("reply_markup")
+        if markup:
+            message["reply_markup"] = json.loads(markup) if isinstance(markup, str) else markup
+            self._last_markup[chat_id] = message
+
+        self.inbox(chat_id).put_nowait(Outgoing(method, chat_id, message_id, params))
+        return message
+
+    # ---------- методы Bot API ----------
+
+    async def _m_getMe(self, params: dict) -> dict:
+        return {"id": BOT_ID, "is_bot": True, "first_name": "loadtest", "username": "loadtest_bot"}
+
+    async def _m_getUpdates(self, params: dict) -> list[dict]:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._has_updates.clear()
+            try:
+                await asyncio.wait_for(self._has_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    async def _m_getChat(self, params: dict) -> dict:
+        return {
+            **self._chat(ADMIN_CHAT_ID),
+            "accent_color_id": 0,
+            "max_reaction_count": 0,
+            "accepted_gift_types": {
+                "unlimited_gifts": False,
+                "limited_gifts": False,
+                "unique_gifts": False,
+                "premium_subscription": False,
+            },
+        }
+
+    async def _m_getChatMember(self, params: dict) -> dict:
+        return {"status": "member", "user": self._user(int(params["user_id"]))}
+
+    async def _m_getFile(self, params: dict) -> dict:
+        file_id = params["file_id"]
+        data = self.files.get(file_id, b"")
+        return {
+            "file_id": file_id,
+            "file_unique_id": file_id,
+            "file_size": len(data),
+            "file_path": f"photos/{file_id}.jpg",
+        }
+
+    async def _m_sendMessage(self, params: dict) -> dict:
+        return self._outgoing("sendMessage", params, text=params.get("text", ""))
+
+    async def _m_sendPhoto(self, params: dict) -> dict:
+        data = params.get("photo")
+        file = self._new_file(data if isinstance(data, bytes) else b"")
+        photo = [{**file, "width": 1024, "height": 1024}]
+        return self._outgoing("sendPhoto", params, photo=photo, caption=params.get("caption", ""))
+
+    async def _m_sendVideo(self, params: dict) -> dict:
+        data = params.get("video")
+        file = self._new_file(data if isinstance(data, bytes) else b"")
+        video = {**file, "width": 640, "height": 640, "duration": 5}
+        return self._outgoing("sendVideo", params, video=video)
+
+    async def _m_sendDocument(self, params: dict) -> dict:
+        data = params.get("document")
+        return self._outgoing("sendDocument", params, document=self._new_file(data if isinstance(data, bytes) else b""))
+
+    async def _m_editMessageText(self, params: dict) -> dict:
+        return self._outgoing("editMessageText", params, text=params.get("text", ""))
+
+    async def _m_editMessageReplyMarkup(self, params: dict) -> dict:
+        return self._outgoing("editMessageReplyMarkup", params)
+
+    async def _m_editMessageMedia(self, params: dict) -> dict:
+        photo = [{**self._new_file(b""), "width": 1024, "height": 1024}]
+        return self._outgoing("editMessageMedia", params, photo=photo)
+
+    async def _m_forwardMessage(self, params: dict) -> dict:
+        return self._outgoing("forwardMessage", params, text="forwarded")
+
+    async def _m_deleteMessage(self, params: dict) -> bool:
+        self._outgoing("deleteMessage", params)
+        return True
@@ -0,0 +1,168 @@
+"""
+Воспроизведение файла нагрузки (см. loadtest.trace) против bot.py, Celery и заглушек.
+
+  python -m loadtest.replay may.jsonl --speed 10 --latency 20 --json run_a.json
+  python -m loadtest.replay --compare run_a.json run_b.json
+
+--speed N проигрывает трассу в N раз быстрее реального времени. Во время прогона
+раз в --sample секунд пишется срез: очередь апдейтов бота, очередь Celery,
+запросы в полёте к OpenAI, доставлено фигурок и p95 времени до фигурки за интервал.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+from loadtest.report import Collector, format_summary, percentile
+from loadtest.stand import Stand, add_stand_in_args, stand_in_stats, stand_ins_from_args
+from loadtest.users import FIRST_USER_ID, expect_figure
+
+logger = logging.getLogger("loadtest")
+
+
+def load_workload(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def push_event(tg, user_id: int, event: dict) -> None:
+    kind = event["event"]
+    if kind == "start":
+        tg.push_text(user_id, "/start")
+    elif kind == "help":
+        tg.push_text(user_id, "/help")
+    elif kind in ("name", "profession"):
+        tg.push_text(user_id, event.get("text") or "врач")
+    elif kind == "not_photo":
+        tg.push_text(user_id, event.get("text") or "фото")
+    elif kind == "gender":
+        tg.push_callback(user_id, f"gender_{event.get('text') or 'male'}")
+    elif kind in ("check_sub", "random_profession", "another"):
+        tg.push_callback(user_id, kind)
+    elif kind == "photo":
+        tg.push_photo(user_id)
+    else:
+        logger.warning(f"Неизвестное событие в трассе: {kind}")
+
+
+async def _wait_figure(tg, user_id: int, stats: Collector, sent: float, timeout: float, delivered: list) -> None:
+    try:
+        now = await expect_figure(tg, user_id, stats, sent, timeout)
+    except asyncio.TimeoutError:
+        # фото сверх лимита попыток фигурку и не должно получить
+        stats.error("no_figure")
+        return
+    stats.figure(now - sent)
+    delivered.append((now, now - sent))
+
+
+async def replay(args: argparse.Namespace) -> dict:
+    events = load_workload(args.workload)
+    tg, oa = stand_ins_from_args(args)
+    stats = Collector()
+    delivered: list[tuple[float, float]] = []
+    timeline: list[dict] = []
+    waiters: list[asyncio.Task] = []
+
+    async with Stand(tg, oa, bot=True, celery_workers=args.workers,
+                     tg_port=args.tg_port, openai_port=args.openai_port) as stand:
+        started = time.monotonic()
+
+        async def sample() -> None:
+            last = time.monotonic()
+            while True:
+                await asyncio.sleep(args.sample)
+                now = time.monotonic()
+                window = [lat for ts, lat in delivered if ts > last]
+                last = now
+                timeline.append({
+                    "t": round(now - started, 1),
+                    "pending_updates": tg.pending_updates(),
+                    "celery_queue": stand.celery_queue_depth(),
+                    "openai_inflight": oa.inflight,
+                    "delivered": len(delivered),
+                    "p95_window_s": percentile(window, 95),
+                })
+
+        sampler = asyncio.create_task(sample())
+        try:
+            seen_users = set()
+            for event in events:
+                delay = started + event["t"] / args.speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                user_id = FIRST_USER_ID + event["user"]
+                if user_id not in seen_users:
+                    seen_users.add(user_id)
+                    stats.user_started()
+                push_event(tg, user_id, event)
+                if event["event"] == "photo":
+                    waiters.append(asyncio.create_task(
+                        _wait_figure(tg, user_id, stats, time.monotonic(), args.figure_timeout, delivered)
+                    ))
+            await asyncio.gather(*waiters)
+            stats.finish()
+        finally:
+            sampler.cancel()
+
+    return stats.summary(
+        workload=args.workload,
+        speed=args.speed,
+        timeline=timeline,
+        **stand_in_stats(tg, oa),
+    )
+
+
+def compare(paths: list[str]) -> str:
+    runs = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            runs.append((path, json.load(f)))
+
+    rows = [
+        ("фигурок в минуту", lambda r: r["figures_per_min"]),
+        ("время до фигурки p50", lambda r: r["time_to_figure_s"]["p50"]),
+        ("время до фигурки p95", lambda r: r["time_to_figure_s"]["p95"]),
+        ("время до фигурки p99", lambda r: r["time_to_figure_s"]["p99"]),
+        ("время до превью p50", lambda r: r.get("time_to_preview_s", {}).get("p50")),
+        ("доля ошибок", lambda r: r["error_rate"]),
+        ("макс. очередь апдейтов", lambda r: max((s["pending_updates"] for s in r.get("timeline", [])), default=None)),
+        ("макс. очередь Celery", lambda r: max((s["celery_queue"] or 0 for s in r.get("timeline", [])), default=None)),
+        ("ответов 429 от OpenAI", lambda r: r.get("openai", {}).get("rate_limited", 0)),
+    ]
+    width = max(len(name) for name, _ in rows)
+    lines = [" " * width + "  " + "  ".join(f"{path:>20}" for path, _ in runs)]
+    for name, getter in rows:
+        values = "  ".join(f"{str(getter(run)):>20}" for _, run in runs)
+        lines.append(f"{name:<{width}}  {values}")
+    return "\n".join(lines)
+
+
+def main(argv=None) -> None:
+    p = argparse.ArgumentParser(prog="python -m loadtest.replay", description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("workload", nargs="?", help="файл нагрузки из loadtest.trace")
+    p.add_argument("--speed", type=float, default=1.0, help="ускорение относительно реального времени")
+    p.add_argument("--sample", type=float, default=5.0, help="период среза очередей, с")
+    p.add_argument("--compare", nargs="+", metavar="REPORT", help="сравнить сохранённые отчёты")
+    add_stand_in_args(p)
+    args = p.parse_args(argv)
+
+    if args.compare:
+        print(compare(args.compare))
+        return
+    if not args.workload:
+        p.error("нужен файл нагрузки или --compare")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    summary = asyncio.run(replay(args))
+    print(format_summary(summary))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# loadtest/report.py
+
+import json
+import math
+import time
+from collections import Counter
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    """Перцентиль методом ближайшего ранга; None для пустой выборки."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, min(len(ordered), math.ceil(q / 100 * len(ordered))))
+    return ordered[rank - 1]
+
+
+class Collector:
+    """Копит результаты прогона: время до фигурки, длительность сценария, ошибки по типам."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished: float | None = None
+        self.users = 0
+        self.time_to_figure: list[float] = []
+        self.time_to_preview: list[float] = []
+        self.flow_time: list[float] = []
+        self.errors: Counter = Counter()
+
+    def user_started(self) -> None:
+        self.users += 1
+
+    def figure(self, time_to_figure: float, flow_time: float | None = None) -> None:
+        self.time_to_figure.append(time_to_figure)
+        if flow_time is not None:
+            self.flow_time.append(flow_time)
+
+    def preview(self, time_to_preview: float) -> None:
+        self.time_to_preview.append(time_to_preview)
+
+    def error(self, kind: str) -> None:
+        self.errors[kind] += 1
+
+    def finish(self) -> None:
+        self.finished = time.monotonic()
+
+    def summary(self, **extra) -> dict:
+        duration = (self.finished or time.monotonic()) - self.started
+        delivered = len(self.time_to_figure)
+        failed = sum(self.errors.values())
+        return {
+            "duration_s": round(duration, 2),
+            "users": self.users,
+            "delivered": delivered,
+            "figures_per_min": round(delivered / duration * 60, 2) if duration else 0.0,
+            "time_to_figure_s": {
+                f"p{q}": _round(percentile(self.time_to_figure, q)) for q in (50, 95, 99)
+            },
+            "time_to_preview_s": {
+                f"p{q}": _round(percentile(self.time_to_preview, q)) for q in (50, 95, 99)
+            },
+            "flow_time_s": {
+                f"p{q}": _round(percentile(self.flow_time, q)) for q in (50, 95, 99)
+            },
+            # доля неудачных попыток среди всех завершённых (фигурка или ошибка)
+            "error_rate": round(failed / (delivered + failed), 4) if delivered + failed else 0.0,
+            "errors": dict(self.errors),
+            **extra,
+        }
+
+
+def _round(value: float | None) -> float | None:
+    return round(value, 3) if value is not None else None
+
+
+def format_summary(summary: dict) -> str:
+    ttf = summary["time_to_figure_s"]
+    lines = [
+        f"Длительность:       {summary['duration_s']} с",
+        f"Пользователей:      {summary['users']}",
+        f"Доставлено фигурок: {summary['delivered']}",
+        f"Фигурок в минуту:   {summary['figures_per_min']}",
+        f"Время до фигурки:   p50={ttf['p50']}  p95={ttf['p95']}  p99={ttf['p99']} с",
+    ]
+    ttp = summary.get("time_to_preview_s", {})
+    if ttp.get("p50") is not None:
+        lines.append(f"Время до превью:    p50={ttp['p50']}  p95={ttp['p95']}  p99={ttp['p99']} с")
+    lines.append(f"Доля ошибок:        {summary['error_rate']:.2%}")
+    for kind, count in sorted(summary["errors"].items()):
+        lines.append(f"  {kind}: {count}")
+    for key in ("heavy", "deferred", "openai", "telegram", "redis"):
+        if key in summary:
+            lines.append(f"{key}: {json.dumps(summary[key], ensure_ascii=False)}")
+    return "\n".join(lines)
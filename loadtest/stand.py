@@ -0,0 +1,189 @@
+# loadtest/stand.py
+
+import argparse
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from loadtest.assets import png_bytes
+from loadtest.fake_openai import FakeOpenAI
+from loadtest.fake_telegram import FakeTelegram
+
+logger = logging.getLogger("loadtest")
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def add_stand_in_args(p: argparse.ArgumentParser) -> None:
+    """Общие для всех прогонов параметры заглушек."""
+    p.add_argument("--workers", type=int, default=4, help="concurrency Celery-воркера / число воркеров генератора")
+    p.add_argument("--latency", type=float, default=20.0, help="медиана задержки images.edit, с")
+    p.add_argument("--latency-sigma", type=float, default=0.4, help="разброс логнормальной задержки")
+    p.add_argument("--rate-limit", type=float, default=0.0, help="доля ответов 429")
+    p.add_argument("--rpm-per-key", type=int, default=0, help="лимит запросов в минуту на ключ (0 — нет)")
+    p.add_argument("--retry-after", type=float, default=2.0, help="Retry-After в ответах 429, с")
+    p.add_argument("--batch-latency", type=float, default=30.0, help="через сколько секунд заглушка завершает пакет Batch API")
+    p.add_argument("--batch-error-rate", type=float, default=0.0, help="доля строк пакета, завершающихся ошибкой")
+    p.add_argument("--tg-global-rate", type=float, default=0.0,
+                   help="лимит заглушки Bot API, сообщений в секунду на бота (0 — нет); сверх него 429")
+    p.add_argument("--tg-chat-rate", type=float, default=0.0, help="то же в один чат")
+    p.add_argument("--tg-error-rate", type=float, default=0.0, help="доля сообщений, на которые заглушка Bot API отвечает 502")
+    p.add_argument("--tg-port", type=int, default=8081)
+    p.add_argument("--openai-port", type=int, default=8082)
+    p.add_argument("--figure-timeout", type=float, default=900.0)
+    p.add_argument("--stream", action="store_true", help="потоковая генерация с превью (GENERATION_STREAM=1)")
+    p.add_argument("--photo-quality", action="store_true",
+                   help="проверка качества фото (PHOTO_QUALITY=1); пользователи шлют зашумлённую картинку, которая её проходит")
+    p.add_argument("--json", help="куда сохранить отчёт в JSON")
+
+
+def stand_ins_from_args(args: argparse.Namespace) -> tuple[FakeTelegram, FakeOpenAI]:
+    # запускаемые bot.py и Celery читают режим из окружения
+    os.environ["GENERATION_STREAM"] = "1" if args.stream else "0"
+    # градиент заглушки проверку резкости не проходит — без флага проверка выключена
+    os.environ["PHOTO_QUALITY"] = "1" if args.photo_quality else "0"
+    tg = FakeTelegram(
+        photo_bytes=png_bytes(512, noise=True) if args.photo_quality else None,
+        global_rate=args.tg_global_rate, chat_rate=args.tg_chat_rate, error_rate=args.tg_error_rate,
+    )
+    return tg, FakeOpenAI(
+        latency=args.latency,
+        latency_sigma=args.latency_sigma,
+        rate_limit_ratio=args.rate_limit,
+        rpm_per_key=args.rpm_per_key,
+        retry_after=args.retry_after,
+        batch_latency=args.batch_latency,
+        batch_error_rate=args.batch_error_rate,
+    )
+
+
+def stand_in_stats(tg: FakeTelegram, oa: FakeOpenAI) -> dict:
+    return {
+        "openai": {**oa.stats, "max_inflight": oa.max_inflight, "per_key": dict(oa.per_key)},
+        "telegram": dict(tg.calls),
+    }
+
+
+class Stand:
+    """
+    Поднимает заглушки Telegram и OpenAI, выставляет переменные окружения,
+    по которым bot.py / tasks.py / api.py идут в заглушки, и запускает нужные процессы.
+
+        async with Stand(tg, oa, bot=True, celery_workers=4) as stand:
+            ...
+    """
+
+    def __init__(
+        self,
+        tg: FakeTelegram,
+        oa: FakeOpenAI,
+        bot: bool = False,
+        celery_workers: int = 0,
+        tg_port: int = 8081,
+        openai_port: int = 8082,
+        celery_profile: str | None = None
+    ):
+        self.tg = tg
+        self.oa = oa
+        self.bot = bot
+        self.celery_workers = celery_workers
+        self.celery_profile = celery_profile
+        self.tg_port = tg_port
+        self.openai_port = openai_port
+        self.tmp_dir = ""
+        self.procs: list[subprocess.Popen] = []
+        self._redis = None
+
+    def _spawn(self, args: list[str]) -> None:
+        logger.info(f"Запускаем: {' '.join(args)}")
+        self.procs.append(subprocess.Popen(args, cwd=ROOT, env=dict(os.environ)))
+
+    async def wait_until(self, predicate, timeout: float, what: str) -> None:
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Не дождались: {what}")
+            for proc in self.procs:
+                if proc.poll() is not None:
+                    raise RuntimeError(f"Процесс {proc.args} завершился с кодом {proc.returncode}")
+            await asyncio.sleep(0.2)
+
+    async def __aenter__(self) -> "Stand":
+        await self.tg.start(port=self.tg_port)
+        await self.oa.start(port=self.openai_port)
+
+        self.tmp_dir = tempfile.mkdtemp(prefix="loadtest_")
+        os.environ.update({
+            "TELEGRAM_API_URL": self.tg.base_url,
+            "OPENAI_BASE_URL": self.oa.base_url,
+            "SHARED_TMP_DIR": self.tmp_dir,
+        })
+
+        if self.celery_workers and not self.bot:
+            # схему обычно приводит к последней версии бот; без него — сами, иначе воркеры упадут на settings
+            from storage import make_storage
+
+            store = make_storage()
+            await store.migrate()
+            await store.close()
+
+        if self.celery_workers:
+            cmd = [sys.executable, "-m", "celery", "-A", "celery_app", "worker", "--loglevel=warning"]
+            if self.celery_profile:
+                os.environ["CELERY_PROFILE"] = self.celery_profile
+            from celery_app import WORKER_PROFILES
+
+            # пул и concurrency берутся из профиля (celery_app.WORKER_PROFILES), если он их задаёт
+            if "worker_concurrency" not in WORKER_PROFILES.get(self.celery_profile or "default", {}):
+                cmd.append(f"--concurrency={self.celery_workers}")
+            self._spawn(cmd)
+        if self.bot:
+            self._spawn([sys.executable, "bot.py"])
+            await self.wait_until(lambda: self.tg.calls["getUpdates"] > 0, 60, "бот начал polling")
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        for proc in self.procs:
+            proc.terminate()
+        for proc in self.procs:
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        await self.tg.stop()
+        await self.oa.stop()
+
+    def _redis_client(self):
+        if self._redis is None:
+            import redis
+            from config import REDIS_URL
+
+            self._redis = redis.Redis.from_url(REDIS_URL, socket_timeout=1)
+        return self._redis
+
+    def celery_queue_depth(self) -> int | None:
+        """Длина очередей Celery (доставки и генерации) в Redis; None, если брокер недоступен."""
+        try:
+            from celery_app import GENERATION_QUEUE
+
+            r = self._redis_client()
+            return r.llen("celery") + r.llen(GENERATION_QUEUE)
+        except Exception:
+            return None
+
+    def redis_memory(self) -> dict | None:
+        """Память Redis и число сохранённых результатов Celery; None, если брокер недоступен."""
+        try:
+            r = self._redis_client()
+            info = r.info("memory")
+            return {
+                "used_memory": info["used_memory"],
+                "result_keys": sum(1 for _ in r.scan_iter("celery-task-meta-*", count=1000)),
+            }
+        except Exception:
+            return None
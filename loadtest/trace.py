@@ -0,0 +1,149 @@
+"""
+Извлечение реального профиля нагрузки из bot.log (или logs/bot.jsonl) в файл нагрузки (JSONL).
+
+Каждая строка результата — одно действие пользователя:
+  {"t": 12.345, "user": 17, "event": "profession", "text": "врач"}
+t — секунды от первого события, user — обезличенный номер пользователя.
+
+  python -m loadtest.trace bot.log -o may.jsonl --since "2025-04-28 10:00" --max-gap 60
+"""
+
+import argparse
+import json
+import re
+import sys
+from datetime import datetime
+
+_LINE = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}) - \w+ - (.*)$")
+
+# шаблон сообщения лога → событие; вторая группа, если есть, — введённый текст
+_EVENTS = [
+    (re.compile(r"^Пользователь (\d+) нажал /start"), "start"),
+    (re.compile(r"^Пользователь (\d+) начал взаимодействие"), "start"),
+    (re.compile(r"^Пользователь (\d+) подписан, перешел"), "check_sub"),
+    (re.compile(r"^Пользователь (\d+) ввел имя: (.*)$"), "name"),
+    (re.compile(r"^Пользователь (\d+) выбрал профессию: (.*)$"), "profession"),
+    (re.compile(r"^Пользователь (\d+) ввел неверную профессию: (.*)$"), "profession"),
+    (re.compile(r"^Пользователь (\d+) получил случайную профессию"), "random_profession"),
+    (re.compile(r"^Пользователь (\d+) выбрал пол: (male|female)"), "gender"),
+    (re.compile(r"^Пользователь (\d+) отправил фото"), "photo"),
+    (re.compile(r"^Пользователь (\d+) достиг лимита фото"), "photo"),
+    (re.compile(r"^Пользователь (\d+) отправил не фото"), "not_photo"),
+    (re.compile(r"^Пользователь (\d+) запросил другую фигурку"), "another"),
+    (re.compile(r"^Пользователь (\d+) запросил помощь"), "help"),
+    (re.compile(r"^/help от (\d+)"), "help"),
+]
+
+
+def decode_line(raw: bytes) -> str:
+    """
+    bot.log писался из разных окружений: часть строк в UTF-8, часть в cp1251,
+    часть — UTF-8, прочитанный как cp1251 и записанный снова («РџРѕР»...»).
+    """
+    try:
+        text = raw.decode("utf-8")
+    except UnicodeDecodeError:
+        return raw.decode("cp1251", errors="replace")
+    if "Р" in text or "С" in text:
+        try:
+            return text.encode("cp1251").decode("utf-8")
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            pass
+    return text
+
+
+def parse_line(line: str) -> tuple[datetime, int, str, str | None] | None:
+    """(время, tg id, событие, текст) или None, если строка — не действие пользователя."""
+    line = line.rstrip("\r\n")
+    if line.startswith("{"):
+        # JSON-строка из log_setup; время в UTC, приводим к локальному, как в старом формате
+        try:
+            record = json.loads(line)
+            ts = datetime.fromisoformat(record["ts"]).astimezone().replace(tzinfo=None)
+            message = record["msg"]
+        except (ValueError, KeyError, TypeError):
+            return None
+    else:
+        m = _LINE.match(line)
+        if not m:
+            return None
+        ts = datetime.strptime(m.group(1), "%Y-%m-%d %H:%M:%S,%f")
+        message = m.group(2)
+    for pattern, event in _EVENTS:
+        em = pattern.match(message)
+        if em:
+            text = em.group(2).strip() if em.lastindex and em.lastindex > 1 else None
+            return ts, int(em.group(1)), event, text
+    return None
+
+
+def extract(
+    paths: list[str],
+    since: datetime | None = None,
+    until: datetime | None = None,
+    max_gap: float | None = None
+) -> list[dict]:
+    """
+    Читает логи и возвращает события по порядку времени.
+    max_gap сжимает простои длиннее max_gap секунд (ночи, перезапуски) до max_gap.
+    """
+    records = []
+    for path in paths:
+        with open(path, "rb") as f:
+            for raw in f:
+                parsed = parse_line(decode_line(raw))
+                if not parsed:
+                    continue
+                ts = parsed[0]
+                if (since and ts < since) or (until and ts > until):
+                    continue
+                records.append(parsed)
+    records.sort(key=lambda r: r[0])
+
+    users: dict[int, int] = {}
+    events = []
+    t = 0.0
+    prev = None
+    for ts, tg_id, event, text in records:
+        if prev is not None:
+            gap = (ts - prev).total_seconds()
+            t += min(gap, max_gap) if max_gap is not None else gap
+        prev = ts
+        item = {"t": round(t, 3), "user": users.setdefault(tg_id, len(users)), "event": event}
+        if event == "name":
+            item["text"] = f"Имя{item['user']}"  # настоящие имена в файл нагрузки не попадают
+        elif text is not None:
+            item["text"] = text
+        events.append(item)
+    return events
+
+
+def _dt(value: str) -> datetime:
+    return datetime.fromisoformat(value)
+
+
+def main(argv=None) -> None:
+    p = argparse.ArgumentParser(prog="python -m loadtest.trace", description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("logs", nargs="+", help="файлы логов бота")
+    p.add_argument("-o", "--output", help="файл нагрузки (по умолчанию stdout)")
+    p.add_argument("--since", type=_dt, help="начало окна, например '2025-04-28 10:00'")
+    p.add_argument("--until", type=_dt, help="конец окна")
+    p.add_argument("--max-gap", type=float, help="сжимать простои длиннее N секунд")
+    args = p.parse_args(argv)
+
+    events = extract(args.logs, args.since, args.until, args.max_gap)
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for item in events:
+            out.write(json.dumps(item, ensure_ascii=False) + "\n")
+    finally:
+        if args.output:
+            out.close()
+    users = len({e["user"] for e in events})
+    duration = events[-1]["t"] if events else 0
+    print(f"{len(events)} событий, {users} пользователей, {duration:.0f} с", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
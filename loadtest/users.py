@@ -0,0 +1,104 @@
+# loadtest/users.py
+
+import asyncio
+import json
+import random
+import time
+
+from loadtest.fake_telegram import FakeTelegram, Outgoing
+from loadtest.report import Collector
+from preview import PREVIEW_CAPTION
+
+# id симулированных пользователей не пересекаются с настоящими
+FIRST_USER_ID = 9_000_000_000
+
+# ответы бота на шагах сценария
+_REPLY = {"sendMessage", "editMessageText"}
+# фигурка приходит новым фото или заменой превью (потоковая генерация)
+_FIGURE = {"sendPhoto", "editMessageMedia"}
+
+
+def _caption(out: Outgoing) -> str:
+    if out.method == "editMessageMedia":
+        media = out.params.get("media") or {}
+        if isinstance(media, str):
+            media = json.loads(media)
+        return media.get("caption") or ""
+    return out.params.get("caption") or ""
+
+
+async def expect_figure(tg: FakeTelegram, user_id: int, stats: Collector, sent: float, timeout: float) -> float:
+    """
+    Ждёт итоговую фигурку; превью (подпись PREVIEW_CAPTION) пропускает,
+    записав время до первого из них. Возвращает момент доставки фигурки.
+    """
+    deadline = time.monotonic() + timeout
+    seen_preview = False
+    while True:
+        out = await tg.expect(user_id, _FIGURE, deadline - time.monotonic())
+        if _caption(out) != PREVIEW_CAPTION:
+            return out.ts
+        if not seen_preview:
+            seen_preview = True
+            stats.preview(out.ts - sent)
+
+
+async def walk_form(
+    tg: FakeTelegram,
+    user_id: int,
+    profession: str,
+    stats: Collector,
+    step_timeout: float = 30.0,
+    figure_timeout: float = 600.0
+) -> None:
+    """
+    Один пользователь проходит весь Form: /start → имя → профессия → пол → фото
+    и ждёт фигурку (sendPhoto). Каждый шаг ждёт ответ бота не дольше step_timeout.
+    """
+    stats.user_started()
+    started = time.monotonic()
+    steps = [
+        ("start", lambda: tg.push_text(user_id, "/start")),
+        ("name", lambda: tg.push_text(user_id, f"Тест{user_id % 1000}")),
+        ("profession", lambda: tg.push_text(user_id, profession)),
+        ("gender", lambda: tg.push_callback(user_id, random.choice(["gender_male", "gender_female"]))),
+    ]
+    step = "start"
+    try:
+        for step, action in steps:
+            action()
+            await tg.expect(user_id, _REPLY, step_timeout)
+
+        step = "figure"
+        photo_sent = time.monotonic()
+        tg.push_photo(user_id)
+        delivered = await expect_figure(tg, user_id, stats, photo_sent, figure_timeout)
+        stats.figure(delivered - photo_sent, delivered - started)
+    except asyncio.TimeoutError:
+        stats.error(f"timeout:{step}")
+    except Exception as e:
+        stats.error(f"{step}:{type(e).__name__}")
+
+
+async def wait_figure(
+    tg: FakeTelegram,
+    user_id: int,
+    stats: Collector,
+    submitted: float,
+    figure_timeout: float = 600.0
+) -> None:
+    """Ждёт фигурку для задачи, поставленной в очередь напрямую (без бота)."""
+    stats.user_started()
+    try:
+        delivered = await expect_figure(tg, user_id, stats, submitted, figure_timeout)
+        stats.figure(delivered - submitted)
+    except asyncio.TimeoutError:
+        stats.error("timeout:figure")
+
+
+async def arrivals(count: int, rate: float):
+    """Моменты прихода пользователей: пуассоновский поток с интенсивностью rate в секунду (0 — все сразу)."""
+    for i in range(count):
+        yield i
+        if rate > 0:
+            await asyncio.sleep(random.expovariate(rate))
@@ -0,0 +1,254 @@
+# log_setup.py
+
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+LOG_DIR = os.getenv("LOG_DIR", "logs")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "midnight")
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "14"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "50000"))
+
+# поля, которые попадают в JSON, если переданы через extra= или контекст
+STRUCTURED_FIELDS = ("user_id", "job_id", "event", "tier", "attempt", "duration_ms")
+
+_context: contextvars.ContextVar[dict] = contextvars.ContextVar("log_context", default={})
+
+
+# --------------------
+# Контекст: user_id / job_id для всех записей внутри обработчика
+# --------------------
+def bind_log_context(**fields) -> None:
+    """Добавляет поля в контекст до конца текущей задачи (или до clear_log_context)."""
+    _context.set({**_context.get(), **{k: v for k, v in fields.items() if v is not None}})
+
+
+def clear_log_context() -> None:
+    _context.set({})
+
+
+@contextmanager
+def log_context(**fields):
+    token = _context.set({**_context.get(), **{k: v for k, v in fields.items() if v is not None}})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in _context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+# --------------------
+# Сэмплирование повторяющихся сообщений
+# --------------------
+class SamplingFilter(logging.Filter):
+    """
+    Ограничивает поток одинаковых сообщений (ключ — логгер, шаблон msg и user_id,
+    так что действия разных пользователей друг друга не вытесняют, а «Update ... is not
+    handled» без пользователя сэмплируется целиком).
+
+    В каждом окне window секунд первые burst записей проходят как есть,
+    дальше проходит каждая sample_every-я. Пропущенные записи не теряются бесследно:
+    следующая прошедшая запись с тем же ключом несёт поле suppressed.
+    WARNING и выше не сэмплируются.
+    """
+
+    def __init__(self, window: float = 1.0, burst: int = 20, sample_every: int = 100):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.sample_every = sample_every
+        self._state: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, str(record.msg), getattr(record, "user_id", None))
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.get(key)
+            if state is None or now - state[0] >= self.window:
+                suppressed = state[2] if state else 0
+                state = [now, 0, suppressed]
+                self._state[key] = state
+                if len(self._state) > 10_000:
+                    self._state.clear()
+            state[1] += 1
+            count = state[1]
+            if count > self.burst and (count - self.burst) % self.sample_every:
+                state[2] += 1
+                return False
+            if state[2]:
+                record.suppressed = state[2]
+                state[2] = 0
+        return True
+
+
+# --------------------
+# Форматирование и запись
+# --------------------
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in STRUCTURED_FIELDS + ("suppressed",):
+            value = getattr(record, key, None)
+            if value is not None:
+                data[key] = value
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        elif record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """Ротация по времени (when) и дополнительно по размеру (max_bytes)."""
+
+    def __init__(self, filename: str, when: str, backup_count: int, max_bytes: int):
+        super().__init__(filename, when=when, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.max_bytes = max_bytes
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if super().shouldRollover(record):
+            return True
+        if self.max_bytes and self.stream is not None:
+            return self.stream.tell() >= self.max_bytes
+        return False
+
+    def rotation_filename(self, default_name: str) -> str:
+        # при ротации по размеру в пределах одного периода имя по времени совпадает —
+        # добавляем номер, иначе TimedRotatingFileHandler удалил бы предыдущий файл
+        name, n = default_name, 0
+        while os.path.exists(name):
+            n += 1
+            name = f"{default_name}.{n}"
+        return super().rotation_filename(name)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler, который никогда не блокирует event loop: форматирование и запись
+    делает поток QueueListener, а при переполнении очереди запись отбрасывается.
+    """
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # в отличие от базового prepare, не форматируем запись целиком — только подставляем args
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: logging.handlers.QueueListener | None = None
+# процесс, в котором запущен _listener, и аргументы setup_logging — для перезапуска после fork
+_listener_pid: int | None = None
+_setup_args: tuple | None = None
+
+
+def setup_logging(name: str, *loggers: logging.Logger, console: bool = True) -> logging.handlers.QueueListener:
+    """
+    Переводит логирование процесса на JSON-строки в {LOG_DIR}/{name}.jsonl через очередь.
+
+    Обработчики корневого логгера и переданных loggers снимаются; записи идут
+    в NonBlockingQueueHandler, а в файл (и, если console, в stderr) их пишет
+    отдельный поток. Повторный вызов возвращает уже запущенный listener; в процессе,
+    порождённом fork (prefork-воркеры Celery), очередь и поток создаются заново.
+    """
+    global _listener, _listener_pid, _setup_args
+    if _listener is not None and _listener_pid == os.getpid():
+        return _listener
+
+    os.makedirs(LOG_DIR, exist_ok=True)
+    file_handler = SizeAndTimeRotatingFileHandler(
+        os.path.join(LOG_DIR, f"{name}.jsonl"),
+        when=LOG_ROTATE_WHEN,
+        backup_count=LOG_BACKUP_COUNT,
+        max_bytes=LOG_MAX_BYTES,
+    )
+    file_handler.setFormatter(JSONFormatter())
+    handlers: list[logging.Handler] = [file_handler]
+    if console:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+        handlers.append(stream_handler)
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    for lg in (root, *loggers):
+        for h in list(lg.handlers):
+            lg.removeHandler(h)
+        if lg is not root:
+            lg.propagate = True
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    if _listener_pid is None:
+        atexit.register(shutdown_logging)
+    _listener_pid = os.getpid()
+    _setup_args = (name, loggers, console)
+    return _listener
+
+
+def _restart_after_fork() -> None:
+    """
+    Дочерний процесс наследует NonBlockingQueueHandler, но не поток QueueListener:
+    без перезапуска его записи копились бы в очереди, которую никто не читает.
+    """
+    global _listener
+    if _setup_args is not None:
+        # поток родителя в этом процессе не существует — останавливать нечего
+        _listener = None
+        name, loggers, console = _setup_args
+        setup_logging(name, *loggers, console=console)
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def shutdown_logging() -> None:
+    """Дописывает очередь и останавливает поток записи; безопасно вызывать повторно."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,110 @@
+"""
+Перенос данных бота из SQLite (users.db) в PostgreSQL.
+
+  python migrate_storage.py --sqlite users.db --dsn postgresql://bot@localhost:5432/bot
+
+Схема PostgreSQL создаётся миграциями storage.py; таблицы назначения должны быть
+пустыми (--truncate — очистить их перед переносом). Строки копируются пачками
+через COPY, в конце количество строк сверяется с источником. Бота на время
+переноса лучше остановить, затем запустить с STORAGE_BACKEND=postgres.
+"""
+
+import argparse
+import asyncio
+import sqlite3
+import time
+from datetime import datetime
+
+from config import DB_PATH, logger
+from storage import DATABASE_URL, PostgresStorage, SQLiteStorage
+
+# таблица → колонки; даты в SQLite — текст, в PostgreSQL — timestamp
+TABLES = {
+    "admins": ("user_id",),
+    "users": (
+        "user_id", "name", "profession", "gender", "photo_count",
+        "created_at", "updated_at", "allowed_generations", "last_photo_id",
+    ),
+    "subscriptions": ("user_id", "subscribed_at"),
+    "settings": ("key", "value"),
+}
+TIMESTAMP_COLUMNS = {"created_at", "updated_at", "subscribed_at"}
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--sqlite", default=DB_PATH, help="исходный users.db")
+    p.add_argument("--dsn", default=DATABASE_URL, help="PostgreSQL назначения")
+    p.add_argument("--batch", type=int, default=5000, help="строк в одном COPY")
+    p.add_argument("--truncate", action="store_true", help="очистить таблицы назначения")
+    return p.parse_args(argv)
+
+
+def _timestamp(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        logger.warning("Непонятная дата %r — переносим как NULL", value)
+        return None
+
+
+def _convert(columns: tuple[str, ...], row: tuple) -> tuple:
+    return tuple(
+        _timestamp(value) if column in TIMESTAMP_COLUMNS else value
+        for column, value in zip(columns, row)
+    )
+
+
+async def copy_table(conn, source: sqlite3.Connection, table: str, batch: int) -> int:
+    columns = TABLES[table]
+    cur = source.execute(f"SELECT {', '.join(columns)} FROM {table};")
+    copied = 0
+    while rows := cur.fetchmany(batch):
+        await conn.copy_records_to_table(
+            table, records=[_convert(columns, row) for row in rows], columns=list(columns)
+        )
+        copied += len(rows)
+    return copied
+
+
+async def run(args: argparse.Namespace) -> None:
+    # источник приводим к последней схеме: личные лимиты, settings и т. д.
+    await SQLiteStorage(args.sqlite).migrate()
+    target = PostgresStorage(args.dsn, min_size=1, max_size=1)
+    await target.migrate()
+
+    source = sqlite3.connect(args.sqlite)
+    try:
+        async with target.pool.acquire() as conn:
+            if args.truncate:
+                await conn.execute(f"TRUNCATE {', '.join(TABLES)}")
+            for table in TABLES:
+                if await conn.fetchval(f"SELECT EXISTS (SELECT 1 FROM {table})"):
+                    raise SystemExit(f"Таблица {table} в PostgreSQL не пуста — запустите с --truncate")
+
+            # всё в одной транзакции: оборвался перенос — назначение остаётся пустым
+            async with conn.transaction():
+                for table in TABLES:
+                    started = time.monotonic()
+                    copied = await copy_table(conn, source, table, args.batch)
+                    logger.info("%s: %s строк за %.1f с", table, copied, time.monotonic() - started)
+
+            for table in TABLES:
+                expected = source.execute(f"SELECT COUNT(*) FROM {table};").fetchone()[0]
+                actual = await conn.fetchval(f"SELECT COUNT(*) FROM {table}")
+                if expected != actual:
+                    raise SystemExit(f"{table}: в SQLite {expected} строк, в PostgreSQL {actual}")
+            await conn.execute(f"ANALYZE {', '.join(TABLES)}")
+    finally:
+        source.close()
+        await target.close()
+    logger.info("Перенос завершён")
+
+
+if __name__ == "__main__":
+    from log_setup import setup_logging
+
+    setup_logging("migrate_storage", logger)
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,63 @@
+# migrations.py
+
+import logging
+from typing import Awaitable, Callable
+
+import aiosqlite
+
+# общий для bot.py и db.py (у db.py своя БД и нет config), поэтому обычный logging
+logger = logging.getLogger(__name__)
+
+Migration = Callable[[aiosqlite.Connection], Awaitable[None]]
+
+
+def sql(*statements: str) -> Migration:
+    """Шаг миграции из готовых SQL-запросов."""
+
+    async def step(db: aiosqlite.Connection) -> None:
+        for statement in statements:
+            await db.execute(statement)
+
+    return step
+
+
+async def column_names(db: aiosqlite.Connection, table: str) -> set[str]:
+    cur = await db.execute(f"PRAGMA table_info({table});")
+    return {row[1] for row in await cur.fetchall()}
+
+
+async def migrate(db: aiosqlite.Connection, steps: list[Migration], name: str = "db") -> int:
+    """
+    Применяет шаги, которых ещё не было в этой БД; версия схемы — PRAGMA user_version
+    (номер последнего применённого шага, у новой БД 0).
+
+    Каждый шаг выполняется в своей транзакции BEGIN IMMEDIATE вместе с записью версии:
+    упавший шаг откатывается целиком, а два процесса, стартующих одновременно,
+    не применят его дважды — второй дождётся блокировки и увидит новую версию.
+    Шаги только дописываются в конец списка; менять уже выпущенные нельзя.
+    """
+    await db.execute("PRAGMA busy_timeout = 5000;")
+    cur = await db.execute("PRAGMA user_version;")
+    version = (await cur.fetchone())[0]
+    if version > len(steps):
+        logger.warning("Схема %s новее кода: версия %s, известно шагов %s", name, version, len(steps))
+        return version
+
+    while version < len(steps):
+        await db.execute("BEGIN IMMEDIATE;")
+        try:
+            cur = await db.execute("PRAGMA user_version;")
+            version = (await cur.fetchone())[0]
+            if version >= len(steps):
+                await db.rollback()
+                break
+            await steps[version](db)
+            version += 1
+            # PRAGMA не принимает параметры; version — наше целое число
+            await db.execute(f"PRAGMA user_version = {version};")
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+        logger.info("Схема %s: применена миграция %s", name, version)
+    return version
@@ -0,0 +1,118 @@
+# name_render.py
+
+import base64
+import io
+import os
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from process_pool import LazyProcessPool
+
+# Имя на упаковке рисуем сами, а не доверяем модели: она путает буквы в {name},
+# и каждая такая ошибка — /help и ещё одна полная генерация. Модель оставляет
+# место для имени пустым (NAME_PLATE_PROMPT в промпте), а поверх результата мы
+# кладём плашку цвета упаковки и имя шрифтом из fonts/. NAME_BOX по умолчанию
+# подобран под макет референсов (Для него.png / Для нее.png): имя крупно
+# белым над профессией; другой макет — другой NAME_BOX.
+NAME_RENDER = os.getenv("NAME_RENDER", "0") == "1"
+NAME_FONT = os.getenv(
+    "NAME_FONT", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts", "DejaVuSans-Bold.ttf")
+)
+# место для имени в долях кадра: левый, верхний, правый, нижний край
+NAME_BOX = tuple(float(v) for v in os.getenv("NAME_BOX", "0.33,0.06,0.9,0.18").split(","))
+# auto — фон упаковки, продолженный от левого края NAME_BOX к правому: плашка
+# сливается с фоном (и с его светотенью) и закрывает, если модель всё же что-то написала
+NAME_PLATE_COLOR = os.getenv("NAME_PLATE_COLOR", "auto")
+NAME_TEXT_COLOR = os.getenv("NAME_TEXT_COLOR", "#ffffff")
+# left или center
+NAME_ALIGN = os.getenv("NAME_ALIGN", "left")
+# процессов в пуле бота (ImageGenerator); Celery рисует в своём воркере
+NAME_RENDER_WORKERS = int(os.getenv("NAME_RENDER_WORKERS", "2"))
+# добавляется к промпту вместо имени
+NAME_PLATE_PROMPT = os.getenv(
+    "NAME_PLATE_PROMPT",
+    "Не пиши имя на упаковке: место, где оно должно быть (крупно над профессией), "
+    "оставь пустым, только фон упаковки без текста — имя будет нанесено отдельно.",
+)
+
+# текст занимает не больше этих долей плашки
+_TEXT_WIDTH = 0.95
+_TEXT_HEIGHT = 0.8
+_MIN_FONT_SIZE = 10
+# сумма разниц по каналам, при которой правый край считается уже не фоном упаковки
+_EDGE_JUMP = 90
+
+
+@lru_cache(maxsize=64)
+def _font(size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(NAME_FONT, size)
+
+
+def _fit(draw: ImageDraw.ImageDraw, name: str, width: float, height: float) -> tuple[str, ImageFont.FreeTypeFont]:
+    """Самый крупный кегль, при котором имя помещается; не помещается и в минимальном — обрезаем с «…»."""
+    size = max(int(height * _TEXT_HEIGHT), _MIN_FONT_SIZE)
+    while size > _MIN_FONT_SIZE and draw.textlength(name, font=_font(size)) > width * _TEXT_WIDTH:
+        size -= max(size // 10, 1)
+    font = _font(size)
+    text = name
+    while len(text) > 1 and draw.textlength(text, font=font) > width * _TEXT_WIDTH:
+        text = text[:-2] + "…"
+    return text, font
+
+
+def _background(img: Image.Image, box: tuple[int, int, int, int]) -> Image.Image:
+    """
+    Фон под имя: каждая строка — плавный переход от пикселя левого края box к пикселю правого.
+    Справа уже не упаковка (цвет резко другой) — строка заливается цветом левого края.
+    """
+    x0, y0, x1, y1 = box
+    pixels = np.asarray(img, dtype=np.float32)
+    # box у края кадра: берём крайний столбец, а не соседний (его нет или он с другой стороны)
+    left, right = pixels[y0:y1, max(x0 - 1, 0)], pixels[y0:y1, min(x1, img.width - 1)]
+    right = np.where(np.abs(right - left).sum(axis=1, keepdims=True) > _EDGE_JUMP, left, right)
+    t = np.linspace(0.0, 1.0, x1 - x0, dtype=np.float32)[None, :, None]
+    plate = left[:, None] * (1 - t) + right[:, None] * t
+    return Image.fromarray(plate.round().astype(np.uint8))
+
+
+def render_name(data: bytes, name: str) -> bytes:
+    """PNG результата → PNG с плашкой NAME_BOX и именем на ней."""
+    with Image.open(io.BytesIO(data)) as img:
+        img = img.convert("RGB")
+    w, h = img.size
+    box = (round(NAME_BOX[0] * w), round(NAME_BOX[1] * h), round(NAME_BOX[2] * w), round(NAME_BOX[3] * h))
+    plate_h = box[3] - box[1]
+    if NAME_PLATE_COLOR == "auto":
+        img.paste(_background(img, box), box[:2])
+    draw = ImageDraw.Draw(img)
+    if NAME_PLATE_COLOR != "auto":
+        draw.rounded_rectangle(box, radius=plate_h * 0.15, fill=NAME_PLATE_COLOR)
+    text, font = _fit(draw, name.strip(), box[2] - box[0], plate_h)
+    y = (box[1] + box[3]) / 2
+    if NAME_ALIGN == "center":
+        draw.text(((box[0] + box[2]) / 2, y), text, font=font, fill=NAME_TEXT_COLOR, anchor="mm")
+    else:
+        draw.text((box[0], y), text, font=font, fill=NAME_TEXT_COLOR, anchor="lm")
+    out = io.BytesIO()
+    # сжатие послабее: ответ OpenAI — 1–2 Мп, а Telegram всё равно пережмёт фото
+    img.save(out, format="PNG", compress_level=3)
+    return out.getvalue()
+
+
+def render_name_b64(b64: str, name: str) -> str:
+    """То же для base64-ответа OpenAI (Celery-воркеры и Batch API)."""
+    return base64.b64encode(render_name(base64.b64decode(b64), name)).decode()
+
+
+_pool = LazyProcessPool(NAME_RENDER_WORKERS)
+
+
+async def render_name_async(data: bytes, name: str) -> bytes:
+    """render_name в пуле процессов — разбор и сжатие PNG не держат event loop бота."""
+    return await _pool.run(render_name, data, name)
+
+
+def shutdown() -> None:
+    _pool.shutdown()
@@ -0,0 +1,127 @@
+# photo_quality.py
+
+import os
+from dataclasses import dataclass
+
+import numpy as np
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from config import logger
+from process_pool import LazyProcessPool
+
+# Проверка фото до генерации: размытое, крошечное или чёрное фото стоит полноценного
+# images.edit и попытки, а потом — /help и повторной генерации. Явно негодные отклоняем
+# сразу и объясняем почему. Пороги консервативные: сомнительное фото лучше пропустить.
+PHOTO_QUALITY = os.getenv("PHOTO_QUALITY", "1") == "1"
+# короткая сторона, px: меньше — лицо на фигурке не получится
+PHOTO_MIN_SIDE = int(os.getenv("PHOTO_MIN_SIDE", "320"))
+# дисперсия лапласиана на кадре, уменьшенном до PHOTO_ANALYSIS_SIDE: меньше — фото размыто
+PHOTO_MIN_SHARPNESS = float(os.getenv("PHOTO_MIN_SHARPNESS", "20"))
+# средняя яркость 0..255: за пределами — слишком тёмное или пересвеченное
+PHOTO_MIN_BRIGHTNESS = float(os.getenv("PHOTO_MIN_BRIGHTNESS", "35"))
+PHOTO_MAX_BRIGHTNESS = float(os.getenv("PHOTO_MAX_BRIGHTNESS", "225"))
+# проверка лица каскадом Хаара (нужен opencv-python-headless; без него пропускается)
+PHOTO_FACE_CHECK = os.getenv("PHOTO_FACE_CHECK", "0") == "1"
+# процессов в пуле: разбор JPEG и свёртка не держат event loop бота
+PHOTO_QUALITY_WORKERS = int(os.getenv("PHOTO_QUALITY_WORKERS", "2"))
+# метрики резкости и яркости считаем на кадре этого размера — пороги не зависят от разрешения
+PHOTO_ANALYSIS_SIDE = 512
+
+# причина отказа → объяснение пользователю
+REASONS = {
+    "unreadable": "не получилось открыть картинку",
+    "small": "фото слишком маленькое — лицо на фигурке выйдет нечётким",
+    "blurry": "фото размыто",
+    "dark": "фото слишком тёмное",
+    "bright": "фото пересвечено",
+    "no_face": "на фото не видно лица",
+}
+
+
+@dataclass
+class PhotoQuality:
+    reason: str | None = None
+    width: int = 0
+    height: int = 0
+    sharpness: float = 0.0
+    brightness: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.reason is None
+
+    def message(self) -> str:
+        return (
+            f"Кажется, {REASONS[self.reason]} 🙈 Попытку мы не засчитали.\n\n"
+            "Пришлите, пожалуйста, другое — чёткое селфи при хорошем освещении, лицо крупно и без посторонних предметов 📸"
+        )
+
+
+def _sharpness(gray: np.ndarray) -> float:
+    """Дисперсия дискретного лапласиана: у размытого кадра почти нет резких перепадов."""
+    lap = (
+        gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:]
+        - 4 * gray[1:-1, 1:-1]
+    )
+    return float(lap.var())
+
+
+def _has_face(gray: np.ndarray) -> bool | None:
+    """Есть ли лицо анфас; None — opencv не установлен, проверить нечем."""
+    try:
+        import cv2
+    except ImportError:
+        return None
+    cascade = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml"))
+    faces = cascade.detectMultiScale(gray.astype(np.uint8), scaleFactor=1.1, minNeighbors=5, minSize=(48, 48))
+    return len(faces) > 0
+
+
+def assess(path: str) -> PhotoQuality:
+    """Метрики и вердикт для одного файла; выполняется в процессе пула."""
+    try:
+        with Image.open(path) as img:
+            img = ImageOps.exif_transpose(img)
+            width, height = img.size
+            img.thumbnail((PHOTO_ANALYSIS_SIDE, PHOTO_ANALYSIS_SIDE))
+            gray = np.asarray(img.convert("L"), dtype=np.float32)
+    except (OSError, UnidentifiedImageError):
+        return PhotoQuality("unreadable")
+
+    quality = PhotoQuality(
+        width=width,
+        height=height,
+        sharpness=_sharpness(gray),
+        brightness=float(gray.mean()),
+    )
+    if min(width, height) < PHOTO_MIN_SIDE:
+        quality.reason = "small"
+    elif quality.brightness < PHOTO_MIN_BRIGHTNESS:
+        quality.reason = "dark"
+    elif quality.brightness > PHOTO_MAX_BRIGHTNESS:
+        quality.reason = "bright"
+    elif quality.sharpness < PHOTO_MIN_SHARPNESS:
+        quality.reason = "blurry"
+    elif PHOTO_FACE_CHECK and _has_face(gray) is False:
+        quality.reason = "no_face"
+    return quality
+
+
+_pool = LazyProcessPool(PHOTO_QUALITY_WORKERS)
+
+
+async def check_photo(path: str) -> PhotoQuality:
+    """Проверяет фото в пуле процессов; при выключенной проверке — сразу «годится»."""
+    if not PHOTO_QUALITY:
+        return PhotoQuality()
+    quality = await _pool.run(assess, path)
+    logger.info(
+        "Фото %s: %sx%s, резкость %.1f, яркость %.1f — %s",
+        os.path.basename(path), quality.width, quality.height, quality.sharpness, quality.brightness,
+        quality.reason or "годится",
+    )
+    return quality
+
+
+def shutdown() -> None:
+    _pool.shutdown()
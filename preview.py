@@ -0,0 +1,31 @@
+# preview.py
+
+import os
+import time
+from dataclasses import dataclass, field
+
+# потоковая генерация: промежуточные кадры images.edit показываем пользователю
+GENERATION_STREAM = os.getenv("GENERATION_STREAM", "0") == "1"
+# сколько промежуточных кадров просить у API (0–3)
+PARTIAL_IMAGES = int(os.getenv("PARTIAL_IMAGES", "2"))
+# не чаще одного редактирования сообщения с превью за столько секунд
+PREVIEW_EDIT_INTERVAL = float(os.getenv("PREVIEW_EDIT_INTERVAL", "3.0"))
+
+PREVIEW_CAPTION = "Фигурка проявляется… ещё чуть-чуть ⏳"
+
+
+@dataclass
+class Preview:
+    """Сообщение с превью в чате: сначала sendPhoto, потом editMessageMedia не чаще interval."""
+
+    chat_id: int
+    message_id: int | None = None
+    interval: float = PREVIEW_EDIT_INTERVAL
+    _last_edit: float = field(default=0.0, repr=False)
+
+    def wait_time(self) -> float:
+        """Сколько секунд ещё нельзя редактировать сообщение."""
+        return max(self._last_edit + self.interval - time.monotonic(), 0.0)
+
+    def mark(self) -> None:
+        self._last_edit = time.monotonic()
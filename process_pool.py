@@ -0,0 +1,29 @@
+# process_pool.py
+
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+class LazyProcessPool:
+    """
+    Пул процессов для CPU-работы бота (разбор и сжатие картинок), чтобы она не держала event loop.
+    Создаётся при первом вызове — процессы, которым он не понадобился, его не запускают.
+    Процессы стартуют через spawn: в боте работают потоки (логи, Redis), а fork
+    многопоточного процесса может зависнуть. Каждый дочерний процесс заново импортирует
+    главный модуль (как __mp_main__), поэтому bot.py на импорте ничего не создаёт — см. bot.setup().
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._pool: ProcessPoolExecutor | None = None
+
+    async def run(self, fn, *args):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
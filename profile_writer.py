@@ -0,0 +1,34 @@
+# profile_writer.py
+
+from write_behind import WriteBehind
+
+
+class ProfileWriter(WriteBehind):
+    """
+    Отложенная запись ответов анкеты (name/profession/gender) в users.
+
+    Во время Form профиль живёт в данных FSM: хендлеры не ходят в БД на каждом шаге,
+    а process_photo берёт анкету оттуда и записывает её вместе с резервированием попытки.
+    Сюда те же ответы попадают для воронки /stats и /export — тех, кто бросил анкету
+    на полпути, тоже надо посчитать. Пачка пишется раз в flush_interval секунд
+    или сразу, как только накопилось batch_size пользователей (write_behind.py).
+    """
+
+    items = "анкет"
+
+    def record(self, user_id: int, **fields) -> None:
+        """Ответ анкеты (без полей — пользователь только открыл бота)."""
+        self._dirty.setdefault(user_id, {}).update(fields)
+        self._changed()
+
+    def saved(self, user_id: int) -> None:
+        """Анкета уже записана другим запросом (резервированием попытки) — в пачке не нужна."""
+        self._dirty.pop(user_id, None)
+
+    async def _write(self, batch: dict[int, dict]) -> None:
+        await self.storage.save_profiles(batch)
+
+    def _restore(self, batch: dict[int, dict]) -> None:
+        # более свежие ответы важнее
+        for uid, fields in batch.items():
+            self._dirty[uid] = {**fields, **self._dirty.get(uid, {})}
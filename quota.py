@@ -0,0 +1,53 @@
+# quota.py
+
+from config import DEFAULT_ALLOWED_GENERATIONS, logger
+from setting_cache import fresh, remember
+from storage import DEFAULT_LIMIT_KEY
+
+
+def _parse_limit(value: str | None) -> int:
+    return int(value) if value is not None else DEFAULT_ALLOWED_GENERATIONS
+
+
+async def default_limit(store) -> int:
+    """Общий лимит генераций (из кэша, не чаще раза в LIMIT_CACHE_TTL — из settings)."""
+    value = fresh(store, DEFAULT_LIMIT_KEY)
+    if value is None:
+        value = remember(store, DEFAULT_LIMIT_KEY, _parse_limit(await store.get_setting(DEFAULT_LIMIT_KEY)))
+    return value
+
+
+def default_limit_sync(store) -> int:
+    """То же для Celery-воркеров (store — BlockingStorage)."""
+    value = fresh(store, DEFAULT_LIMIT_KEY)
+    if value is None:
+        value = remember(store, DEFAULT_LIMIT_KEY, _parse_limit(store.get_setting(DEFAULT_LIMIT_KEY)))
+    return value
+
+
+async def set_default_limit(store, value: int) -> None:
+    """Новый общий лимит — одна строка settings, сколько бы ни было пользователей."""
+    await store.set_setting(DEFAULT_LIMIT_KEY, str(value))
+    remember(store, DEFAULT_LIMIT_KEY, value)
+
+
+async def reserve_generation(store, uid: int, **profile) -> dict | None:
+    """
+    Резервирует попытку генерации одним атомарным запросом: профиль уже
+    с увеличенным photo_count и действующим лимитом или None, если лимит исчерпан.
+    Две быстрые фотографии подряд не проскочат: второй запрос видит уже увеличенный счётчик.
+    profile — name/profession/gender из анкеты, записываются тем же запросом.
+    """
+    return await store.reserve_generation(uid, await default_limit(store), **profile)
+
+
+async def release_generation(store, uid: int) -> None:
+    """Возвращает попытку, если генерация окончательно не удалась."""
+    if await store.release_generation(uid):
+        logger.info("Пользователю %s возвращена попытка генерации", uid)
+
+
+def release_generation_sync(store, uid: int) -> None:
+    """То же для Celery-воркеров (store — BlockingStorage)."""
+    if store.release_generation(uid):
+        logger.info("Пользователю %s возвращена попытка генерации", uid)
@@ -0,0 +1,57 @@
+# result_index.py
+
+from collections import OrderedDict
+
+from write_behind import WriteBehind
+
+
+class LastResultIndex(WriteBehind):
+    """
+    Индекс «последний результат пользователя» — message_id последней отправленной фигурки.
+
+    Два уровня:
+      - ограниченный LRU в памяти (не больше max_size пользователей);
+      - пакетная запись в users.last_photo_id: раз в flush_interval секунд
+        или сразу, как только накопилось batch_size изменений (write_behind.py).
+
+    Промахи LRU читаются из БД и в кэш не кладутся: туда же пишут Celery-воркеры,
+    и закэшированное чтение могло бы устареть.
+    """
+
+    items = "last_photo_id"
+
+    def __init__(
+        self,
+        storage,
+        max_size: int = 10_000,
+        batch_size: int = 200,
+        flush_interval: float = 5.0
+    ):
+        super().__init__(storage, batch_size, flush_interval)
+        self.max_size = max_size
+        self._cache: OrderedDict[int, int] = OrderedDict()
+
+    def record(self, user_id: int, message_id: int) -> None:
+        self._cache[user_id] = message_id
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+        self._dirty[user_id] = message_id
+        self._changed()
+
+    async def get(self, user_id: int) -> int | None:
+        if user_id in self._cache:
+            self._cache.move_to_end(user_id)
+            return self._cache[user_id]
+        if user_id in self._dirty:
+            return self._dirty[user_id]
+
+        return await self.storage.get_last_photo_id(user_id)
+
+    async def _write(self, batch: dict[int, int]) -> None:
+        await self.storage.set_last_photo_ids(batch)
+
+    def _restore(self, batch: dict[int, int]) -> None:
+        for uid, mid in batch.items():
+            self._dirty.setdefault(uid, mid)
@@ -0,0 +1,25 @@
+# setting_cache.py
+
+import os
+import time
+
+# Без config: общий для quota.py (users.db бота) и db.py (у него своя БД и нет config)
+
+# сколько секунд процесс верит закэшированной настройке (общему лимиту генераций); бот
+# обновляет свой кэш сразу при /generation all, у Celery-воркеров изменение видно через LIMIT_CACHE_TTL
+LIMIT_CACHE_TTL = float(os.getenv("LIMIT_CACHE_TTL", "30"))
+
+# (хранилище, ключ settings) → (значение, когда перечитать)
+_cached: dict[tuple[object, str], tuple[object, float]] = {}
+
+
+def remember(store, key: str, value):
+    """Запоминает значение настройки key хранилища store на LIMIT_CACHE_TTL секунд; возвращает его."""
+    _cached[store, key] = (value, time.monotonic() + LIMIT_CACHE_TTL)
+    return value
+
+
+def fresh(store, key: str):
+    """Закэшированное значение настройки или None, если его нет или пора перечитать."""
+    value, expires = _cached.get((store, key), (None, 0.0))
+    return value if time.monotonic() < expires else None
@@ -0,0 +1,591 @@
+# storage.py
+
+import asyncio
+import os
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+import aiosqlite
+
+from config import DB_PATH, DEFAULT_ALLOWED_GENERATIONS, logger
+from migrations import column_names, migrate, sql
+
+# sqlite — файл DB_PATH; postgres — DATABASE_URL через пул соединений asyncpg
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://bot@localhost:5432/bot")
+STORAGE_POOL_MIN = int(os.getenv("STORAGE_POOL_MIN", "2"))
+STORAGE_POOL_MAX = int(os.getenv("STORAGE_POOL_MAX", "10"))
+
+# общий лимит генераций — строка settings; users.allowed_generations — личный лимит (NULL — общий)
+DEFAULT_LIMIT_KEY = "default_allowed_generations"
+
+USER_FIELDS = (
+    "user_id", "name", "profession", "gender", "photo_count",
+    "created_at", "updated_at", "allowed_generations",
+)
+EXPORT_FIELDS = ("user_id", "name", "profession", "gender", "photo_count", "last_photo_id")
+PROFILE_FIELDS = ("user_id", "name", "profession", "gender", "photo_count", "allowed_generations")
+
+
+def _ts(value) -> str | None:
+    """Даты наружу — строкой 'YYYY-MM-DD HH:MM:SS' (UTC), как их хранит SQLite."""
+    return value.strftime("%Y-%m-%d %H:%M:%S") if isinstance(value, datetime) else value
+
+
+class _SQLStorage(ABC):
+    """
+    Общая часть хранилищ: SQL пишется один раз с «?» и {now}/{week_ago},
+    бэкенд подставляет свои плейсхолдеры и выражения для времени.
+    Все даты — UTC.
+    """
+
+    NOW = ""
+    WEEK_AGO = ""
+
+    def _sql(self, query: str) -> str:
+        return query.format(now=self.NOW, week_ago=self.WEEK_AGO)
+
+    @abstractmethod
+    async def _execute(self, query: str, *args) -> int:
+        ...
+
+    @abstractmethod
+    async def _executemany(self, query: str, rows: list[tuple]) -> None:
+        ...
+
+    @abstractmethod
+    async def _fetchone(self, query: str, *args):
+        ...
+
+    @abstractmethod
+    async def _fetchall(self, query: str, *args) -> list:
+        ...
+
+    # ---------- users ----------
+
+    async def get_user(self, uid: int) -> dict | None:
+        """Профиль как в БД: allowed_generations — личный лимит или None."""
+        row = await self._fetchone(
+            f"SELECT {', '.join(USER_FIELDS)} FROM users WHERE user_id = ?;", uid
+        )
+        if row is None:
+            return None
+        user = dict(zip(USER_FIELDS, row))
+        user["created_at"] = _ts(user["created_at"])
+        user["updated_at"] = _ts(user["updated_at"])
+        return user
+
+    async def upsert_user(
+        self,
+        uid: int,
+        *,
+        name: str | None = None,
+        profession: str | None = None,
+        gender: str | None = None,
+        inc_photo: bool = False,
+        set_allowed: int | None = None,
+        dec_allowed: bool = False,
+        default_limit: int | None = None
+    ) -> None:
+        """
+        Новая строка или обновление переданных полей — одним запросом.
+        dec_allowed уменьшает действующий лимит, поэтому нужен default_limit.
+        """
+        updates, params = [], []
+        for column, value in (("name", name), ("profession", profession), ("gender", gender)):
+            if value is not None:
+                updates.append(f"{column} = ?")
+                params.append(value)
+        if inc_photo:
+            updates.append("photo_count = users.photo_count + 1")
+        if set_allowed is not None:
+            updates.append("allowed_generations = ?")
+            params.append(set_allowed)
+        elif dec_allowed:
+            updates.append("allowed_generations = COALESCE(users.allowed_generations, ?) - 1")
+            params.append(default_limit)
+
+        on_conflict = "DO NOTHING"
+        if updates:
+            on_conflict = f"DO UPDATE SET {', '.join(updates)}, updated_at = {{now}}"
+        await self._execute(
+            self._sql(f"""
+                INSERT INTO users (
+                    user_id, name, profession, gender, photo_count,
+                    created_at, updated_at, allowed_generations
+                ) VALUES (?, ?, ?, ?, ?, {{now}}, {{now}}, ?)
+                ON CONFLICT (user_id) {on_conflict};
+            """),
+            uid, name or "", profession or "", gender or "", 1 if inc_photo else 0, set_allowed,
+            *params,
+        )
+
+    async def reserve_generation(
+        self,
+        uid: int,
+        default_limit: int,
+        *,
+        name: str | None = None,
+        profession: str | None = None,
+        gender: str | None = None
+    ) -> dict | None:
+        """
+        Проверка лимита, +1 к photo_count и профиль — одним атомарным запросом.
+        Новой строки нет — вставляем её сразу с photo_count = 1, если общий лимит
+        больше нуля; лимит исчерпан — WHERE в DO UPDATE не срабатывает, и RETURNING
+        ничего не отдаёт. name/profession/gender (анкета из FSM) записываются тем же
+        запросом; не переданные остаются как в БД.
+        """
+        row = await self._fetchone(
+            self._sql("""
+                INSERT INTO users (
+                    user_id, name, profession, gender, photo_count,
+                    created_at, updated_at, allowed_generations
+                )
+                SELECT ?, ?, ?, ?, 1, {now}, {now}, NULL
+                 WHERE ? > 0 OR EXISTS (SELECT 1 FROM users WHERE user_id = ?)
+                ON CONFLICT (user_id) DO UPDATE
+                   SET photo_count = users.photo_count + 1,
+                       name        = COALESCE(NULLIF(excluded.name, ''), users.name),
+                       profession  = COALESCE(NULLIF(excluded.profession, ''), users.profession),
+                       gender      = COALESCE(NULLIF(excluded.gender, ''), users.gender),
+                       updated_at  = {now}
+                 WHERE users.photo_count < COALESCE(users.allowed_generations, ?)
+             RETURNING user_id, name, profession, gender, photo_count,
+                       COALESCE(allowed_generations, ?);
+            """),
+            uid, name or "", profession or "", gender or "", default_limit, uid, default_limit, default_limit,
+        )
+        return dict(zip(PROFILE_FIELDS, row)) if row else None
+
+    async def save_profiles(self, batch: dict[int, dict]) -> None:
+        """
+        Пачка ответов анкеты: user_id → {name, profession, gender} (любые из них).
+        Незаполненные поля не затирают сохранённые; пустой профиль только создаёт строку.
+        """
+        await self._executemany(
+            self._sql("""
+                INSERT INTO users (
+                    user_id, name, profession, gender, photo_count,
+                    created_at, updated_at, allowed_generations
+                ) VALUES (?, ?, ?, ?, 0, {now}, {now}, NULL)
+                ON CONFLICT (user_id) DO UPDATE
+                   SET name       = COALESCE(NULLIF(excluded.name, ''), users.name),
+                       profession = COALESCE(NULLIF(excluded.profession, ''), users.profession),
+                       gender     = COALESCE(NULLIF(excluded.gender, ''), users.gender),
+                       updated_at = CASE WHEN excluded.name || excluded.profession || excluded.gender = ''
+                                         THEN users.updated_at ELSE {now} END;
+            """),
+            [
+                (uid, fields.get("name") or "", fields.get("profession") or "", fields.get("gender") or "")
+                for uid, fields in batch.items()
+            ],
+        )
+
+    async def release_generation(self, uid: int) -> bool:
+        changed = await self._execute(
+            self._sql("""
+                UPDATE users
+                   SET photo_count = photo_count - 1,
+                       updated_at  = {now}
+                 WHERE user_id = ? AND photo_count > 0;
+            """),
+            uid,
+        )
+        return changed > 0
+
+    async def reset_photo_count(self, uid: int) -> None:
+        await self._execute("UPDATE users SET photo_count = 0 WHERE user_id = ?;", uid)
+
+    async def user_ids(self) -> list[int]:
+        return [row[0] for row in await self._fetchall("SELECT user_id FROM users;")]
+
+    async def export_users(self) -> list[dict]:
+        rows = await self._fetchall(f"SELECT {', '.join(EXPORT_FIELDS)} FROM users;")
+        return [dict(zip(EXPORT_FIELDS, row)) for row in rows]
+
+    async def get_last_photo_id(self, uid: int) -> int | None:
+        row = await self._fetchone("SELECT last_photo_id FROM users WHERE user_id = ?;", uid)
+        return row[0] if row else None
+
+    async def set_last_photo_ids(self, batch: dict[int, int]) -> None:
+        await self._executemany(
+            "UPDATE users SET last_photo_id = ? WHERE user_id = ?;",
+            [(mid, uid) for uid, mid in batch.items()],
+        )
+
+    async def user_stats(self) -> dict:
+        """Воронка и активность пользователей для /stats."""
+
+        async def count(where: str = "", table: str = "users") -> int:
+            query = f"SELECT COUNT(*) FROM {table}" + (f" WHERE {where}" if where else "")
+            return (await self._fetchone(self._sql(query + ";")))[0]
+
+        return {
+            # сколько пользователей вообще открыли бота
+            "total_users": await count(),
+            # написали имя
+            "wrote_name": await count("name IS NOT NULL AND name <> ''"),
+            # написали профессию
+            "wrote_prof": await count("profession IS NOT NULL AND profession <> ''"),
+            # выбрали пол: всего, М, Ж
+            "total_gender": await count("gender IN ('male','female')"),
+            "male_count": await count("gender = 'male'"),
+            "female_count": await count("gender = 'female'"),
+            # отправили хотя бы 1 фото / 2 и более фото
+            "at_least_one": await count("photo_count >= 1"),
+            "at_least_two": await count("photo_count >= 2"),
+            # активных за неделю (updated_at за последние 7 дней)
+            "active_week": await count("updated_at >= {week_ago}"),
+            # подписались всего (без ручного оффсета)
+            "real_subs": await count(table="subscriptions"),
+        }
+
+    # ---------- subscriptions, admins, settings ----------
+
+    async def add_subscription(self, uid: int) -> None:
+        await self._execute(
+            "INSERT INTO subscriptions (user_id) VALUES (?) ON CONFLICT (user_id) DO NOTHING;", uid
+        )
+
+    async def is_admin(self, uid: int) -> bool:
+        return await self._fetchone("SELECT 1 FROM admins WHERE user_id = ?;", uid) is not None
+
+    async def add_admins(self, ids) -> None:
+        await self._executemany(
+            "INSERT INTO admins (user_id) VALUES (?) ON CONFLICT (user_id) DO NOTHING;",
+            [(uid,) for uid in ids],
+        )
+
+    async def get_setting(self, key: str) -> str | None:
+        row = await self._fetchone("SELECT value FROM settings WHERE key = ?;", key)
+        return row[0] if row else None
+
+    async def set_setting(self, key: str, value: str) -> None:
+        await self._execute(
+            "INSERT INTO settings (key, value) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value;",
+            key, value,
+        )
+
+
+# ---------- SQLite ----------
+
+async def _sqlite_schema_v1(db: aiosqlite.Connection):
+    """Исходная схема; для БД, созданных до миграций, — недостающие колонки и пустые поля."""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id INTEGER PRIMARY KEY
+        );
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id             INTEGER PRIMARY KEY,
+            name                TEXT,
+            profession          TEXT,
+            gender              TEXT,
+            photo_count         INTEGER DEFAULT 0,
+            created_at          TEXT    DEFAULT (datetime('now')),
+            updated_at          TEXT    DEFAULT (datetime('now')),
+            allowed_generations INTEGER DEFAULT 2,
+            last_photo_id       INTEGER DEFAULT NULL
+        );
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user_id       INTEGER PRIMARY KEY,
+            subscribed_at TEXT    DEFAULT (datetime('now'))
+        );
+    """)
+
+    # ADD COLUMN не допускает DEFAULT (datetime('now')) — даты заполняет UPDATE ниже,
+    # новые строки их и так пишут явно
+    cols = await column_names(db, "users")
+    if "created_at" not in cols:
+        await db.execute("ALTER TABLE users ADD COLUMN created_at TEXT;")
+    if "updated_at" not in cols:
+        await db.execute("ALTER TABLE users ADD COLUMN updated_at TEXT;")
+    if "allowed_generations" not in cols:
+        await db.execute(
+            "ALTER TABLE users ADD COLUMN allowed_generations INTEGER DEFAULT 2;"
+        )
+    if "last_photo_id" not in cols:
+        await db.execute(
+            "ALTER TABLE users ADD COLUMN last_photo_id INTEGER DEFAULT NULL;"
+        )
+
+    await db.execute(
+        "UPDATE users SET created_at = datetime('now') WHERE created_at IS NULL;"
+    )
+    await db.execute(
+        "UPDATE users SET updated_at = datetime('now') WHERE updated_at IS NULL;"
+    )
+    await db.execute(
+        "UPDATE users SET allowed_generations = 2 WHERE allowed_generations IS NULL;"
+    )
+
+
+async def _sqlite_schema_v3(db: aiosqlite.Connection):
+    """
+    Общий лимит генераций — в settings, allowed_generations становится личным лимитом
+    (NULL — действует общий). Общим становится самый частый лимит, у таких
+    пользователей личный сбрасывается.
+    """
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key   TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """)
+    cur = await db.execute("""
+        SELECT allowed_generations FROM users
+         WHERE allowed_generations IS NOT NULL
+         GROUP BY allowed_generations
+         ORDER BY COUNT(*) DESC
+         LIMIT 1;
+    """)
+    row = await cur.fetchone()
+    default = row[0] if row else DEFAULT_ALLOWED_GENERATIONS
+    await db.execute(
+        "INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?);", (DEFAULT_LIMIT_KEY, str(default))
+    )
+    await db.execute("UPDATE users SET allowed_generations = NULL WHERE allowed_generations = ?;", (default,))
+
+
+async def _sqlite_schema_v4(db: aiosqlite.Connection):
+    """
+    У allowed_generations остался DEFAULT 2 из первой схемы, хотя NULL теперь значит
+    «общий лимит». SQLite не умеет менять DEFAULT колонки — таблица пересоздаётся.
+    """
+    await db.execute("""
+        CREATE TABLE users_v4 (
+            user_id             INTEGER PRIMARY KEY,
+            name                TEXT,
+            profession          TEXT,
+            gender              TEXT,
+            photo_count         INTEGER DEFAULT 0,
+            created_at          TEXT    DEFAULT (datetime('now')),
+            updated_at          TEXT    DEFAULT (datetime('now')),
+            allowed_generations INTEGER,
+            last_photo_id       INTEGER DEFAULT NULL
+        );
+    """)
+    columns = ", ".join(USER_FIELDS + ("last_photo_id",))
+    await db.execute(f"INSERT INTO users_v4 ({columns}) SELECT {columns} FROM users;")
+    await db.execute("DROP TABLE users;")
+    await db.execute("ALTER TABLE users_v4 RENAME TO users;")
+    await db.execute("CREATE INDEX idx_users_updated_at ON users(updated_at);")
+    await db.execute("CREATE INDEX idx_users_photo_count ON users(photo_count);")
+
+
+# Шаги миграций users.db (migrations.py): только дописываем в конец
+SQLITE_MIGRATIONS = [
+    _sqlite_schema_v1,
+    # /stats: активные за неделю и отправившие 1/2 фото — без полного прохода по users
+    sql(
+        "CREATE INDEX IF NOT EXISTS idx_users_updated_at ON users(updated_at);",
+        "CREATE INDEX IF NOT EXISTS idx_users_photo_count ON users(photo_count);",
+    ),
+    _sqlite_schema_v3,
+    _sqlite_schema_v4,
+]
+
+
+class SQLiteStorage(_SQLStorage):
+    """users.db: соединение на операцию, как везде в боте; писатели ждут блокировку до 5 с."""
+
+    NOW = "datetime('now')"
+    WEEK_AGO = "datetime('now', '-7 days')"
+
+    def __init__(self, db_path: str = DB_PATH):
+        self.db_path = db_path
+
+    async def open(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def migrate(self) -> None:
+        async with aiosqlite.connect(self.db_path) as db:
+            await migrate(db, SQLITE_MIGRATIONS, name="users.db")
+
+    def _connect(self):
+        return aiosqlite.connect(self.db_path, timeout=5.0)
+
+    async def _execute(self, query: str, *args) -> int:
+        async with self._connect() as db:
+            cur = await db.execute(query, args)
+            await db.commit()
+            return cur.rowcount
+
+    async def _executemany(self, query: str, rows: list[tuple]) -> None:
+        async with self._connect() as db:
+            await db.executemany(query, rows)
+            await db.commit()
+
+    async def _fetchone(self, query: str, *args):
+        async with self._connect() as db:
+            cur = await db.execute(query, args)
+            row = await cur.fetchone()
+            # RETURNING у INSERT/UPDATE — запись, её надо зафиксировать
+            if db.in_transaction:
+                await db.commit()
+            return row
+
+    async def _fetchall(self, query: str, *args) -> list:
+        async with self._connect() as db:
+            cur = await db.execute(query, args)
+            return await cur.fetchall()
+
+
+# ---------- PostgreSQL ----------
+
+# Шаги миграций PostgreSQL (версия — в таблице schema_version): только дописываем в конец
+POSTGRES_MIGRATIONS = [
+    [
+        """
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id BIGINT PRIMARY KEY
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id             BIGINT PRIMARY KEY,
+            name                TEXT,
+            profession          TEXT,
+            gender              TEXT,
+            photo_count         INTEGER DEFAULT 0,
+            created_at          TIMESTAMP(0) DEFAULT (now() AT TIME ZONE 'utc'),
+            updated_at          TIMESTAMP(0) DEFAULT (now() AT TIME ZONE 'utc'),
+            allowed_generations INTEGER,
+            last_photo_id       BIGINT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user_id       BIGINT PRIMARY KEY,
+            subscribed_at TIMESTAMP(0) DEFAULT (now() AT TIME ZONE 'utc')
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS settings (
+            key   TEXT PRIMARY KEY,
+            value TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_users_updated_at ON users(updated_at)",
+        "CREATE INDEX IF NOT EXISTS idx_users_photo_count ON users(photo_count)",
+    ],
+]
+
+
+def _numbered(query: str) -> str:
+    """«?» → $1, $2, … (в нашем SQL «?» встречается только как плейсхолдер)."""
+    parts = query.split("?")
+    return parts[0] + "".join(f"${i}{part}" for i, part in enumerate(parts[1:], start=1))
+
+
+class PostgresStorage(_SQLStorage):
+    """
+    Та же схема в PostgreSQL: пул asyncpg на процесс, строки блокируются по отдельности,
+    и бот с Celery-воркерами не ждут друг друга на общей блокировке файла.
+    """
+
+    NOW = "(now() AT TIME ZONE 'utc')::timestamp(0)"
+    WEEK_AGO = "(now() AT TIME ZONE 'utc') - interval '7 days'"
+
+    def __init__(self, dsn: str = DATABASE_URL, min_size: int = STORAGE_POOL_MIN,
+                 max_size: int = STORAGE_POOL_MAX):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+
+    async def open(self) -> None:
+        if self.pool is None:
+            import asyncpg
+
+            self.pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size)
+
+    async def close(self) -> None:
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def migrate(self) -> None:
+        await self.open()
+        async with self.pool.acquire() as conn:
+            await conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+            while True:
+                async with conn.transaction():
+                    # одновременно стартующие процессы применяют шаги по очереди
+                    await conn.execute("SELECT pg_advisory_xact_lock(hashtext('schema_version'))")
+                    version = await conn.fetchval("SELECT max(version) FROM schema_version") or 0
+                    if version >= len(POSTGRES_MIGRATIONS):
+                        return
+                    for statement in POSTGRES_MIGRATIONS[version]:
+                        await conn.execute(statement)
+                    await conn.execute("INSERT INTO schema_version (version) VALUES ($1)", version + 1)
+                logger.info("Схема postgres: применена миграция %s", version + 1)
+
+    async def _execute(self, query: str, *args) -> int:
+        status = await self.pool.execute(_numbered(query), *args)
+        # статус вида "UPDATE 3" / "INSERT 0 1"
+        return int(status.rsplit(" ", 1)[-1]) if status[-1].isdigit() else 0
+
+    async def _executemany(self, query: str, rows: list[tuple]) -> None:
+        await self.pool.executemany(_numbered(query), rows)
+
+    async def _fetchone(self, query: str, *args):
+        return await self.pool.fetchrow(_numbered(query), *args)
+
+    async def _fetchall(self, query: str, *args) -> list:
+        return await self.pool.fetch(_numbered(query), *args)
+
+
+def make_storage():
+    """Хранилище по STORAGE_BACKEND."""
+    if STORAGE_BACKEND == "postgres":
+        return PostgresStorage()
+    if STORAGE_BACKEND != "sqlite":
+        raise ValueError(f"Неизвестный STORAGE_BACKEND: {STORAGE_BACKEND}")
+    return SQLiteStorage()
+
+
+class BlockingStorage:
+    """
+    Синхронный фасад для Celery-воркеров: методы хранилища выполняются в собственном
+    event loop в фоновом потоке. Хранилище и поток создаются лениво в каждом процессе —
+    prefork-воркеры получают свои, а не унаследованные через fork.
+    """
+
+    def __init__(self, factory=make_storage):
+        self._factory = factory
+        self._pid: int | None = None
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._store = None
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def _ensure(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._loop = asyncio.new_event_loop()
+                    threading.Thread(target=self._loop.run_forever, name="storage", daemon=True).start()
+                    self._store = self._factory()
+                    self._run(self._store.open())
+                    self._pid = os.getpid()
+        return self._store
+
+    def __getattr__(self, name: str):
+        method = getattr(self._ensure(), name)
+
+        def call(*args, **kwargs):
+            return self._run(method(*args, **kwargs))
+
+        return call
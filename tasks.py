@@ -1,208 +1,450 @@
 # tasks.py
 
 import os
+import time
 import json
 import base64
-import random
 import logging
-import pandas as pd
-import re
-from config import ACCESSORIES_FILE, PACKAGING_PROMPT_TEMPLATE
 import openai
 from openai import RateLimitError
 import requests
-from celery_app import celery_app
-from config import API_KEYS, API_TOKEN, DB_PATH, REDIS_URL, REF_MALE, REF_FEMALE
-import sqlite3
+from celery_app import GENERATION_QUEUE, celery_app
+from log_setup import bind_log_context
+from hedging import HedgePolicy, RedisHedgeStats
+from preview import GENERATION_STREAM, PARTIAL_IMAGES, PREVIEW_CAPTION, Preview
+from degradation import DegradationPolicy, tier_params
+from quota import default_limit_sync, release_generation_sync
+from storage import BlockingStorage
+from telegram_client import TelegramClient, TelegramLimiter
+from fair_queue import FAIR_DISPATCH_DEPTH, FairQueue
+from generation import ANOTHER_BUTTON, build_prompt, result_caption
+from name_render import NAME_RENDER, render_name_b64
+from config import API_KEYS, REDIS_URL, REF_MALE, REF_FEMALE
 import redis
 
 logger = logging.getLogger(__name__)
 
 _r = redis.Redis.from_url(REDIS_URL)
+# Bot API: пул соединений на процесс и общий с ботом лимит сообщений (telegram_client.py)
+_telegram = TelegramClient(TelegramLimiter(_r))
+# окно задержек и бюджет дублей общие для всех воркеров — в Redis
+_hedge = HedgePolicy(RedisHedgeStats(_r))
+# users — через то же хранилище, что и у бота (STORAGE_BACKEND); пул свой в каждом процессе
+_store = BlockingStorage()
+# concurrency Celery-воркеров — для прогноза ожидания в очереди (по умолчанию — из профиля)
+CELERY_CONCURRENCY = int(os.getenv("CELERY_CONCURRENCY", celery_app.conf.worker_concurrency or 4))
+# выбор уровня качества живёт в процессе бота — он один ставит задачи
+_degradation = DegradationPolicy()
+# задачи ждут в справедливой очереди по пользователям и попадают в Celery по мере освобождения мест;
+# запас в два раза к concurrency — чтобы воркеры не простаивали, пока диспетчер добирает очередь
+_fair = FairQueue(_r, depth=FAIR_DISPATCH_DEPTH or 2 * CELERY_CONCURRENCY)
+
+# Генерация разбита на стадии: generate_image_task генерирует и сохраняет картинку под id задачи,
+# deliver_result_task отправляет её. Ретраи доставки не вызывают images.edit заново,
+# а доставленный результат не отправляется второй раз (message_id в job:{id}).
+# сколько хранится состояние задачи в Redis
+JOB_TTL = int(os.getenv("JOB_TTL", str(24 * 3600)))
+# у доставки свой счётчик ретраев: Telegram может лежать дольше, чем терпит генерация
+DELIVERY_MAX_RETRIES = int(os.getenv("DELIVERY_MAX_RETRIES", "8"))
+# попыток записать готовую картинку на диск, прежде чем сдаться (ретрай таска — новая генерация)
+PERSIST_ATTEMPTS = int(os.getenv("PERSIST_ATTEMPTS", "3"))
+
+def choose_tier() -> str:
+    """Уровень качества для новой задачи по глубине очереди генераций и медианной задержке генерации."""
+    try:
+        # только генерации: доставки идут в очередь celery и на выбор качества не влияют
+        depth = _r.llen(GENERATION_QUEUE) + _fair.size()
+        latencies = sorted(_hedge.stats.latencies())
+    except redis.RedisError as e:
+        logger.warning("Не удалось оценить очередь Celery: %s", e)
+        return _degradation.tiers[0].name
+    p50 = latencies[len(latencies) // 2] if latencies else 0.0
+    return _degradation.choose(depth, depth * p50 / CELERY_CONCURRENCY).name
+
+def submit_generation(
+    image_path: str,
+    profession: str,
+    gender: str,
+    user_id: int,
+    tier: str | None = None,
+    name: str | None = None,
+    photo_count: int | None = None,
+    limit: int | None = None
+) -> int:
+    """
+    Ставит генерацию в справедливую очередь; возвращает место задачи в ней (1 — следующая).
+    name/photo_count/limit — профиль, известный боту: с ними таски не читают users.
+    """
+    job_id, position = _fair.submit(user_id, {
+        "image_path": image_path,
+        "profession": profession,
+        "gender": gender,
+        "user_id": user_id,
+        "tier": tier,
+        "name": name,
+        "photo_count": photo_count,
+        "limit": limit,
+    })
+    logger.info("[%s] Задача %s в очереди, место %s", user_id, job_id, position)
+    return position
+
+def send_generation(job_id: str, payload: dict) -> None:
+    """Выдаёт задачу из справедливой очереди в Celery; id задачи Celery — id в очереди."""
+    generate_image_task.apply_async(kwargs=payload, task_id=job_id)
+
+def dispatch_generations() -> int:
+    return _fair.dispatch(send_generation)
+
+def generation_position(user_id: int) -> int:
+    return _fair.position(user_id)
+
+def tier_metrics() -> dict:
+    """Сколько результатов Celery выдал на каждом уровне качества."""
+    return {k.decode(): int(v) for k, v in _r.hgetall("degradation:tiers").items()}
+
+def hedge_metrics() -> dict:
+    """Счётчики хеджирования Celery-воркеров: requests, hedged, hedge_wins, latency_saved_s."""
+    return _hedge.stats.snapshot()
+
 def pick_api_key() -> str:
     # atomically incr counter and mod by keys count
     idx = int(_r.incr("api_key_pointer")) % len(API_KEYS)
-    logger.info(f"pick_api_key: using key index={idx}")
+    logger.info("pick_api_key: using key index=%s", idx)
     return API_KEYS[idx]
 
-def _norm(s: str) -> str:
-    t = s.lower()
-    t = re.sub(r"[^\w\s]", "", t)
-    return re.sub(r"\s+", " ", t).strip()
-
-# загружаем маппинг профессия → список аксессуаров
-_acc_df = pd.read_excel(ACCESSORIES_FILE)
-_acc_df.columns = _acc_df.columns.str.strip()
-_acc_df["ПРОФЕССИЯ"] = _acc_df["ПРОФЕССИЯ"] \
-    .astype(str) \
-    .str.replace("/", ",", regex=False)
-_acc_df = _acc_df.assign(
-    ПРОФЕССИЯ=_acc_df["ПРОФЕССИЯ"].str.split(",")
-).explode("ПРОФЕССИЯ")
-_acc_df["ПРОФЕССИЯ"] = _acc_df["ПРОФЕССИЯ"].str.strip()
-
-# 2) Теперь строим mapping, дублируя аксессуары
-_accessories_map: dict[str, list[str]] = {}
-for _, row in _acc_df.iterrows():
-    prof = _norm(row["ПРОФЕССИЯ"])
-    items: list[str] = []
-    for col in _acc_df.columns:
-        if col.startswith("Аксессуар_") and isinstance(row[col], str) and row[col].strip():
-            items.append(row[col].strip())
-    # если одна и та же профессия встречалась несколько раз, последний overwrite дублирует список
-    _accessories_map[prof] = items
+def save_result(b64: str, result_path: str) -> None:
+    """
+    Декодирует base64-ответ OpenAI и пишет PNG на диск. Файл появляется целиком
+    (запись во временный и переименование): наличие файла — контрольная точка задачи.
+    """
+    img_bytes = base64.b64decode(b64)
+    tmp_path = f"{result_path}.tmp"
+    with open(tmp_path, "wb") as out_f:
+        out_f.write(img_bytes)
+    os.replace(tmp_path, result_path)
+
+def checkpoint(job_id: str, **fields) -> None:
+    """Дописывает состояние задачи в Redis (job:{id}), хранится JOB_TTL секунд."""
+    key = f"job:{job_id}"
+    pipe = _r.pipeline()
+    pipe.hset(key, mapping=fields)
+    pipe.expire(key, JOB_TTL)
+    pipe.execute()
+
+def job_state(job_id: str) -> dict[str, str]:
+    return {k.decode(): v.decode() for k, v in _r.hgetall(f"job:{job_id}").items()}
+
+def show_preview(preview: Preview, b64: str) -> None:
+    """Отправляет первый кадр превью, следующими заменяет его — не чаще preview.interval."""
+    photo = ("preview.png", base64.b64decode(b64))
+    if preview.message_id is None:
+        result = _telegram.call(
+            "sendPhoto",
+            data={"chat_id": preview.chat_id, "caption": PREVIEW_CAPTION},
+            files={"photo": photo},
+        )
+        preview.message_id = result["message_id"]
+    elif not preview.wait_time():
+        _telegram.call(
+            "editMessageMedia",
+            data={
+                "chat_id": preview.chat_id,
+                "message_id": preview.message_id,
+                "media": json.dumps({"type": "photo", "media": "attach://photo", "caption": PREVIEW_CAPTION}),
+            },
+            files={"photo": photo},
+        )
+    else:
+        return
+    preview.mark()
+
+def stream_edit(
+    client: openai.OpenAI,
+    image_path: str,
+    ref_path: str,
+    prompt: str,
+    preview: Preview,
+    tier: str | None = None
+) -> str:
+    """images.edit в потоковом режиме: промежуточные кадры уходят в чат, возвращается итоговый b64."""
+    with open(image_path, "rb") as selfie, open(ref_path, "rb") as ref:
+        stream = client.images.edit(
+            model="gpt-image-1",
+            image=[selfie, ref],
+            prompt=prompt,
+            n=1,
+            **tier_params(tier),
+            stream=True,
+            partial_images=PARTIAL_IMAGES
+        )
+        with stream:
+            for event in stream:
+                if event.type == "image_edit.partial_image":
+                    try:
+                        show_preview(preview, event.b64_json)
+                    except requests.RequestException as e:
+                        # превью — не главное, генерацию из-за него не роняем
+                        logger.warning("[%s] Не удалось показать превью: %s", preview.chat_id, e)
+                elif event.type == "image_edit.completed":
+                    return event.b64_json
+    raise ValueError("поток images.edit закончился без image_edit.completed")
+
+class GenerationTask(celery_app.Task):
+    """Генерация окончательно не удалась (ретраи исчерпаны) — возвращаем пользователю попытку."""
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        user_id = kwargs.get("user_id", args[3] if len(args) > 3 else None)
+        if user_id is not None:
+            job_id = kwargs.get("job_id", task_id)
+            release_generation_sync(_store, user_id)
+            # задача больше не занимает место пользователя в справедливой очереди
+            _fair.done(user_id, job_id)
+            discard_preview(job_id, user_id)
+
+
+def discard_preview(job_id: str, user_id: int) -> None:
+    """Задача снята без результата — убираем из чата её превью, если оно было."""
+    try:
+        message_id = job_state(job_id).get("preview_message_id")
+        if message_id is not None:
+            _telegram.call("deleteMessage", data={"chat_id": user_id, "message_id": int(message_id)})
+    except (redis.RedisError, requests.RequestException) as e:
+        logger.warning("[%s] Не удалось убрать превью задачи %s: %s", user_id, job_id, e)
+
 
 @celery_app.task(
     bind=True,
+    base=GenerationTask,
     name="tasks.generate_image_task",
     autoretry_for=(RateLimitError,),
     retry_backoff=True,
     max_retries=5
 )
-def generate_image_task(self, image_path: str, profession: str, gender: str, user_id: int) -> None:
+def generate_image_task(
+    self,
+    image_path: str,
+    profession: str,
+    gender: str,
+    user_id: int,
+    tier: str | None = None,
+    name: str | None = None,
+    photo_count: int | None = None,
+    limit: int | None = None
+) -> None:
     """
-    Celery-таск: синхронно генерирует изображение по исходному фото и отправляет его пользователю.
+    Celery-таск: синхронно генерирует изображение по исходному фото, сохраняет его
+    под id задачи и ставит доставку пользователю (deliver_result_task).
 
     Аргументы:
       - image_path: путь до временного файла с фото пользователя
       - profession: профессия
       - gender: пол ("male"/"female")
       - user_id: Telegram ID
+      - tier: уровень качества из degradation.py (None — standard)
+      - name, photo_count, limit: профиль на момент резервирования попытки (None — из БД)
     """
-    api_key = pick_api_key()
-    openai.api_key = api_key
-    
-    norm_prof = _norm(profession)
-    acc_list = _accessories_map.get(norm_prof, [])
-
-    # выбираем ровно 6 штук (с повторениями, если мало)
-    if len(acc_list) >= 6:
-        selected = random.sample(acc_list, 6)
-    else:
-        selected = random.choices(acc_list, k=6)
-
-    # собираем окончательный prompt
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT name FROM users WHERE user_id = ?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    user_name = row[0] if row and row[0] else "Пользователь"
-
-    # Подставляем все переменные в шаблон
-    full_prompt = PACKAGING_PROMPT_TEMPLATE.format(
-        profession=profession,
-        accessories=", ".join(selected),
-        name=user_name
-    )
-    
+    bind_log_context(user_id=user_id, tier=tier)
+
+    # id задачи не меняется между её ретраями — по нему ищем уже сохранённую картинку
+    job_id = self.request.id
+    result_path = os.path.join(os.path.dirname(image_path), f"{job_id}_result.png")
+    if os.path.exists(result_path):
+        # прошлая попытка успела сохранить картинку, но не поставила доставку
+        logger.info("[%s] Картинка задачи %s уже сохранена, генерацию пропускаем", user_id, job_id)
+        deliver_result_task.delay(
+            job_id=job_id, result_path=result_path, user_id=user_id, tier=tier, photo_count=photo_count, limit=limit
+        )
+        return
+
+    # собираем окончательный prompt; имя обычно приходит от бота, из БД — для старых задач
+    if name is None:
+        user = _store.get_user(user_id)
+        name = user["name"] if user else None
+    user_name = name or "Пользователь"
+
+    full_prompt = build_prompt(profession, user_name)
+
     ref_path = REF_MALE if gender == "male" else REF_FEMALE
 
-    # 2. Запрос к OpenAI Image Edit
-    try:
-        with open(image_path, "rb") as selfie, open(ref_path, "rb") as ref:
-            response = openai.images.edit(
+    # 2. Запрос к OpenAI Image Edit; при хеджировании попытки идут в потоках,
+    # поэтому у каждой свой клиент и ключ, а не общий openai.api_key
+    clients: dict[int, openai.OpenAI] = {}
+
+    def request(attempt: int):
+        # у каждой попытки свой клиент: проигравшую cancel() обрывает его закрытием
+        with openai.OpenAI(api_key=pick_api_key()) as client, \
+                open(image_path, "rb") as selfie, open(ref_path, "rb") as ref:
+            clients[attempt] = client
+            return client.images.edit(
                 model="gpt-image-1",
                 image=[selfie, ref],       # <-- здесь список файлов
                 prompt=full_prompt,
                 n=1,
-                size="1024x1024",
-                quality="medium"
+                **tier_params(tier)
             )
-        
+
+    def cancel(attempt: int) -> None:
+        # проигравшую попытку обрываем закрытием её HTTP-клиента
+        if attempt in clients:
+            clients[attempt].close()
+
+    preview = None
+    if GENERATION_STREAM:
+        # превью прошлой попытки (ретрай таска) продолжаем, а не шлём рядом второе
+        preview_message_id = job_state(job_id).get("preview_message_id")
+        preview = Preview(user_id, int(preview_message_id) if preview_message_id else None)
+    response = b64 = None
+    try:
+        if preview is not None:
+            # без хеджирования: два потока показывали бы пользователю два превью
+            clients[0] = openai.OpenAI(api_key=pick_api_key())
+            b64 = stream_edit(clients[0], image_path, ref_path, full_prompt, preview, tier)
+        else:
+            response = _hedge.run_sync(request, cancel=cancel)
+
     except RateLimitError as e:
-        logger.warning(f"[{user_id}] Rate limit exceeded, retrying: {e}")
+        logger.warning("[%s] Rate limit exceeded, retrying: %s", user_id, e)
         # автоматически retry по декоратору
         raise
     except Exception as e:
-        logger.error(f"[{user_id}] Ошибка генерации изображения: {e}")
+        logger.error("[%s] Ошибка генерации изображения: %s", user_id, e)
         # если хотим ретраиться и на другие ошибки, можно раскинуть сюда
         raise self.retry(exc=e)
+    finally:
+        if preview is not None:
+            if 0 in clients:
+                clients[0].close()
+            # превью уже в чате — его заменит результат, ретрай или удалит on_failure
+            if preview.message_id is not None:
+                checkpoint(
+                    job_id,
+                    preview_message_id=preview.message_id,
+                    preview_editable_at=time.time() + preview.wait_time(),
+                )
 
     # 3. Декодируем Base64 и сохраняем результат
     try:
-        image_obj = response.data[0]
-        b64 = image_obj.b64_json
-        img_bytes = base64.b64decode(b64)
+        if response is not None:
+            b64 = response.data[0].b64_json
+        if not b64:
+            raise ValueError("пустой b64_json")
     except Exception as e:
-        logger.error(f"[{user_id}] Некорректный ответ от OpenAI: {e}")
+        logger.error("[%s] Некорректный ответ от OpenAI: %s", user_id, e)
         raise self.retry(exc=e)
 
-    result_path = f"{os.path.splitext(image_path)[0]}_result.png"
+    # имя на табличку упаковки — своим шрифтом, до сохранения: сохранённый файл уже окончательный
+    if NAME_RENDER:
+        b64 = render_name_b64(b64, user_name)
+
+    for attempt in range(1, PERSIST_ATTEMPTS + 1):
+        try:
+            save_result(b64, result_path)
+            break
+        except OSError as e:
+            if attempt == PERSIST_ATTEMPTS:
+                logger.error("[%s] Не удалось сохранить файл: %s", user_id, e)
+                raise self.retry(exc=e)
+            # картинка пока только в памяти — пробуем здесь же, а не ретраем таска
+            logger.warning("[%s] Не удалось сохранить файл, попытка %s: %s", user_id, attempt, e)
+            time.sleep(attempt)
+    logger.info("[%s] Сохранено изображение: %s", user_id, result_path)
+
+    # 4. Контрольная точка пройдена — дальше только доставка (id превью записан выше)
+    deliver_result_task.delay(
+        job_id=job_id, result_path=result_path, user_id=user_id, tier=tier, photo_count=photo_count, limit=limit
+    )
+
+
+@celery_app.task(
+    bind=True,
+    base=GenerationTask,
+    name="tasks.deliver_result_task",
+    max_retries=DELIVERY_MAX_RETRIES
+)
+def deliver_result_task(
+    self,
+    job_id: str,
+    result_path: str,
+    user_id: int,
+    tier: str | None = None,
+    photo_count: int | None = None,
+    limit: int | None = None
+) -> None:
+    """
+    Celery-таск: отправляет пользователю картинку, сохранённую generate_image_task.
+    Ошибки Telegram ретраят только эту стадию; уже доставленное повторно не отправляется.
+    photo_count/limit — счётчики из резервирования попытки; без них читаются из БД.
+    """
+    bind_log_context(user_id=user_id, tier=tier)
+    state = job_state(job_id)
+    if "message_id" in state:
+        logger.info("[%s] Результат задачи %s уже доставлен", user_id, job_id)
+        _fair.done(user_id, job_id)
+        return
+
+    # 5. Лимит и кол-во генераций — от бота или из БД
+    if photo_count is None or limit is None:
+        user = _store.get_user(user_id)
+        photo_count = user["photo_count"] if user else 0
+        # NULL — личного лимита нет, действует общий из settings
+        limit = user["allowed_generations"] if user and user["allowed_generations"] is not None else default_limit_sync(_store)
+
+    # подпись и кнопка «Другую фигурку» — общие с ImageGenerator (generation.py)
+    caption, more = result_caption(photo_count, limit)
+    reply_markup = json.dumps({"inline_keyboard": [[ANOTHER_BUTTON]]}) if more else None
+
+    # 6. Отправляем результат
+    try:
+        message_id = send_result(state, result_path, user_id, caption, reply_markup)
+    except requests.HTTPError as e:
+        if e.response is not None and 400 <= e.response.status_code < 500:
+            # бот заблокирован, чат удалён и т. п. — повтор не поможет (429 уже повторил клиент)
+            logger.error("[%s] Telegram отклонил результат: %s", user_id, e)
+            raise
+        logger.warning("[%s] Не удалось доставить результат, повтор: %s", user_id, e)
+        raise self.retry(exc=e, countdown=2 ** self.request.retries)
+    except requests.RequestException as e:
+        logger.warning("[%s] Не удалось доставить результат, повтор: %s", user_id, e)
+        raise self.retry(exc=e, countdown=2 ** self.request.retries)
+
+    # 7. Запоминаем, что результат доставлен, и его message_id — его пересылает /help.
+    # Результат уже у пользователя: ошибки учёта не роняют таск (иначе on_failure вернул бы попытку)
+    tier_name = tier or _degradation.tiers[0].name
     try:
-        with open(result_path, "wb") as out_f:
-            out_f.write(img_bytes)
-        logger.info(f"[{user_id}] Сохранено изображение: {result_path}")
+        checkpoint(job_id, message_id=message_id)
+        _fair.done(user_id, job_id)
+        _store.set_last_photo_ids({user_id: message_id})
+
+        # 8. Учитываем, на каком уровне качества выдан результат
+        _r.hincrby("degradation:tiers", tier_name, 1)
     except Exception as e:
-        logger.error(f"[{user_id}] Не удалось сохранить файл: {e}")
-        raise self.retry(exc=e)
+        logger.warning("[%s] Результат доставлен, но не учтён: %s", user_id, e)
+    logger.info("[%s] Результат доставлен, уровень качества %s", user_id, tier_name)
 
-    # 4. Отправляем в Telegram через HTTP (requests)
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT photo_count FROM users WHERE user_id = ?",
-        (user_id,)
-    )
-    row = cur.fetchone()
-    conn.close()
-    count = row[0] if row else 0
-
-    url = f"https://api.telegram.org/bot{API_TOKEN}/sendPhoto"
-
-    if count > 1:
-        caption = (
-            "Большое спасибо, что поучаствовали!❤️\n\n"
-            "Вы использовали все доступные попытки.\n\n"
-            "Обязательно ставьте фигурку на аватарку и не меняйте её до окончания акции и объявления победителей — 5 июня! 🤞\n\n"
-            "А если вам понравился результат, поделитесь им и ссылкой на бота с близкими — вдруг они тоже коллекционируют классный мерч.\n\n"
-            "Если что-то пошло не так, жмите /help 🥺"
-        ) 
-            # 4. Достаём из БД и лимит, и текущее кол-во генераций
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT photo_count, allowed_generations FROM users WHERE user_id = ?",
-        (user_id,)
-    )
-    row = cur.fetchone()
-    conn.close()
-    count = row[0] if row else 0
-    limit = row[1] if row and row[1] is not None else 2
-
-    url = f"https://api.telegram.org/bot{API_TOKEN}/sendPhoto"
-
-    if count >= limit:
-        # финальное сообщение — убираем клавиатуру
-        caption = (
-            "Большое спасибо, что поучаствовали!❤️\n\n"
-            "Вы использовали все доступные попытки.\n\n"
-            "Обязательно ставьте фигурку на аватарку и не меняйте её до окончания акции и объявления победителей — 5 июня! 🤞\n\n"
-            "А если вам понравился результат, поделитесь им и ссылкой на бота с близкими — вдруг они тоже коллекционируют классный мерч.\n\n"
-            "Если что-то пошло не так, жмите /help 🥺"
-        )
-        reply_markup = None
-    else:
-        # ещё есть попытки — предлагаем кнопку «Другую фигурку»
-        caption = (
-            "Ваша фигурка готова 🥳 Скорее скачивайте, ставьте на аватарку в Telegram и не меняйте до конца конкурса — 5 июня!\n\n"
-            "И не забудьте поделиться с друзьями, пусть тоже поучаствуют в розыгрыше приза!\n\n"
-            "Если вдруг что-то не так, пишите /help 🥺"
-        )
-        reply_markup = json.dumps({
-            "inline_keyboard": [[
-                {"text": "Другую фигурку", "callback_data": "another"}
-            ]]
-        })
-
-    data = {
-        "chat_id": user_id,
-        "caption": caption,
-    }
-    if reply_markup:
-        data["reply_markup"] = reply_markup
-
-    # 5. Отправляем результат
-    with open(result_path, "rb") as photo_f:
-        resp = requests.post(url, data=data, files={"photo": photo_f}, timeout=60)
-        resp.raise_for_status()
\ No newline at end of file
+
+def send_result(state: dict, result_path: str, user_id: int, caption: str, reply_markup: str | None) -> int:
+    """Заменяет превью результатом, если превью было, иначе шлёт новым сообщением; возвращает message_id."""
+    message_id = None
+    if "preview_message_id" in state:
+        time.sleep(max(float(state["preview_editable_at"]) - time.time(), 0.0))
+        media = {"type": "photo", "media": "attach://photo", "caption": caption}
+        edit = {"chat_id": user_id, "message_id": int(state["preview_message_id"]), "media": json.dumps(media)}
+        if reply_markup:
+            edit["reply_markup"] = reply_markup
+        try:
+            with open(result_path, "rb") as photo_f:
+                _telegram.call("editMessageMedia", data=edit, files={"photo": photo_f})
+            message_id = int(state["preview_message_id"])
+        except requests.RequestException as e:
+            logger.warning("[%s] Не удалось заменить превью, отправляем отдельно: %s", user_id, e)
+
+    if message_id is None:
+        data = {
+            "chat_id": user_id,
+            "caption": caption,
+        }
+        if reply_markup:
+            data["reply_markup"] = reply_markup
+        with open(result_path, "rb") as photo_f:
+            message_id = _telegram.call("sendPhoto", data=data, files={"photo": photo_f})["message_id"]
+    return message_id
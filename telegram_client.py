@@ -0,0 +1,255 @@
+# telegram_client.py
+
+import asyncio
+import os
+import threading
+import time
+
+import redis
+import requests
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from requests.adapters import HTTPAdapter
+
+from config import API_TOKEN, logger
+
+# Базовый адрес Bot API; для нагрузочных тестов подменяется локальной заглушкой
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+# лимиты Bot API на бота: около 30 сообщений в секунду всего и около одного в секунду в чат
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+# короткий всплеск в один чат (видео-заглушка, превью, результат) проходит без ожидания
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))
+# сколько раз повторять запрос после 429 с retry_after
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+# соединений с Bot API в пуле requests на процесс воркера
+TG_POOL_SIZE = int(os.getenv("TG_POOL_SIZE", "16"))
+# после ошибки Redis столько секунд шлём без лимита, не пытаясь достучаться до него на каждом сообщении
+TG_LIMITER_COOLDOWN = float(os.getenv("TG_LIMITER_COOLDOWN", "30"))
+
+# под лимит попадают только методы, которые пишут в чат; getUpdates, getChatMember и т. п. — нет
+LIMITED_PREFIXES = ("send", "edit", "forward", "copy")
+
+# Списывает по токену из общего бакета и бакета чата, если в обоих есть токен и нет паузы.
+# KEYS: общий бакет, бакет чата, общая пауза, пауза чата.
+# ARGV: скорость и ёмкость общего бакета, скорость и ёмкость бакета чата, "1" — чат задан.
+# Возвращает 0 или сколько миллисекунд подождать перед следующей попыткой.
+_ACQUIRE_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local wait = math.max(redis.call('PTTL', KEYS[3]), 0)
+if ARGV[5] == '1' then
+  wait = math.max(wait, redis.call('PTTL', KEYS[4]))
+end
+if wait > 0 then
+  return wait
+end
+
+local buckets = {{KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2])}}
+if ARGV[5] == '1' then
+  buckets[2] = {KEYS[2], tonumber(ARGV[3]), tonumber(ARGV[4])}
+end
+local levels = {}
+for i, b in ipairs(buckets) do
+  local v = redis.call('HMGET', b[1], 'tokens', 'ts')
+  local tokens = b[3]
+  if v[1] then
+    tokens = math.min(b[3], tonumber(v[1]) + (now - tonumber(v[2])) * b[2] / 1000)
+  end
+  levels[i] = tokens
+  if tokens < 1 then
+    wait = math.max(wait, math.ceil((1 - tokens) * 1000 / b[2]))
+  end
+end
+if wait > 0 then
+  return wait
+end
+for i, b in ipairs(buckets) do
+  redis.call('HSET', b[1], 'tokens', tostring(levels[i] - 1), 'ts', now)
+  redis.call('PEXPIRE', b[1], math.ceil(b[3] * 1000 / b[2]) + 1000)
+end
+return 0
+"""
+
+
+class _Buckets:
+    """Ключи и аргументы Lua-скрипта; общее у синхронного и асинхронного ограничителя."""
+
+    def __init__(self, redis_client, prefix: str = "tg", global_rate: float = TG_GLOBAL_RATE,
+                 chat_rate: float = TG_CHAT_RATE, chat_burst: float = TG_CHAT_BURST):
+        self.r = redis_client
+        self.prefix = prefix
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._acquire = redis_client.register_script(_ACQUIRE_LUA)
+        self._down_until = 0.0
+
+    def _available(self) -> bool:
+        return time.monotonic() >= self._down_until
+
+    def _failed(self, e: Exception) -> None:
+        self._down_until = time.monotonic() + TG_LIMITER_COOLDOWN
+        logger.warning("Лимит Bot API недоступен, %s с отправляем без него: %s", TG_LIMITER_COOLDOWN, e)
+
+    def _keys(self, chat_id) -> list[str]:
+        return [
+            f"{self.prefix}:bucket", f"{self.prefix}:bucket:{chat_id}",
+            f"{self.prefix}:pause", f"{self.prefix}:pause:{chat_id}",
+        ]
+
+    def _args(self, chat_id) -> list:
+        # ёмкость общего бакета — секунда трафика: всплеск больше лимита Bot API не пропускаем
+        return [self.global_rate, self.global_rate, self.chat_rate, self.chat_burst, int(chat_id is not None)]
+
+    def _pause_key(self, chat_id) -> str:
+        return f"{self.prefix}:pause:{chat_id}" if chat_id is not None else f"{self.prefix}:pause"
+
+
+class TelegramLimiter(_Buckets):
+    """
+    Общий для всех процессов лимит исходящих запросов к Bot API: токен-бакеты в Redis,
+    один на бота и по одному на чат, плюс паузы после 429. Синхронный — для Celery-воркеров.
+    Redis недоступен — запросы TG_LIMITER_COOLDOWN секунд идут без лимита.
+    """
+
+    def acquire_sync(self, chat_id=None) -> None:
+        """Ждёт, пока можно отправить ещё одно сообщение в чат chat_id (None — только общий лимит)."""
+        while self._available():
+            try:
+                wait_ms = self._acquire(keys=self._keys(chat_id), args=self._args(chat_id))
+            except redis.RedisError as e:
+                self._failed(e)
+                return
+            if not wait_ms:
+                return
+            time.sleep(wait_ms / 1000)
+
+    def pause_sync(self, chat_id, seconds: float) -> None:
+        """retry_after из ответа 429: все процессы ждут seconds перед запросами в этот чат."""
+        if self._available():
+            try:
+                self.r.set(self._pause_key(chat_id), 1, px=max(int(seconds * 1000), 1))
+                self.r.hincrby(f"{self.prefix}:metrics", "retry_after", 1)
+                return
+            except redis.RedisError as e:
+                self._failed(e)
+        # без Redis пауза только у этого процесса
+        time.sleep(seconds)
+
+
+class AsyncTelegramLimiter(_Buckets):
+    """То же для процесса бота; redis_client — redis.asyncio.Redis."""
+
+    async def acquire(self, chat_id=None) -> None:
+        while self._available():
+            try:
+                wait_ms = await self._acquire(keys=self._keys(chat_id), args=self._args(chat_id))
+            except redis.RedisError as e:
+                self._failed(e)
+                return
+            if not wait_ms:
+                return
+            await asyncio.sleep(wait_ms / 1000)
+
+    async def pause(self, chat_id, seconds: float) -> None:
+        if self._available():
+            try:
+                await self.r.set(self._pause_key(chat_id), 1, px=max(int(seconds * 1000), 1))
+                await self.r.hincrby(f"{self.prefix}:metrics", "retry_after", 1)
+                return
+            except redis.RedisError as e:
+                self._failed(e)
+        await asyncio.sleep(seconds)
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Middleware сессии aiogram: все исходящие сообщения бота (хендлеры, видео-заглушка,
+    ImageGenerator) проходят через общий лимит, а на TelegramRetryAfter запрос
+    повторяется после паузы, которую увидят и Celery-воркеры.
+    """
+
+    def __init__(self, limiter: AsyncTelegramLimiter, max_retries: int = TG_MAX_RETRIES):
+        self.limiter = limiter
+        self.max_retries = max_retries
+
+    async def __call__(self, make_request, bot, method):
+        if not method.__api_method__.startswith(LIMITED_PREFIXES):
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning("[%s] %s: 429, повтор через %s с", chat_id, method.__api_method__, e.retry_after)
+                await self.limiter.pause(chat_id, e.retry_after)
+
+
+class TelegramClient:
+    """
+    Bot API для Celery-воркеров: одна requests.Session с пулом соединений на процесс
+    (после fork — своя), общий лимит и повтор после 429 по retry_after.
+    """
+
+    def __init__(self, limiter: TelegramLimiter | None = None, token: str = API_TOKEN,
+                 base_url: str = TELEGRAM_API_URL, max_retries: int = TG_MAX_RETRIES,
+                 pool_size: int = TG_POOL_SIZE):
+        self.limiter = limiter
+        self.url = f"{base_url}/bot{token}"
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self._session: requests.Session | None = None
+        self._pid: int | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        # сокеты родителя после fork не переиспользуем
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session, self._pid = session, os.getpid()
+            return self._session
+
+    def call(self, method: str, data: dict | None = None, files: dict | None = None, timeout: float = 60) -> dict:
+        """Вызывает метод Bot API и возвращает result; ошибки HTTP — requests.HTTPError."""
+        chat_id = (data or {}).get("chat_id")
+        limited = self.limiter is not None and method.startswith(LIMITED_PREFIXES)
+        attempt = 0
+        while True:
+            if limited:
+                self.limiter.acquire_sync(chat_id)
+            _rewind(files)
+            resp = self.session.post(f"{self.url}/{method}", data=data, files=files, timeout=timeout)
+            if resp.status_code != 429 or attempt == self.max_retries:
+                resp.raise_for_status()
+                return resp.json()["result"]
+            attempt += 1
+            retry_after = _retry_after(resp)
+            logger.warning("[%s] %s: 429, повтор через %s с", chat_id, method, retry_after)
+            if limited:
+                self.limiter.pause_sync(chat_id, retry_after)
+            else:
+                time.sleep(retry_after)
+
+
+def _retry_after(resp: requests.Response) -> float:
+    try:
+        return float(resp.json()["parameters"]["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        return float(resp.headers.get("Retry-After", 1))
+
+
+def _rewind(files: dict | None) -> None:
+    """Файлы, уже прочитанные неудачной попыткой, отправляем заново с начала."""
+    for value in (files or {}).values():
+        f = value[1] if isinstance(value, tuple) else value
+        if hasattr(f, "seek"):
+            f.seek(0)
@@ -0,0 +1,70 @@
+# write_behind.py
+
+import asyncio
+from abc import ABC, abstractmethod
+
+from config import logger
+
+
+class WriteBehind(ABC):
+    """
+    Отложенная пакетная запись в БД: изменения копятся в _dirty (user_id → значение)
+    и пишутся одной пачкой раз в flush_interval секунд или сразу, как только
+    накопилось batch_size пользователей. close() дописывает остаток.
+
+    Наследник пишет пачку (_write) и решает, как вернуть неудачную пачку
+    к более свежим изменениям (_restore).
+    """
+
+    # что пишется — для логов
+    items = "записей"
+
+    def __init__(self, storage, batch_size: int = 200, flush_interval: float = 5.0):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._dirty: dict = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+        self._loop_task: asyncio.Task | None = None
+
+    @abstractmethod
+    async def _write(self, batch: dict) -> None:
+        ...
+
+    @abstractmethod
+    def _restore(self, batch: dict) -> None:
+        """Возвращает неудачную пачку в _dirty, не затирая более свежие значения."""
+
+    def _changed(self) -> None:
+        """Вызывается после записи в _dirty: полная пачка уходит сразу, не дожидаясь интервала."""
+        if len(self._dirty) >= self.batch_size and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self) -> None:
+        name = type(self).__name__
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            batch, self._dirty = self._dirty, {}
+            try:
+                await self._write(batch)
+                logger.debug("%s: записано %s %s", name, len(batch), self.items)
+            except Exception as e:
+                self._restore(batch)
+                logger.error("%s: не удалось записать пачку: %s", name, e)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self) -> None:
+        if self._loop_task is None:
+            self._loop_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            self._loop_task = None
+        await self.flush()